@@ -17,7 +17,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import datetime
+import functools
+import os
 import sys
+import time
 import getpass
 
 import apscheduler.scheduler as scheduler #@UnresolvedImport
@@ -29,8 +34,74 @@ import cron
 import backuprepository
 import process
 import path
-
-def make_full_location(c_user, c_host, c_path, c_device):
+import mountmanager
+import mountplanner
+import capacity
+import catalog
+import dirwatch
+import expiryqueue
+import fingerprint
+import jobexecutor
+import sharding
+
+
+# in seconds
+# Devices stay mounted this long after the last backup using them finished,
+# so backups of several tags firing at the same time share a single mount.
+_MOUNT_IDLE_TIMEOUT = 10 * 60
+
+# The number of devices that are mounted at the same time on a single host
+# when bringing up all devices at startup.
+_MAX_MOUNTS_PER_HOST = 4
+
+# An unchanged backup is cloned from the last one, which holds the same
+# files as the sources. Cloning may take this many times as long as walking
+# the sources for their fingerprint took.
+_CLONE_TIME_FACTOR = 10
+
+# in bytes
+# Backups are deferred if they are predicted to leave less free space on their
+# destination.
+_DESTINATION_RESERVE = 1024 ** 3
+
+# Every repository has a catalog of its backups in this directory, so the
+# repositories do not have to be listed on startup.
+_CATALOG_DIRECTORY = "/var/lib/autobackup"
+
+# Expired backups are deleted by this many threads in the background. Only
+# one backup per device is deleted at a time, as deletions on the same disk
+# just slow each other down.
+_EXPIRY_WORKERS = 4
+_MAX_DELETIONS_PER_DEVICE = 1
+
+# The backups of this many repositories run at the same time, but at most
+# _MAX_BACKUPS_PER_HOST reading from the same source host and
+# _MAX_BACKUPS_PER_DEVICE writing to the same destination device.
+_BACKUP_WORKERS = 4
+_MAX_BACKUPS_PER_HOST = 2
+_MAX_BACKUPS_PER_DEVICE = 1
+# in seconds
+# A backup running longer than this is cancelled. It stays partial and is
+# continued by the next backup of the repository.
+_BACKUP_TIMEOUT = 24 * 60 * 60
+
+# The number of rsyncs of a backup that run at the same time, every one
+# copying the sources on one host.
+_MAX_PARALLEL_SOURCES = 4
+
+# The statistics of rsync --stats that are reported for every backup.
+_RSYNC_TRANSFERRED_BYTES = "Total transferred file size"
+_RSYNC_TRANSFERRED_FILES = "Number of regular files transferred"
+# The size of all files of the sources, used to balance shards.
+_RSYNC_TOTAL_BYTES = "Total file size"
+# The exit code of rsync if source files vanished while they were copied,
+# which is normal for a live filesystem.
+_RSYNC_VANISHED_FILES = 24
+
+_mount_manager = mountmanager.MountManager(idle_timeout=_MOUNT_IDLE_TIMEOUT)
+
+def make_full_location(c_user, c_host, c_path, c_device,
+                       is_destination=False):
     # extract user from c_user
     if c_user is None:
         user = getpass.getuser()
@@ -54,18 +125,28 @@ def make_full_location(c_user, c_host, c_path, c_device):
     c_device = list(c_device.values())[0]
     if c_device is None:
         device = None
+        mountpoint = None
     else:
-        (uuid, fs, mountpoint) = c_device
+        (uuid, fs, mountpoint_path) = c_device
         if host is None:
             device_host = host.get_localhost()
         else:
             device_host = host
         device = filesystem.Device(host=device_host, uuid=uuid,
-                                    filesystem=fs, user=user,
-                                    mountpoint=mountpoint)
+                                    filesystem=fs, user=user)
+        if not is_destination:
+            (options, backup_options) = ((), None)
+        else:
+            (options, backup_options) = mountmanager.get_profiles(fs)
+        mountpoint = filesystem.Mountpoint(host=device_host,
+                                           path=mountpoint_path,
+                                           options=options,
+                                           create_if_not_existent=True,
+                                           user=user,
+                                           backup_options=backup_options)
 
     return path.FullLocation(user=user, host=host, path=path,
-                             device=device)
+                             device=device, mountpoint=mountpoint)
 
 def main():
     if len(sys.argv) != 2:
@@ -81,58 +162,132 @@ def main():
     config_structure = parser.parse()
     (c_backups, ) = config_structure
 
+    if not os.path.isdir(_CATALOG_DIRECTORY):
+        os.makedirs(_CATALOG_DIRECTORY)
+
+    expiry_queue = expiryqueue.ExpiryQueue(
+        delete_function=_delete_backup, workers=_EXPIRY_WORKERS,
+        max_per_device=_MAX_DELETIONS_PER_DEVICE)
+
     backup_repos = []
     # construct a list of backuprepositories out of c_backups
     for c_backup in c_backups:
         c_name = list(c_backup.keys())[0]
-        (c_sources, c_destination, c_tags) = list(c_backup.values())[0]
+        (c_sources, c_destination, c_tags,
+         c_expire_for_space) = list(c_backup.values())[0]
         sources = []
+        # The number of shards of every source, see sharding.
+        shard_counts = []
+        # The number of seconds every source is walked for its fingerprint.
+        fingerprint_time_limits = []
         destination = None
         tags = []
 
         for c_source in c_sources:
-            (c_user, c_host, c_path, c_device) = c_source
+            (c_user, c_host, c_path, c_device, c_shards,
+             c_fingerprint_time_limit) = c_source
             source = make_full_location(c_user, c_host, c_path, c_device)
             sources.append(source)
-        (c_user, c_host, c_path, c_device) = c_source
+            shard_counts.append(None if c_shards is None else int(c_shards))
+            fingerprint_time_limits.append(
+                process.FINGERPRINT_TIME_LIMIT
+                if c_fingerprint_time_limit is None
+                else float(c_fingerprint_time_limit))
+        (c_user, c_host, c_path, c_device, c_shards,
+         c_fingerprint_time_limit) = c_source
 
         (c_user, c_host, c_path, c_device) = c_destination
-        destination = make_full_location(c_user, c_host, c_path, c_device)
-
-        destination_directories = process.func_directory_get_files(
-                                      host=destination.host,
-                                      user=destination.user,
-                                      path=destination.path)
-
+        destination = make_full_location(c_user, c_host, c_path, c_device,
+                                         is_destination=True)
+
+        repository_catalog = catalog.Catalog(
+            os.path.join(_CATALOG_DIRECTORY, "{0}.sqlite".format(c_name)))
+        if repository_catalog.is_empty():
+            destination_directories = process.func_directory_get_files(
+                host=destination.host,
+                user=destination.user,
+                path=destination.path)
+        else:
+            # The repository is rescanned later on, if it changed.
+            destination_directories = None
 
         for c_tag in c_tags:
-            (c_cron, c_max_age, c_max_count) = c_tag
-            tag = backuprepository.Tag(cron=c_cron, max_age=c_max_age,
-                                       max_count=c_max_count)
+            c_tag_name = list(c_tag.keys())[0]
+            (c_cron, c_max_age, c_max_count, c_thinning) = \
+                list(c_tag.values())[0]
+            tag = backuprepository.Tag(
+                cron=cron.Cronjob(c_cron),
+                max_age=configparser.get_timedelta(c_max_age),
+                max_count=None if c_max_count is None else int(c_max_count),
+                name=c_tag_name,
+                thinning=c_thinning)
             tags.append(tag)
 
 
-        backup_repo = backuprepositoriy.BackupRepository(
+        backup_repo = backuprepository.BackupRepository(
             source_locations=sources,
             repository_location=destination,
             repository_directories=destination_directories,
-            tags=tags)
+            tags=tags,
+            capacity=capacity.CapacityEstimator(
+                location=destination, reserve=_DESTINATION_RESERVE),
+            expire_for_space=(c_expire_for_space is not None and
+                              _get_bool(c_expire_for_space)),
+            catalog=repository_catalog,
+            watcher=dirwatch.DirectoryWatcher(
+                host=destination.host, user=destination.user,
+                path=destination.path),
+            expiry_queue=expiry_queue,
+            acquire_destination=lambda location: _acquire_devices(
+                [location]),
+            release_destination=lambda location: _release_devices(
+                [location]))
+
+        backup_repo.backup_required += functools.partial(
+            _backup_required_handler, repository_catalog, shard_counts,
+            fingerprint_time_limits)
 
         backup_repos.append(backup_repo)
 
+    _mount_all_devices(backup_repos)
+
+    backup_executor = jobexecutor.JobExecutor(
+        workers=_BACKUP_WORKERS, max_per_host=_MAX_BACKUPS_PER_HOST,
+        max_per_device=_MAX_BACKUPS_PER_DEVICE)
+
     def check_all_backups():
+        # Every repository is checked in a job of its own, so a slow backup
+        # does not hold up the others. A repository whose last check is still
+        # waiting is not checked twice.
+        now = datetime.datetime.now()
         for backup_repo in backup_repos:
-            backup_repo.check_backups()
+            (sources, destination) = _get_transfer_locations(
+                backup_repo.source_locations, backup_repo.repository_location)
+            backup_executor.submit(
+                functools.partial(_check_repository, backup_repo, now),
+                key=backup_repo.catalog.path,
+                hosts=[source.host for source in sources],
+                devices=[location.device for location in [destination]
+                         if location.device is not None],
+                timeout=_BACKUP_TIMEOUT,
+                callback=functools.partial(_check_finished_handler,
+                                           backup_repo))
 
     # subscribe to all events
     for backup_repo in backup_repos:
-        backup_repo.backup_required += _backup_required_handler
         backup_repo.backup_expired += _backup_expired_handler
+        backup_repo.backup_deferred += _backup_deferred_handler
 
     # start scheduling
+    expiry_queue.start()
+    backup_executor.start()
     backup_scheduler = scheduler.Scheduler()
     check_all_backups()
     backup_scheduler.add_cron_job(check_all_backups, minute="*")
+    backup_scheduler.add_cron_job(_mount_manager.unmount_idle, minute="*")
+
+
+
 
 
 
@@ -160,20 +315,324 @@ def main():
 
 
 
+
+def _is_accessible(location):
+    """
+    Determines whether a location can be examined without mounting its
+    device. Locations on devices that were unmounted after being idle are
+    not rescanned, so they are not mounted again just for that.
+    """
+    return location.device is None or location.mountpoint.is_active()
+
+
+def _check_repository(backup_repo, now):
+    """
+    Checks the backups of a single repository. Called by the worker threads
+    of the backup executor.
+    """
+    # Rescanning is done in the same job as checking the backups, as the
+    # repository must not change while it is checked. It costs a single stat
+    # unless the repository changed.
+    if _is_accessible(backup_repo.repository_location):
+        try:
+            backup_repo.rescan()
+        except process.ProcessError as error:
+            print("Listing {0} failed: {1}".format(
+                backup_repo.repository_location.path, error))
+    try:
+        backup_repo.check_backups(now)
+    except process.ProcessError:
+        # The backup stays partial and is continued next time.
+        print("Backup to {0} failed.".format(
+            backup_repo.repository_location.path))
+    if _is_accessible(backup_repo.repository_location):
+        _update_usage(backup_repo)
+
+
+def _check_finished_handler(backup_repo, job):
+    if job.state == jobexecutor.JOB_FAILED:
+        print("Checking the backups in {0} failed: {1}".format(
+            backup_repo.repository_location.path, job.error))
+    elif job.state in (jobexecutor.JOB_CANCELLED, jobexecutor.JOB_TIMED_OUT):
+        print("Checking the backups in {0} {1}.".format(
+            backup_repo.repository_location.path, job.state))
+
+
+def _update_usage(backup_repo):
+    """
+    Accounts the space taken up by new backups of a repository and prints it
+    per tag if anything changed.
+    """
+    path = backup_repo.repository_location.path
+    try:
+        count = backup_repo.update_usage()
+    except OSError as error:
+        print("Accounting the backups in {0} failed: {1}".format(path, error))
+        return
+    if count == 0:
+        return
+    for (tag, unique_bytes) in sorted(
+            backup_repo.catalog.get_usage_by_tag().items(),
+            key=lambda item: str(item[0])):
+        print("Backups of tag {0} in {1} take up {2} bytes.".format(
+            tag, path, unique_bytes))
+
+
+def _backup_required_handler(repository_catalog, shard_counts,
+                             fingerprint_time_limits,
+                             repository_location, source_locations,
+                             link_backups, new_backup, partial_name):
+    (sources, repository) = _get_transfer_locations(source_locations,
+                                                    repository_location)
+    destination = path.Location(
+        repository.user, repository.host,
+        os.path.join(repository.path, new_backup.name))
+    # The backup is only renamed to its real name when it is complete.
+    partial = path.Location(
+        repository.user, repository.host,
+        os.path.join(repository.path,
+                     backuprepository.get_partial_name(new_backup.name)))
+    hardlink_to = [path.Location(repository.user, repository.host,
+                                 os.path.join(repository.path, backup.name))
+                   for backup in link_backups]
+    locations = sources + [repository]
+    _acquire_devices(locations)
+    try:
+        continued = False
+        if partial_name is not None:
+            # Continue where a failed backup stopped, so only the rest has
+            # to be transferred.
+            try:
+                process.func_rename(
+                    repository.host, repository.user,
+                    os.path.join(repository.path, partial_name),
+                    partial.path)
+                continued = True
+                print("Continuing partial backup {}.".format(partial_name))
+            except process.ProcessError:
+                # It was never created or removed by hand.
+                pass
+        # Taken before copying, so changes made while copying show up in
+        # the next fingerprint.
+        walk_start = time.time()
+        new_backup.fingerprint = _get_fingerprint(sources,
+                                                  fingerprint_time_limits)
+        walk_duration = time.time() - walk_start
+        unchanged = None
+        if not continued:
+            unchanged = _get_unchanged_backup(repository_catalog,
+                                              link_backups,
+                                              new_backup.fingerprint)
+        durations = []
+        if unchanged is not None:
+            # Nothing to transfer, so the sources are not even touched by
+            # rsync.
+            print("Sources unchanged since {}, hardlinking it to {}.".format(
+                unchanged.name, destination.get_ssh_string()))
+            process.func_clone_tree(
+                repository.host, repository.user,
+                os.path.join(repository.path, unchanged.name), partial.path,
+                time_limit=_CLONE_TIME_FACTOR * walk_duration)
+            new_backup.transferred = 0
+            new_backup.new_files = 0
+        else:
+            print("Creating new backup from {} to {}, hardlinking to {} "
+                  "older backups.".format(
+                      ", ".join([source.get_ssh_string()
+                                 for source in sources]),
+                      destination.get_ssh_string(), len(hardlink_to)))
+            # The sizes of the directories of sharded sources, as estimated
+            # by the last backup.
+            shard_sizes = dict(
+                (source.get_ssh_string(), sharding.load_sizes(
+                    repository_catalog, source.get_ssh_string()))
+                for (source, count) in zip(sources, shard_counts) if count)
+            (new_backup.transferred, new_backup.new_files,
+             durations) = func_create_backup(sources, partial, hardlink_to,
+                                             shard_counts, shard_sizes)
+            for (source_string, sizes) in shard_sizes.items():
+                sharding.save_sizes(repository_catalog, source_string, sizes)
+        process.func_rename(repository.host, repository.user, partial.path,
+                            destination.path)
+        for (sources_string, duration) in durations:
+            print("Copied {0} in {1:.2f}s.".format(sources_string, duration))
+        print("Transferred {0} bytes in {1} new files to {2}.".format(
+            new_backup.transferred, new_backup.new_files,
+            destination.get_ssh_string()))
+    finally:
+        _release_devices(locations)
+        _print_mount_timings()
+
+
+def _get_fingerprint(sources, time_limits):
+    """
+    Returns the fingerprint of all sources of a backup, see the fingerprint
+    module.
+    :param time_limits: The number of seconds every source may be walked.
+    :type time_limits: list of float
+    :returns: The fingerprint, None if a source could not be walked.
+    :rtype: string
+    """
+    fingerprints = []
+    for (source, time_limit) in zip(sources, time_limits):
+        try:
+            source_fingerprint = process.func_get_fingerprint(
+                source.host, getpass.getuser(), source.path,
+                time_limit=time_limit, remote_user=source.user)
+        except process.ProcessError:
+            # rsync will tell what is wrong with the source.
+            source_fingerprint = None
+        fingerprints.append((source.get_ssh_string(), source_fingerprint))
+    return fingerprint.combine(fingerprints)
+
+
+def _get_unchanged_backup(repository_catalog, link_backups,
+                          source_fingerprint):
+    """
+    Returns the latest backup of the sources if they did not change since,
+    so the new backup can be a copy of it.
+    :param link_backups: The link candidates of the new backup, see
+    BackupRepository.get_link_candidates().
+    :type link_backups: list of Backup instances
+    :param source_fingerprint: The current fingerprint of the sources.
+    :type source_fingerprint: string
+    :rtype: Backup instance
+    """
+    if source_fingerprint is None or len(link_backups) == 0:
+        return None
+    # The best candidate is the latest backup of the same sources.
+    latest = link_backups[0]
+    snapshot = repository_catalog.get_snapshot(latest.name)
+    if (snapshot is None or snapshot.status != catalog.STATUS_COMPLETE or
+            snapshot.fingerprint != source_fingerprint):
+        return None
+    return latest
+
+
+def _get_transfer_locations(source_locations, repository_location):
+    """
+    Determines the locations rsync shall use for a backup. A location whose
+    device lives on another host is accessed directly on the host of the
+    device instead of mounting the device on the location's host with sshfs,
+    as long as rsync can still reach both sides. rsync cannot copy between
+    two remote hosts, so sources fall back to sshfs if both they and the
+    destination would be remote otherwise.
+    :returns: A tuple containing the source locations and the destination
+    location.
+    :rtype: tuple
+    """
+    destination = repository_location.get_direct_location()
+    sources = []
+    for source in source_locations:
+        direct = source.get_direct_location()
+        if (direct.host.is_localhost() or
+                destination.host.is_localhost()):
+            sources.append(direct)
+        else:
+            sources.append(source)
+    return (sources, destination)
+
+
+def _mount_all_devices(backup_repos):
+    """
+    Mounts the devices of all backup repositories in parallel and prints how
+    long every mount took. The devices are released right away, so they stay
+    mounted for the idle timeout of the mount manager.
+    """
+    planner = mountplanner.MountPlanner(
+        mount_manager=_mount_manager,
+        max_mounts_per_host=_MAX_MOUNTS_PER_HOST)
+    for backup_repo in backup_repos:
+        (sources, destination) = _get_transfer_locations(
+            backup_repo.source_locations, backup_repo.repository_location)
+        for location in sources + [destination]:
+            if location.device is not None:
+                planner.add(location.device, location.mountpoint)
+    for result in planner.execute():
+        if result.error is None:
+            print("Mounted {0} at {1} in {2:.2f}s.".format(
+                result.device.uuid, result.mountpoint.path, result.duration))
+            _mount_manager.release(result.device, result.mountpoint)
+        else:
+            print("Mounting {0} at {1} failed after {2:.2f}s: {3}".format(
+                result.device.uuid, result.mountpoint.path, result.duration,
+                result.error))
+    _print_mount_timings()
+
+
+def _print_mount_timings():
+    """Prints the timings of all operations of the mount manager."""
+    for timing in _mount_manager.pop_timings():
+        print("{0} of {1} at {2} took {3:.2f}s.".format(
+            timing.operation.capitalize(), timing.device.uuid,
+            timing.mountpoint.path, timing.duration))
+
+
+def _acquire_devices(locations):
+    """
+    Acquires the devices of all locations from the mount manager. If
+    acquiring a device fails, the devices acquired so far are released again.
+    """
+    acquired = []
+    try:
+        for location in locations:
+            if location.device is not None:
+                _mount_manager.acquire(location.device, location.mountpoint)
+                acquired.append(location)
+    except (filesystem.MountError, process.ProcessError):
+        _release_devices(acquired)
+        raise
 
 
+def _release_devices(locations):
+    """Releases the devices of all locations acquired by _acquire_devices()."""
+    for location in locations:
+        if location.device is not None:
+            _mount_manager.release(location.device, location.mountpoint)
 
 
-def _backup_required_handler(repository_location, source_locations,
-                             latest_backup):
-    print("Creating new backup from {} to {}, hardlinking to {}.".
-          format(source_locations.path, repository_location.path,
-                 latest_backup))
 
+def _backup_deferred_handler(repository_location, tag, free_space,
+                             predicted_size):
+    print("Deferring backup to {0}: {1} bytes free, but {2} bytes expected."
+          .format(repository_location.path, free_space, predicted_size))
 
 
 def _backup_expired_handler(backup_location):
-    print("Removing backup {}".format())
+    print("Queueing backup {} for removal".format(
+        backup_location.get_ssh_string()))
+
+
+def _delete_backup(backup_location):
+    """
+    Deletes a backup with idle I/O priority. Called by the worker threads of
+    the expiry queue.
+    :raises: ProcessError or MountError if deleting the backup fails.
+    """
+    location = backup_location.get_direct_location()
+    print("Removing backup {}".format(location.get_ssh_string()))
+
+    def print_progress(progress):
+        print("Removing backup {0}: {1} files and {2} directories deleted, "
+              "{3:.0f} per second.".format(
+                  location.get_ssh_string(), progress.files,
+                  progress.directories, progress.get_throughput()))
+
+    _acquire_devices([location])
+    try:
+        progress = process.func_delete_tree(
+            location.host, location.user, location.path,
+            progress_callback=print_progress, idle_priority=True)
+        print("Removed backup {0}: {1} files and {2} directories in "
+              "{3:.2f}s.".format(location.get_ssh_string(), progress.files,
+                                 progress.directories,
+                                 time.time() - progress.start_time))
+    except process.ProcessError as error:
+        print("Removing backup {0} failed: {1}".format(
+            location.get_ssh_string(), error.stderrdata))
+        raise
+    finally:
+        _release_devices([location])
 
 
 
@@ -186,28 +645,282 @@ def _get_bool(boolstr):
     raise ValueError("{} is not a boolean value.".format(boolstr))
 
 
-def func_create_backup(source_locations, target_location, hardlink_to):
-    if not target_location.is_localhost() and  any([not loc.host.is_localhost() for loc in source_locations]):
+def func_create_backup(source_locations, target_location, hardlink_to,
+                       shard_counts=None, shard_sizes=None):
+    """
+    Copies the sources into the target with rsync. Files that did not change
+    since one of the older backups are hardlinked instead of copied. The
+    sources of every host and user are copied by a single rsync, up to
+    _MAX_PARALLEL_SOURCES of them at the same time, so a backup takes about
+    as long as its slowest host.
+    :param hardlink_to: The locations of older backups, best candidates
+    first, at most backuprepository.LINK_CANDIDATES.
+    :type hardlink_to: list of Location instances
+    :param shard_counts: The number of shards of every source, None or 0 for
+    sources that are not sharded, see sharding. The shards of a source are
+    copied by rsyncs of their own, all at the same time.
+    :type shard_counts: list of ints
+    :param shard_sizes: The estimated sizes of the directories of every
+    sharded source by the source as a string, see sharding.plan_shards().
+    They are updated with the sizes found by this backup.
+    :type shard_sizes: dict
+    :returns: A tuple containing the number of bytes transferred, the
+    number of regular files that were transferred, i.e. the files that got a
+    new inode instead of a hardlink, and the number of seconds every rsync
+    took as a list of (sources, seconds) tuples.
+    :rtype: tuple
+    :raises: ProcessError if rsync failed for a source, after all other
+    sources are done, so a retry has less to transfer. Sources that did not
+    start before the backup was cancelled are skipped, see
+    jobexecutor.get_current_job().
+    """
+    if (not target_location.host.is_localhost() and
+            any([not loc.host.is_localhost() for loc in source_locations])):
         raise Exception("Either source or location must be local.")
-    args = ["rsync"]
-    if hardlink_to == None:
-        link_dest = ""
-    else:
-        link_dest = ("--link-dest", hardlink_to.path)
-    args.extend(link_dest)
+    if shard_counts is None:
+        shard_counts = [None] * len(source_locations)
+    if shard_sizes is None:
+        shard_sizes = {}
+    # The target may contain a previous attempt. --delete removes what was
+    # deleted from the sources since, where it cannot hit the other
+    # sources, see _get_delete_args(). --partial keeps files that were cut
+    # off, so they do not start over either.
+    args = ["rsync", "--archive", "--stats", "--partial"]
+    link_args = []
+    for location in hardlink_to:
+        link_args.extend(("--link-dest", location.path))
     destination_string = target_location.get_ssh_string()
-    # We have to rsync every source location on their own, as all source args
-    # for rsync must come from the same machine
-    # TODO determine host and user for execution
-    host = None
-    user = None
-    for source in source_locations:
+    # rsync is terminated if the job of the backup is cancelled or times out.
+    # The pool threads do not run the job, so the event is taken from here.
+    job = jobexecutor.get_current_job()
+    cancel_event = None if job is None else job.cancelled
+
+    plain = [source for (source, count) in zip(source_locations, shard_counts)
+             if not count]
+    sharded = [(source, count) for (source, count)
+               in zip(source_locations, shard_counts) if count]
+    # (description, arguments) of every rsync
+    transfers = []
+    # All source args for rsync must come from the same machine, so there is
+    # one rsync per host. It needs a single ssh connection and file list.
+    for group in _group_sources(plain):
+        source_strings = [source.get_ssh_string() for source in group]
+        transfers.append((", ".join(source_strings),
+                          args + _get_delete_args(group, source_locations) +
+                          link_args + source_strings + [destination_string]))
+    # The top level of a sharded source is copied first, which creates the
+    # directories of the shards and removes everything that is gone. The
+    # shards are copied with --relative into the same places afterwards, so
+    # --link-dest finds their files at the same paths as well.
+    top_level = []
+    shard_plans = []
+    for (source, count) in sharded:
         source_string = source.get_ssh_string()
-        (exit_code, _, stderrdata) = \
-            execute(host, [args, source_string, destination_string], user)
-        if exit_code != 0:
+        entries = [entry.rstrip("/") for entry in
+                   process.func_directory_get_files(
+                       source.host, getpass.getuser(), source.path,
+                       remote_user=source.user)
+                   if entry.endswith("/")]
+        shards = sharding.plan_shards(
+            entries, shard_sizes.get(source_string, {}), count)
+        shard_plans.append((source_string, shards, len(transfers)))
+        top_level.append(_get_top_level_transfer(
+            source, target_location, hardlink_to,
+            _get_delete_args([source], source_locations)))
+        for (index, shard) in enumerate(shards):
+            shard_strings = [
+                path.Location(source.user, source.host,
+                              shard_path).get_ssh_string()
+                for shard_path in sharding.get_shard_paths(source.path,
+                                                           shard)]
+            transfers.append(("{0} (shard {1} of {2})".format(
+                source_string, index + 1, len(shards)),
+                # The directories of a shard belong to this source alone.
+                args + ["--delete", "--relative"] + link_args +
+                shard_strings + [destination_string]))
+    if top_level:
+        # rsync only creates the last directory of the target, which is a
+        # subdirectory of the target for the top level.
+        process.func_create_directory(
+            target_location.host, getpass.getuser(), target_location.path,
+            create_parents=True, remote_user=target_location.user)
+    workers = max([_MAX_PARALLEL_SOURCES] +
+                  [count for (_, count) in sharded])
+    results = (_run_transfers(top_level, workers, cancel_event) +
+               _run_transfers(transfers, workers, cancel_event))
+    offset = len(top_level)
+    for (source_string, shards, first) in shard_plans:
+        totals = []
+        for result in results[offset + first:offset + first + len(shards)]:
+            (_, exit_code, stdoutdata, _, _) = result
+            if exit_code in (0, _RSYNC_VANISHED_FILES):
+                totals.append(_parse_rsync_stats(stdoutdata).get(
+                    _RSYNC_TOTAL_BYTES, 0))
+            else:
+                totals.append(None)
+        shard_sizes[source_string] = sharding.update_sizes(
+            shard_sizes.get(source_string, {}), shards, totals)
+
+    transferred = 0
+    new_files = 0
+    durations = []
+    error = None
+    for (sources_string, exit_code, stdoutdata, stderrdata,
+         duration) in results:
+        if exit_code is None:
+            continue
+        if exit_code not in (0, _RSYNC_VANISHED_FILES):
             print("Backup from {0} to {1} failed:\n{2}".format(
-                source_string, destination_string, stderrdata))
+                sources_string, destination_string, stderrdata))
+            error = process.ProcessError(exit_code, stdoutdata, stderrdata)
+        stats = _parse_rsync_stats(stdoutdata)
+        transferred += stats.get(_RSYNC_TRANSFERRED_BYTES, 0)
+        new_files += stats.get(_RSYNC_TRANSFERRED_FILES, 0)
+        durations.append((sources_string, duration))
+    if error is None and cancel_event is not None and cancel_event.is_set():
+        error = process.ProcessError(None, "", "Cancelled.")
+    if error is not None:
+        raise error
+    return (transferred, new_files, durations)
+
+
+def _group_sources(source_locations):
+    """
+    Groups sources that can be copied by a single rsync, i.e. sources on the
+    same host that are accessed as the same user.
+    :returns: The groups in the order of their first source, every group in
+    the order of its sources.
+    :rtype: list of lists of Location instances
+    """
+    groups = []
+    for source in source_locations:
+        for group in groups:
+            if group[0].host == source.host and group[0].user == source.user:
+                group.append(source)
+                break
+        else:
+            groups.append([source])
+    return groups
+
+
+def _get_delete_args(sources, source_locations):
+    """
+    Returns the arguments that make rsync delete what is gone from some of
+    the sources of a backup. A source given with a trailing slash is copied
+    into the root of the target, where --delete would remove everything
+    the other sources copied, even while they are copying. Such sources
+    rely on the fresh target instead, only a continued backup may keep
+    files that were deleted in the meantime.
+    :param sources: The sources copied by a single rsync.
+    :type sources: list of Location instances
+    :param source_locations: All sources of the backup.
+    :type source_locations: list of Location instances
+    :rtype: list of strings
+    """
+    if (len(source_locations) > 1 and
+            any([source.path.endswith("/") for source in sources])):
+        return []
+    return ["--delete"]
+
+
+def _get_top_level_transfer(source, target_location, hardlink_to,
+                            delete_args):
+    """
+    Returns the rsync that copies the files directly in a sharded source and
+    creates its directories, but leaves the directories empty.
+    :param delete_args: See _get_delete_args().
+    :type delete_args: list of strings
+    :returns: A tuple containing a description and the arguments of rsync.
+    :rtype: tuple
+    """
+    # --archive would recurse, these are all its other options. --dirs only
+    # copies the contents of a directory given with a trailing slash, so the
+    # directory the source would create is named as the target instead.
+    args = ["rsync", "--links", "--perms", "--times", "--group", "--owner",
+            "--devices", "--specials", "--dirs", "--stats",
+            "--partial"] + delete_args
+    if source.path.endswith("/"):
+        subdirectory = ""
+    else:
+        subdirectory = os.path.basename(source.path)
+    # --link-dest directories are looked up relative to the target.
+    for location in hardlink_to:
+        args.extend(("--link-dest", os.path.join(location.path,
+                                                 subdirectory)))
+    source_string = path.Location(source.user, source.host,
+                                  source.path.rstrip("/") + "/"
+                                  ).get_ssh_string()
+    target_string = path.Location(
+        target_location.user, target_location.host,
+        os.path.join(target_location.path, subdirectory, "")
+        ).get_ssh_string()
+    return ("{0} (top level)".format(source.get_ssh_string()),
+            args + [source_string, target_string])
+
+
+def _run_transfers(transfers, workers, cancel_event):
+    """
+    Runs rsyncs in a pool of threads.
+    :param transfers: The description and the arguments of every rsync.
+    :type transfers: list of tuples
+    :param workers: The number of rsyncs to run at the same time.
+    :type workers: int
+    :returns: The results of _run_transfer() in the order of the transfers.
+    :rtype: list of tuples
+    """
+    if not transfers:
+        return []
+    pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(len(transfers), workers)))
+    try:
+        return list(pool.map(
+            lambda transfer: _run_transfer(transfer[0], transfer[1],
+                                           cancel_event),
+            transfers))
+    finally:
+        pool.shutdown(wait=True)
+
+
+def _run_transfer(description, args, cancel_event):
+    """
+    Runs a single rsync. Called by the threads of _run_transfers().
+    :returns: A tuple containing the description, the exit code of rsync or
+    None if the backup was cancelled before it started, its output to
+    stdout and stderr and the number of seconds it took.
+    :rtype: tuple
+    """
+    if cancel_event is not None and cancel_event.is_set():
+        return (description, None, "", "", 0.0)
+    start = time.time()
+    # rsync runs locally and reaches remote locations over ssh itself.
+    (exit_code, stdoutdata, stderrdata) = process.execute(
+        host.get_localhost(), args, getpass.getuser(),
+        cancel_event=cancel_event)
+    return (description, exit_code, stdoutdata, stderrdata,
+            time.time() - start)
+
+
+def _parse_rsync_stats(output):
+    """
+    Parses the statistics rsync prints with --stats, like
+    "Total transferred file size: 1,234 bytes".
+    :returns: The values of all statistics by their names.
+    :rtype: dict
+    """
+    stats = {}
+    for line in output.splitlines():
+        (name, separator, value) = line.partition(":")
+        if not separator:
+            continue
+        # Newer versions group digits by the locale and append details, like
+        # "Number of files: 5 (reg: 3, dir: 2)".
+        fields = value.split()
+        if len(fields) == 0:
+            continue
+        number = fields[0].replace(",", "").replace(".", "")
+        if number.isdigit():
+            stats[name.strip()] = int(number)
+    return stats
 
 if __name__ == '__main__':
     main()
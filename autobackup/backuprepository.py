@@ -1,20 +1,76 @@
+import array
+import bisect
 import datetime
+import functools
 import os
+import time
 
 
+import catalog
+import deletion
 import event
 import cron
+import path
+import process
+import retention
+import usage
 
 SUFFIX     = 'bak'
 # Timeformat used by the datetime.strptime() method of
 TIMEFORMAT = '%Y-%m-%dT%H:%M:%S'
 FORMAT     = "{0}.{1}".format(TIMEFORMAT, SUFFIX)
+# Backups are created in a directory with this suffix appended to their name
+# and renamed when they are complete, so a half-written backup never looks
+# like a backup.
+PARTIAL_SUFFIX = 'partial'
+_PARTIAL_SUFFIX_WITH_DOT = ".{0}".format(PARTIAL_SUFFIX)
+# Backup names start with the time formatted with TIMEFORMAT, which always
+# has this length.
+_TIME_LENGTH = len("YYYY-MM-DDTHH:MM:SS")
+_SUFFIX_WITH_DOT = ".{0}".format(SUFFIX)
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+# The number of parsed names that are cached, see _parse_name(). The least
+# recently used ones are dropped, so names of long deleted backups do not
+# pile up.
+_NAME_CACHE_SIZE = 100000
+# Up to this many backups are inserted into a _SortedBackups one by one,
+# more are appended and sorted at once, see _SortedBackups.extend().
+_INSERT_LIMIT = 16
+
+# rsync accepts at most this many --link-dest directories.
+LINK_CANDIDATES = 20
+
+# The state of the repository directory when it was last listed, as
+# remembered in the catalog.
+_DIRECTORY_STATE_KEY = "directory_state"
+# Backups created for a tag carry the name of the tag between the time and
+# the suffix: <time>.<tag>.<suffix>. Backups without a tag are just named
+# <time>.<suffix>.
 
 class Tag(object):
-    def __init__(self, cron, max_age, max_count):
+    def __init__(self, cron, max_age, max_count, name=None, thinning=None):
+        """
+        :param cron: The schedule of the backups of the tag.
+        :type cron: Cronjob instance
+        :param max_age: The maximum age of the backups of the tag, None if
+        there is no limit.
+        :type max_age: timedelta instance
+        :param max_count: The maximum number of backups of the tag, None if
+        there is no limit.
+        :type max_count: int
+        :param name: The name of the tag, which is part of the names of its
+        backups.
+        :type name: string
+        :param thinning: If given, only the newest backup of every hour, day,
+        week or month is kept, see retention.THINNING_BUCKETS.
+        :type thinning: string
+        """
         self.cron = cron
         self.max_age = max_age
         self.max_count = max_count
+        self.name = name
+        self.thinning = thinning
 
 
 class BackupRepository(object):
@@ -28,125 +84,744 @@ class BackupRepository(object):
                  source_locations,
                  repository_location,
                  repository_directories,
-                 tags):
-        """
-        :param sourceHost:
-        The host of the source directories.
-        :param sources:
-        A list with absolute pathes to all source directories.
-        :param host:
-        The host of the repository.
-        :param path:
-        The absolute path to the repository.
-        :param directories:
-        The subdirectories of the repository.
-        :param interval:
-        An timedelta object describing the desired interval between two
-        backups.
-        :param maxCount:
-        The maximum amount of backups to retain. If this number is exceeded,
-        the oldest backups are to be deleted first.
-        :param maxAge:
-        The maximum age of all backups. Older backups are to be deleted.
+                 tags,
+                 capacity=None,
+                 expire_for_space=False,
+                 catalog=None,
+                 watcher=None,
+                 expiry_queue=None,
+                 acquire_destination=None,
+                 release_destination=None):
+        """
+        :param source_locations:
+        A list of FullLocations of all source directories.
+        :param repository_location:
+        The FullLocation of the repository.
+        :param repository_directories:
+        The names of all directories in the repository. Names that are not
+        names of backups are ignored. If None, the backups are read from the
+        catalog instead.
+        :param tags:
+        A list of Tags, describing when backups are to be created and when they
+        expire. If the maximum count of a tag is exceeded, the oldest backups
+        are to be deleted first. Backups older than the maximum age are to be
+        deleted.
+        :param capacity:
+        A CapacityEstimator for the destination. If given, a backup is only
+        required if it is predicted to fit on the destination, otherwise it is
+        deferred until it fits.
+        :param expire_for_space:
+        If True, the oldest backups are expired before a backup that would not
+        fit is deferred, until it fits or only one backup is left.
+        :param catalog:
+        The Catalog of the repository. If given, every backup that is
+        created or expired is recorded there.
+        :param watcher:
+        A DirectoryWatcher of the repository directory. If given, rescan()
+        only lists the repository if the watcher noticed a change.
+        :param expiry_queue:
+        An ExpiryQueue. If given, expired backups are put into it to be
+        deleted in the background, and so are backups that were expired but
+        not deleted before a restart.
+        :param acquire_destination:
+        Called with the repository location before a backup is required, so
+        the free space of the destination can be measured, e.g. to mount its
+        device.
+        :param release_destination:
+        Called with the repository location after a backup was required, see
+        acquire_destination.
         """
         self.repository_location = repository_location
         self.repository_directories = repository_directories
 
         self.source_locations = source_locations
+        self.tags = tags
+        self.capacity = capacity
+        self.expire_for_space = expire_for_space
+        self.catalog = catalog
+        self.watcher = watcher
+        self.expiry_queue = expiry_queue
+        self.acquire_destination = acquire_destination
+        self.release_destination = release_destination
+        # Identifies the sources in the catalog, so backups created from the
+        # same sources can be preferred as hardlink targets.
+        self._sources = "\n".join(sorted(
+            source.get_ssh_string() for source in source_locations))
 
         self.backup_required = event.Event()
         self.backup_expired = event.Event()
+        self.backup_deferred = event.Event()
 
-        # tag-name -> backup[]
+        # Tags whose backups could not be created due to missing space. They
+        # are retried on every check, as their cron will not match again
+        # until the next occurence.
+        self._deferred_tags = []
+        # The names of the backups that are in the expiry queue.
+        self._deleting = set()
+        # The names of the partial directories of backups that failed, oldest
+        # first. The next backup continues in the newest one.
+        self._partials = []
+
+        # Backups are not kept as Backup instances, which would take hundreds
+        # of bytes each, but only as their birth and the id of their tag.
+        # Their names can be rebuilt from that, see _make_backup().
+        # tag-id -> tag-name, untagged backups have the tag-name None
+        self._tag_names = []
+        # tag-name -> backups sorted by birth
         self.backups = {}
-        for directory in self.source_locations:
-            backup = Backup(directory, tags)
-            self.backups[backup.tag] = backup
+        # all backups of all tags sorted by birth
+        self._all_backups = _SortedBackups()
+
+        if self.catalog is not None:
+            self._load_catalog()
+        if repository_directories is not None:
+            self.reconcile(repository_directories)
+
+
+    def _load_catalog(self):
+        # Nothing has to be listed if the directory did not change while we
+        # were not running.
+        if self.watcher is not None and self.watcher.state is None:
+            self.watcher.state = self.catalog.get_value(_DIRECTORY_STATE_KEY)
+        # Backups that were running when we stopped never finished.
+        for snapshot in self.catalog.get_snapshots(catalog.STATUS_RUNNING):
+            self.catalog.update(snapshot.name, status=catalog.STATUS_FAILED)
+        # Their partial directories may still be there. Continuing the
+        # backup of other sources would carry their files along.
+        for snapshot in self.catalog.get_snapshots(catalog.STATUS_FAILED):
+            if snapshot.sources == self._sources:
+                self._partials.append(get_partial_name(snapshot.name))
+        complete = self.catalog.get_snapshots(catalog.STATUS_COMPLETE)
+        self._add_backups(Backup(self._get_backup_location(snapshot.name))
+                          for snapshot in complete)
+        # The growth model learns the sizes of the backups oldest first, so
+        # the first backup after a restart is predicted like any other.
+        if self.capacity is not None:
+            for snapshot in complete:
+                if snapshot.size is not None:
+                    self.capacity.growth.add_sample(snapshot.size)
+        # Backups that expired before we stopped may not be deleted yet.
+        for snapshot in self.catalog.get_snapshots(catalog.STATUS_EXPIRED):
+            self._delete_backup(self._get_backup_location(snapshot.name))
+
+
+    def rescan(self):
+        """
+        Lists the repository and reconciles the backups with it, if it
+        changed since it was last listed.
+        :returns: A tuple containing the number of added and of removed
+        backups.
+        :rtype: tuple
+        :raises: ProcessError if listing the repository fails.
+        """
+        if self.watcher is not None and not self.watcher.has_changed():
+            return (0, 0)
+        try:
+            directories = process.func_directory_get_files(
+                host=self.repository_location.host,
+                user=self.repository_location.user,
+                path=self.repository_location.path)
+        except process.ProcessError:
+            raise
+        result = self.reconcile(directories)
+        if self.watcher is not None:
+            self.watcher.acknowledge()
+            if self.catalog is not None:
+                self.catalog.set_value(_DIRECTORY_STATE_KEY,
+                                       self.watcher.state)
+        return result
+
+
+    def reconcile(self, repository_directories):
+        """
+        Updates the backups after the repository changed behind our back,
+        e.g. because backups were deleted by hand. Only backups that
+        appeared or vanished are touched.
+        :param repository_directories:
+        The names of all directories in the repository.
+        :returns: A tuple containing the number of added and of removed
+        backups.
+        :rtype: tuple
+        """
+        present = {}
+        partials = []
+        for directory in repository_directories:
+            directory = directory.rstrip('/')
+            if directory.endswith(_PARTIAL_SUFFIX_WITH_DOT):
+                partials.append(directory)
+                continue
+            if deletion.is_deleting_path(directory):
+                # The deletion of a backup was interrupted.
+                self._delete_backup(self._get_backup_location(directory))
+                continue
+            try:
+                backup = Backup(self._get_backup_location(directory))
+            except ValueError:
+                # Not a backup, e.g. a file somebody put there.
+                continue
+            present[backup.name] = backup
+        # Failed and expired backups are still there, but must not be used.
+        ignored = set()
+        if self.catalog is not None:
+            # Failed backups keep their records while their partial
+            # directories are there, so they can be continued.
+            self.catalog.reconcile(
+                [(backup.name, backup.tag, backup.timestamp)
+                 for backup in present.values()],
+                [name[:-len(_PARTIAL_SUFFIX_WITH_DOT)] for name in partials])
+            ignored = set(
+                snapshot.name for snapshot in self.catalog.get_snapshots()
+                if snapshot.status != catalog.STATUS_COMPLETE)
+        known = set(self._all_backups.get_keys())
+        present_keys = set((backup.timestamp, self._get_tag_id(backup.tag))
+                           for backup in present.values())
+        added = [backup for (name, backup) in present.items()
+                 if (backup.timestamp, self._get_tag_id(backup.tag))
+                 not in known and name not in ignored]
+        removed = [self._make_backup(timestamp, tag_id)
+                   for (timestamp, tag_id) in known - present_keys]
+        self._add_backups(added)
+        for backup in removed:
+            self._remove_backup(backup)
+        # Names start with the birth, so they sort by age.
+        self._partials = sorted(partial for partial in partials
+                                if self._is_own_partial(partial))
+        return (len(added), len(removed))
+
+
+    def _is_own_partial(self, partial_name):
+        """
+        Determines whether a partial directory belongs to a failed backup of
+        the sources of this repository, see _load_catalog(). Without a
+        catalog, the sources are only known for backups that failed while we
+        were running.
+        :rtype: bool
+        """
+        if partial_name in self._partials:
+            return True
+        if self.catalog is None:
+            return False
+        snapshot = self.catalog.get_snapshot(
+            partial_name[:-len(_PARTIAL_SUFFIX_WITH_DOT)])
+        return (snapshot is not None and
+                snapshot.status == catalog.STATUS_FAILED and
+                snapshot.sources == self._sources)
 
 
-    def check_backups(self):
-        now = datetime.datetime.now()
+    def check_backups(self, now=None):
+        """
+        Expires backups and requires new backups for all tags whose cron
+        matches.
+        :param now: The time to check for, the current time if None. Checks
+        that have to wait for a while pass the time they were due.
+        :type now: datetime instance
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        self._expire_backups(now)
         for tag in self.tags:
-            # "tag" looks like: cron, max_age, max_count
-            max_age = tag[1]
-            max_count = tag[2]
-            while len(self.backups[tag]) > max_count:
-                latest_backup = self._get_latest_backup(tag)
-                self._on_backup_expired(latest_backup)
-                del latest_backup
-            for backup in self.backups[tag]:
-                if backup.birth < max_age:
-                    self._on_backup_expired(backup.location)
-                    del backup
-            if tag[0].matches(now):
-                self._on_backup_required(self.repository_location,
-                                         self.source_locations,
-                                         self._get_latest_backup(),
-                                         tag)
+            if tag.cron.matches(now) or tag in self._deferred_tags:
+                self._create_backup_if_fits(tag)
+
+
+    def _expire_backups(self, now):
+        """
+        Expires all backups that are too old, too many or thinned out by
+        their tag, all in one go.
+        """
+        tags = dict((tag.name, tag) for tag in self.tags)
+        # The columns are handed over as they are. Backups of tags that are
+        # not configured (anymore) never expire.
+        expired = retention.get_expired(
+            births=self._all_backups.births,
+            tag_ids=self._all_backups.tag_ids,
+            tags=[tags.get(tag_name) for tag_name in self._tag_names],
+            now=retention.to_timestamp(now))
+        expired = [self._make_backup(self._all_backups.births[index],
+                                     self._all_backups.tag_ids[index])
+                   for index in expired]
+        for backup in expired:
+            self._on_backup_expired(backup)
 
 
+    def get_backups_between(self, start=None, end=None, tag=None):
+        """
+        Returns all backups born in a period, oldest first.
+        :param start: The start of the period (inclusive), None for no limit.
+        :type start: datetime instance
+        :param end: The end of the period (inclusive), None for no limit.
+        :type end: datetime instance
+        :param tag: The name of the tag whose backups are returned. If None,
+        the backups of all tags are returned.
+        :type tag: string
+        :returns: All backups born in the period.
+        :rtype: list of Backup instances
+        """
+        if tag is None:
+            backups = self._all_backups
+        else:
+            backups = self._get_backups(tag)
+        if start is not None:
+            start = retention.to_timestamp(start)
+        if end is not None:
+            end = retention.to_timestamp(end)
+        return [self._make_backup(backups.births[index],
+                                  backups.tag_ids[index])
+                for index in backups.get_range(start, end)]
+
+
+    def get_link_candidates(self, count=LINK_CANDIDATES):
+        """
+        Returns the backups a new backup shall hardlink unchanged files to,
+        best candidates first. Backups of all tags are considered. Backups
+        created from the same sources come first, as they most likely contain
+        the same files, then all others. Both are ordered by recency.
+        :param count: The maximum number of backups to return.
+        :type count: int
+        :rtype: list of Backup instances
+        """
+        candidates = []
+        if self.catalog is not None:
+            candidates = [
+                Backup(self._get_backup_location(snapshot.name))
+                for snapshot in self.catalog.get_latest_snapshots(
+                    count, catalog.STATUS_COMPLETE, self._sources)]
+        names = set(backup.name for backup in candidates)
+        index = len(self._all_backups) - 1
+        while len(candidates) < count and index >= 0:
+            backup = self._make_backup(self._all_backups.births[index],
+                                       self._all_backups.tag_ids[index])
+            if backup.name not in names:
+                candidates.append(backup)
+            index -= 1
+        return candidates
+
+
+    def update_usage(self):
+        """
+        Accounts the unique bytes of all complete backups that were not
+        accounted yet, and hands on the files of backups that are gone to
+        the backups still holding them, see the usage module. Does nothing
+        without a catalog or if the repository is on another host.
+        :returns: The number of backups accounted.
+        :rtype: int
+        :raises: OSError if walking a backup fails.
+        """
+        if self.catalog is None:
+            return 0
+        location = self.repository_location.get_direct_location()
+        if location.host is not None and not location.host.is_localhost():
+            return 0
+        usage.release_inodes(self.catalog, location.path, LINK_CANDIDATES)
+        count = 0
+        for snapshot in self.catalog.get_snapshots(catalog.STATUS_COMPLETE):
+            if snapshot.unique_bytes is None:
+                usage.account_backup(self.catalog, location.path, snapshot)
+                count += 1
+        return count
+
+
+    def _create_backup_if_fits(self, tag):
+        """
+        Requires a backup for a tag if it is predicted to fit on the
+        destination. Otherwise, the oldest backups are expired first if
+        expire_for_space is set, and if that does not help, the backup is
+        deferred.
+        """
+        # An unmounted destination would report the free space of the
+        # filesystem below its mountpoint.
+        if self.acquire_destination is not None:
+            self.acquire_destination(self.repository_location)
+        try:
+            self._create_backup(tag)
+        finally:
+            if self.release_destination is not None:
+                self.release_destination(self.repository_location)
+
+
+    def _create_backup(self, tag):
+        """
+        Does the work of _create_backup_if_fits() while the destination is
+        acquired.
+        """
+        if self.capacity is not None:
+            # The last measurement may be from before the destination was
+            # mounted.
+            self.capacity.get_free_space(refresh=True)
+            # Deleting in the background does not free any space right away,
+            # so nothing more is expired until the queued backups are gone.
+            while (not self.capacity.will_fit() and self.expire_for_space and
+                   self._count_backups() > 1 and not self._deleting):
+                self._on_backup_expired(self._get_oldest_backup(None))
+                self.capacity.get_free_space(refresh=True)
+            if not self.capacity.will_fit():
+                if tag not in self._deferred_tags:
+                    self._deferred_tags.append(tag)
+                self._on_backup_deferred(tag)
+                return
+        if tag in self._deferred_tags:
+            self._deferred_tags.remove(tag)
+
+        new_backup = self._on_backup_required(self.repository_location,
+                                              self.source_locations,
+                                              self.get_link_candidates(),
+                                              tag)
+        if self.capacity is not None and new_backup is not None:
+            # The bytes rsync wrote, unlike the free space, are not changed
+            # by deletions and other backups on the same filesystem.
+            self.capacity.backup_finished(new_backup.transferred)
+
+
+    def _count_backups(self):
+        return len(self._all_backups)
+
+
+    def _on_backup_deferred(self, tag):
+        if len(self.backup_deferred):
+            self.backup_deferred(self.repository_location, tag,
+                                 self.capacity.get_free_space(),
+                                 self.capacity.growth.predict())
 
 
     def _on_backup_required(self, repository_location, source_locations,
-                            latest_backup, tag):
+                            link_backups, tag):
         if len(self.backup_required):
-            self.backup_required(repository_location, source_locations,
-                                 latest_backup, new_backup_dirname)
-
-            self.backups.append(Backup(os.path.join(
-                                                  self.repository_location.path,
-                                                  new_backup_dirname)))
+            new_backup = Backup(self._get_backup_location(
+                make_name(datetime.datetime.now(), tag.name)))
+            if self.catalog is not None:
+                self.catalog.add(new_backup.name, new_backup.tag,
+                                 new_backup.timestamp, catalog.STATUS_RUNNING,
+                                 sources=self._sources)
+            partial_name = None
+            if self._partials:
+                partial_name = self._partials.pop()
+            start = time.time()
+            try:
+                self.backup_required(repository_location, source_locations,
+                                     link_backups, new_backup, partial_name)
+            except Exception:
+                self._partials.append(get_partial_name(new_backup.name))
+                if self.catalog is not None:
+                    self.catalog.update(new_backup.name,
+                                        status=catalog.STATUS_FAILED,
+                                        duration=time.time() - start)
+                raise
+            if self.catalog is not None:
+                # Hardlinked files take no space, so the backup consumed
+                # what was transferred.
+                self.catalog.update(new_backup.name,
+                                    status=catalog.STATUS_COMPLETE,
+                                    duration=time.time() - start,
+                                    size=new_backup.transferred,
+                                    transferred=new_backup.transferred,
+                                    new_files=new_backup.new_files,
+                                    fingerprint=new_backup.fingerprint)
+            self._add_backup(new_backup)
+            return new_backup
+        return None
 
 
-    def _on_backup_expired(self, location):
+    def _on_backup_expired(self, backup):
+        # The backup is forgotten even if nobody deletes it, otherwise it
+        # would expire again and again.
+        self._remove_backup(backup)
+        if self.catalog is not None:
+            self.catalog.update(backup.name, status=catalog.STATUS_EXPIRED)
         if len(self.backup_expired):
-            self.backup_expired(location)
-            del([backup for backup in self.backups \
-                        if backup.location == location][0])
+            self.backup_expired(backup.location)
+        self._delete_backup(backup.location)
+
+
+    def _delete_backup(self, location):
+        """
+        Puts a backup into the expiry queue, if there is one. Returns right
+        away.
+        """
+        if self.expiry_queue is None:
+            return
+        name = os.path.basename(location.path.rstrip('/'))
+        if name in self._deleting:
+            return
+        self._deleting.add(name)
+        if not self.expiry_queue.put(location, self._on_backup_deleted):
+            # The remains of an interrupted deletion of a queued backup.
+            self._deleting.discard(name)
+
+
+    def _on_backup_deleted(self, location, error):
+        # Called from a worker thread of the expiry queue.
+        name = os.path.basename(location.path.rstrip('/'))
+        self._deleting.discard(name)
+        if error is None and self.catalog is not None:
+            self.catalog.remove(name)
+
+
+    def _get_backup_location(self, name):
+        return path.FullLocation(
+            user=self.repository_location.user,
+            host=self.repository_location.host,
+            path=os.path.join(self.repository_location.path,
+                              name.rstrip('/')),
+            device=self.repository_location.device,
+            mountpoint=self.repository_location.mountpoint)
+
+
+    def _get_backups(self, tag):
+        if tag not in self.backups:
+            self.backups[tag] = _SortedBackups()
+        return self.backups[tag]
+
+
+    def _get_tag_id(self, tag):
+        try:
+            return self._tag_names.index(tag)
+        except ValueError:
+            self._tag_names.append(tag)
+            return len(self._tag_names) - 1
+
+
+    def _make_backup(self, timestamp, tag_id):
+        """
+        Rebuilds a backup from its birth and the id of its tag.
+        """
+        return Backup(self._get_backup_location(
+            make_name(_from_timestamp(timestamp), self._tag_names[tag_id])))
+
+
+    def _add_backup(self, backup):
+        tag_id = self._get_tag_id(backup.tag)
+        self._get_backups(backup.tag).add(backup.timestamp, tag_id)
+        self._all_backups.add(backup.timestamp, tag_id)
+
+
+    def _add_backups(self, backups):
+        # tag-name -> keys of the backups of the tag
+        keys = {}
+        for backup in backups:
+            keys.setdefault(backup.tag, []).append(
+                (backup.timestamp, self._get_tag_id(backup.tag)))
+        for (tag, tag_keys) in keys.items():
+            self._get_backups(tag).extend(tag_keys)
+        self._all_backups.extend(
+            key for tag_keys in keys.values() for key in tag_keys)
+
+
+    def _remove_backup(self, backup):
+        tag_id = self._get_tag_id(backup.tag)
+        self._get_backups(backup.tag).remove(backup.timestamp, tag_id)
+        self._all_backups.remove(backup.timestamp, tag_id)
 
 
     def _get_latest_backup(self, tag=None):
         if tag is None:
-            backups = []
-            for tag in self.backups:
-                backups.extend(self.backups[tag])
+            backups = self._all_backups
         else:
-            backups = self.backups[tag]
+            backups = self._get_backups(tag)
         if len(backups) == 0:
             return None
-        latest = backups[0]
-        for backup in backups:
-            if backup.birth > latest.birth:
-                latest = backup
-        return latest
+        return self._make_backup(backups.births[-1], backups.tag_ids[-1])
 
     def _get_oldest_backup(self, tag):
         if tag is None:
-            backups = []
-            for tag in self.backups:
-                backups.extend(self.backups[tag])
+            backups = self._all_backups
         else:
-            backups = self.backups[tag]
-
+            backups = self._get_backups(tag)
         if len(backups) == 0:
             return None
-        oldest = backups[0]
-        for backup in backups:
-            if backup.birth < oldest.birth:
-                oldest = backup
-        return oldest
+        return self._make_backup(backups.births[0], backups.tag_ids[0])
+
+
+
+class _SortedBackups(object):
+    """
+    The births and tag ids of backups, sorted by birth. They are stored in
+    two arrays of machine integers, which take ten bytes per backup. The
+    oldest and latest backup are at the ends, the position of a backup to
+    insert, remove or of a range is found by bisection in O(log n).
+    """
+
+    def __init__(self):
+        # Both arrays are kept in the same order.
+        self.births = array.array('q')
+        self.tag_ids = array.array('H')
+
+    def __len__(self):
+        return len(self.births)
+
+    def get_keys(self):
+        """
+        :returns: The birth and tag id of every backup.
+        :rtype: iterator of tuples
+        """
+        return zip(self.births, self.tag_ids)
+
+    def add(self, birth, tag_id):
+        index = bisect.bisect_right(self.births, birth)
+        self.births.insert(index, birth)
+        self.tag_ids.insert(index, tag_id)
+
+    def extend(self, keys):
+        """
+        Adds many backups at once. Inserting moves all later backups every
+        time, so more than _INSERT_LIMIT backups are appended and sorted
+        once instead. Backups with the same birth keep their order, just
+        like with add().
+        :param keys: The birth and tag id of every backup.
+        :type keys: iterable of tuples
+        """
+        keys = sorted(keys, key=_get_birth)
+        if len(keys) <= _INSERT_LIMIT:
+            for (birth, tag_id) in keys:
+                self.add(birth, tag_id)
+            return
+        if len(self.births) > 0 and keys[0][0] < self.births[-1]:
+            # The sort is stable, so the backups that were already there
+            # stay in front of new ones with the same birth.
+            keys = sorted(list(self.get_keys()) + keys, key=_get_birth)
+            self.births = array.array('q')
+            self.tag_ids = array.array('H')
+        self.births.extend(birth for (birth, _) in keys)
+        self.tag_ids.extend(tag_id for (_, tag_id) in keys)
+
+    def remove(self, birth, tag_id):
+        index = bisect.bisect_left(self.births, birth)
+        end = bisect.bisect_right(self.births, birth)
+        while index < end:
+            if self.tag_ids[index] == tag_id:
+                del self.births[index]
+                del self.tag_ids[index]
+                return
+            index += 1
+        raise ValueError("Backup not found.")
+
+    def get_range(self, start=None, end=None):
+        """
+        :returns: The indices of all backups born between start and end
+        (inclusive).
+        :rtype: range
+        """
+        if start is None:
+            first = 0
+        else:
+            first = bisect.bisect_left(self.births, start)
+        if end is None:
+            last = len(self.births)
+        else:
+            last = bisect.bisect_right(self.births, end)
+        return range(first, last)
+
+
+def _get_birth(key):
+    return key[0]
 
 
 
 class Backup(object):
 
-    def __init__(self, dirname, tags):
-        self.dirname = dirname
-        self.tags = tags
-        (self.tag, self.birth) = _parse_name(location.path)
+    # Backups are created in bulk while reconciling, so they do without a
+    # __dict__.
+    __slots__ = ("location", "name", "tag", "birth", "timestamp",
+                 "transferred", "new_files", "fingerprint")
 
-def _parse_name(path):
-    if not dirname.endswith(".{}".format(SUFFIX)):
-        raise ValueError("Invalid extension.")
-    return ("taggy", datetime.datetime.strptime(dirname.split('.')[0], TIMEFORMAT))
+    def __init__(self, location):
+        """
+        :param location: The location of the backup directory. Its name has
+        to be the name of a backup, see make_name().
+        :type location: FullLocation instance
+        :raises: ValueError if the name is not the name of a backup.
+        """
+        self.location = location
+        self.name = os.path.basename(location.path.rstrip('/'))
+        (self.tag, self.birth, self.timestamp) = _parse_name(self.name)
+        # Set by whoever creates the backup: the number of bytes
+        # transferred, the number of files that could not be hardlinked and
+        # the fingerprint of the sources, see the fingerprint module.
+        self.transferred = None
+        self.new_files = None
+        self.fingerprint = None
+
+
+def make_name(birth, tag=None):
+    """
+    Returns the name of the backup directory of a backup.
+    :param birth: The time the backup was created.
+    :type birth: datetime instance
+    :param tag: The name of the tag of the backup, None for no tag.
+    :type tag: string
+    :returns: The name of the backup directory.
+    :rtype: string
+    """
+    parts = [birth.strftime(TIMEFORMAT)]
+    if tag is not None:
+        parts.append(tag)
+    parts.append(SUFFIX)
+    return ".".join(parts)
+
+
+def get_partial_name(name):
+    """
+    Returns the name of the directory a backup is created in.
+    :param name: The name of the backup.
+    :type name: string
+    :rtype: string
+    """
+    return name + _PARTIAL_SUFFIX_WITH_DOT
+
+
+def _from_timestamp(timestamp):
+    """The reverse of retention.to_timestamp()."""
+    return _EPOCH + datetime.timedelta(seconds=timestamp)
 
+
+def get_timestamps(names):
+    """
+    Returns the births of many backups at once, as needed by the retention
+    module.
+    :param names: The names of the backups.
+    :type names: iterable of strings
+    :returns: The birth of every backup, see retention.to_timestamp().
+    :rtype: list of ints
+    :raises: ValueError if a name is not the name of a backup.
+    """
+    return [_parse_name(name)[2] for name in names]
+
+
+@functools.lru_cache(maxsize=_NAME_CACHE_SIZE)
+def _parse_name(name):
+    """
+    Parses the name of a backup. The time is always at the same offsets, so
+    it is sliced apart instead of going through datetime.strptime(), which
+    interprets the format string every time. Results are cached, as the same
+    names are parsed on every rescan.
+    :returns: A tuple containing the name of the tag, the birth and the
+    birth as a timestamp, see retention.to_timestamp().
+    :rtype: tuple
+    :raises: ValueError if the name is not the name of a backup.
+    """
+    if (len(name) < _TIME_LENGTH + len(_SUFFIX_WITH_DOT) or
+            not name.endswith(_SUFFIX_WITH_DOT)):
+        raise ValueError("Invalid extension.")
+    time_string = name[:_TIME_LENGTH]
+    # isdigit() alone would accept other digits than 0-9
+    if (time_string[4] != "-" or time_string[7] != "-" or
+            time_string[10] != "T" or time_string[13] != ":" or
+            time_string[16] != ":" or not time_string.isascii() or
+            not (time_string[0:4] + time_string[5:7] + time_string[8:10] +
+                 time_string[11:13] + time_string[14:16] +
+                 time_string[17:19]).isdigit()):
+        raise ValueError("Invalid time {}.".format(time_string))
+    # raises ValueError for days and times that do not exist
+    birth = datetime.datetime(int(time_string[0:4]), int(time_string[5:7]),
+                              int(time_string[8:10]), int(time_string[11:13]),
+                              int(time_string[14:16]),
+                              int(time_string[17:19]))
+    rest = name[_TIME_LENGTH:-len(_SUFFIX_WITH_DOT)]
+    if rest == "":
+        tag = None
+    elif rest[0] == "." and len(rest) > 1:
+        tag = rest[1:]
+    else:
+        raise ValueError("Invalid tag.")
+    timestamp = ((birth.toordinal() - _EPOCH_ORDINAL) * 86400 +
+                 birth.hour * 3600 + birth.minute * 60 + birth.second)
+    return (tag, birth, timestamp)
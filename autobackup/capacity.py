@@ -0,0 +1,150 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of autobackup.
+#
+# autobackup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autobackup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to predict whether a backup will fit on its destination. The free
+space of the destination is compared with the sizes of the previous
+backups, as measured by rsync, so no backup has to be examined with du.
+"""
+
+import time
+
+import process
+
+
+# in seconds
+# The free space of a destination is measured at most this often, except
+# around backups, where it is always measured.
+_FREE_SPACE_MAX_AGE = 60
+
+# Weights of the newest sample for the running mean and deviation of
+# GrowthModel, the same as TCP uses for round trip times (RFC 6298).
+_MEAN_GAIN = 0.125
+_DEVIATION_GAIN = 0.25
+# How many deviations above the mean a prediction lies.
+_DEVIATION_FACTOR = 4
+
+
+class GrowthModel(object):
+    """
+    Learns how many bytes a backup of a repository consumes on its
+    destination. The prediction is the running mean plus a multiple of the
+    running deviation, so it adapts quickly to growing backups but does not
+    jump with every outlier.
+    """
+    def __init__(self):
+        self.mean = None
+        self.deviation = 0.0
+        self.samples = 0
+
+    def add_sample(self, size):
+        """
+        Adds the size of a finished backup.
+        :param size: The number of bytes the backup consumed.
+        :type size: int
+        """
+        if self.mean is None:
+            self.mean = float(size)
+            self.deviation = size / 2.0
+        else:
+            error = size - self.mean
+            self.mean += _MEAN_GAIN * error
+            self.deviation += _DEVIATION_GAIN * (abs(error) - self.deviation)
+        self.samples += 1
+
+    def predict(self):
+        """
+        Predicts the size of the next backup.
+        :returns: The predicted size in bytes, or None if there are no
+        samples yet.
+        :rtype: int
+        """
+        if self.mean is None:
+            return None
+        return int(self.mean + _DEVIATION_FACTOR * self.deviation)
+
+
+class CapacityEstimator(object):
+    """
+    Tracks the free space of the destination of a repository and the growth
+    of its backups. The growth of a backup is the number of bytes written for
+    it, not the free space consumed while it was created, which also changes
+    with deletions and other writers on the same filesystem.
+    """
+    def __init__(self, location, reserve=0):
+        """
+        :param location: The location of the repository.
+        :type location: Location instance
+        :param reserve: The number of bytes that shall always stay free on the
+        destination.
+        :type reserve: int
+        """
+        self.location = location
+        self.reserve = reserve
+        self.growth = GrowthModel()
+
+        self._free_space = None
+        self._measure_time = None
+
+    def get_free_space(self, refresh=False):
+        """
+        Returns the free space of the destination in bytes.
+        :param refresh: If True, the free space is measured even if the last
+        measurement is recent enough.
+        :type refresh: bool
+        :returns: The free space in bytes.
+        :rtype: int
+        :raises: ProcessError if measuring the free space fails.
+        """
+        if (refresh or self._free_space is None or
+                time.time() - self._measure_time >= _FREE_SPACE_MAX_AGE):
+            try:
+                (free, _) = process.func_get_filesystem_usage(
+                    self.location.host, self.location.user,
+                    self.location.path)
+            except process.ProcessError:
+                raise
+            self._free_space = free
+            self._measure_time = time.time()
+        return self._free_space
+
+    def will_fit(self):
+        """
+        Predicts whether the next backup will fit on the destination. Without
+        any history, it is assumed to fit.
+        :returns: True if the backup is expected to fit, False otherwise.
+        :rtype: bool
+        :raises: ProcessError if measuring the free space fails.
+        """
+        predicted = self.growth.predict()
+        if predicted is None:
+            return True
+        return self.get_free_space() - self.reserve >= predicted
+
+    def backup_finished(self, size):
+        """
+        Has to be called after a backup has been written successfully. Adds
+        its size to the growth model. The free space is measured again the
+        next time it is needed.
+        :param size: The number of bytes written for the backup, None if
+        unknown.
+        :type size: int
+        """
+        if size is not None:
+            self.growth.add_sample(size)
+        self._free_space = None
@@ -0,0 +1,400 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of autobackup.
+#
+# autobackup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autobackup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to remember the backups of a repository between runs. Every
+repository has a catalog, a SQLite database on the local machine, that lists
+its backups together with everything known about them. The catalog is read
+on startup instead of listing the repository, and reconciled with the
+repository from time to time.
+
+The catalog also keeps the owner of every file inode in the repository, see
+the usage module.
+"""
+
+import collections
+import sqlite3
+import threading
+
+
+# The backup is being created.
+STATUS_RUNNING = "running"
+# The backup has been created successfully, or it was found in the
+# repository.
+STATUS_COMPLETE = "complete"
+# Creating the backup failed, its directory may be incomplete.
+STATUS_FAILED = "failed"
+# The backup has expired and is waiting to be deleted.
+STATUS_EXPIRED = "expired"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    name TEXT PRIMARY KEY,
+    tag TEXT,
+    birth INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    size INTEGER,
+    transferred INTEGER,
+    duration REAL,
+    fingerprint TEXT,
+    sources TEXT,
+    new_files INTEGER,
+    unique_bytes INTEGER
+);
+CREATE TABLE IF NOT EXISTS properties (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS inodes (
+    inode INTEGER PRIMARY KEY,
+    snapshot TEXT NOT NULL,
+    birth INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS inodes_snapshot ON inodes (snapshot)
+"""
+_COLUMNS = ("name", "tag", "birth", "status", "size", "transferred",
+            "duration", "fingerprint", "sources", "new_files", "unique_bytes")
+# Columns that were added after catalogs had already been created, with their
+# types.
+_ADDED_COLUMNS = (("sources", "TEXT"), ("new_files", "INTEGER"),
+                  ("unique_bytes", "INTEGER"))
+_INODE_COLUMNS = ("inode", "snapshot", "birth", "path", "size")
+# SQLite allows at most 999 parameters per statement in older versions.
+_MAX_PARAMETERS = 900
+
+# A backup as recorded in the catalog.
+# name: The name of the backup directory.
+# tag: The name of the tag of the backup, None for no tag.
+# birth: The birth of the backup, see retention.to_timestamp().
+# status: One of the STATUS_* constants.
+# size: The number of bytes the backup consumed on the destination, None if
+# unknown.
+# transferred: The number of bytes transferred to create the backup, None if
+# unknown.
+# duration: The number of seconds it took to create the backup, None if
+# unknown.
+# fingerprint: The fingerprint of the sources the backup was created from,
+# None if unknown.
+# sources: The source locations the backup was created from, see
+# BackupRepository, None if unknown.
+# new_files: The number of files that were transferred instead of hardlinked
+# to an older backup, None if unknown.
+# unique_bytes: The number of bytes on the destination that belong to this
+# backup, counting every hardlinked file only for the oldest backup holding
+# it, None if not accounted yet. See the usage module.
+Snapshot = collections.namedtuple("Snapshot", _COLUMNS)
+
+# A file inode in the repository and the backup it is attributed to.
+# inode: The inode number.
+# snapshot: The name of the backup owning the inode.
+# birth: The birth of that backup.
+# path: The path of the file relative to the backup directory.
+# size: The number of bytes the inode occupies.
+Inode = collections.namedtuple("Inode", _INODE_COLUMNS)
+
+
+class Catalog(object):
+    """
+    The catalog of a single repository. It can be used from several threads.
+    """
+    def __init__(self, path):
+        """
+        :param path: The path to the database file, which is created if it
+        does not exist. ":memory:" keeps the catalog in memory.
+        :type path: string
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            with self._connection:
+                self._connection.executescript(_SCHEMA)
+                existing = set(row[1] for row in self._connection.execute(
+                    "PRAGMA table_info(snapshots)"))
+                for (column, column_type) in _ADDED_COLUMNS:
+                    if column not in existing:
+                        self._connection.execute(
+                            "ALTER TABLE snapshots ADD COLUMN {0} {1}".format(
+                                column, column_type))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def get_snapshots(self, status=None):
+        """
+        Returns the backups in the catalog, oldest first.
+        :param status: If given, only backups with this status are returned.
+        :type status: string
+        :rtype: list of Snapshot instances
+        """
+        query = "SELECT {0} FROM snapshots".format(", ".join(_COLUMNS))
+        parameters = ()
+        if status is not None:
+            query += " WHERE status = ?"
+            parameters = (status,)
+        query += " ORDER BY birth, name"
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        return [Snapshot(*row) for row in rows]
+
+    def get_latest_snapshots(self, count, status=None, sources=None):
+        """
+        Returns the newest backups in the catalog, newest first.
+        :param count: The maximum number of backups to return.
+        :type count: int
+        :param status: If given, only backups with this status are returned.
+        :type status: string
+        :param sources: If given, only backups created from these sources are
+        returned.
+        :type sources: string
+        :rtype: list of Snapshot instances
+        """
+        conditions = []
+        parameters = []
+        for (column, value) in (("status", status), ("sources", sources)):
+            if value is not None:
+                conditions.append("{0} = ?".format(column))
+                parameters.append(value)
+        query = "SELECT {0} FROM snapshots".format(", ".join(_COLUMNS))
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY birth DESC, name DESC LIMIT ?"
+        parameters.append(count)
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        return [Snapshot(*row) for row in rows]
+
+    def get_snapshot(self, name):
+        """
+        :returns: The backup with the given name, None if there is none.
+        :rtype: Snapshot instance
+        """
+        query = "SELECT {0} FROM snapshots WHERE name = ?".format(
+            ", ".join(_COLUMNS))
+        with self._lock:
+            row = self._connection.execute(query, (name,)).fetchone()
+        if row is None:
+            return None
+        return Snapshot(*row)
+
+    def is_empty(self):
+        with self._lock:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM snapshots").fetchone()
+        return count == 0
+
+    def add(self, name, tag, birth, status, **fields):
+        """
+        Adds a backup, replacing a backup with the same name.
+        :param fields: Values of the remaining columns of Snapshot.
+        :raises: ValueError if a field is not a column of Snapshot.
+        """
+        values = dict(name=name, tag=tag, birth=birth, status=status)
+        values.update(fields)
+        _check_columns(values)
+        columns = list(values.keys())
+        query = "INSERT OR REPLACE INTO snapshots ({0}) VALUES ({1})".format(
+            ", ".join(columns), ", ".join("?" * len(columns)))
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    query, [values[column] for column in columns])
+
+    def update(self, name, **fields):
+        """
+        Changes columns of a backup. Unknown backups are ignored.
+        :raises: ValueError if a field is not a column of Snapshot.
+        """
+        if len(fields) == 0:
+            return
+        _check_columns(fields)
+        columns = list(fields.keys())
+        query = "UPDATE snapshots SET {0} WHERE name = ?".format(
+            ", ".join("{0} = ?".format(column) for column in columns))
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    query, [fields[column] for column in columns] + [name])
+
+    def remove(self, name):
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    "DELETE FROM snapshots WHERE name = ?", (name,))
+
+    def get_usage_by_tag(self):
+        """
+        Returns how much space the complete backups of every tag take up,
+        as far as they were accounted.
+        :returns: A dictionary mapping the name of every tag to the sum of
+        the unique bytes of its backups.
+        :rtype: dict
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT tag, SUM(unique_bytes) FROM snapshots "
+                "WHERE status = ? AND unique_bytes IS NOT NULL "
+                "GROUP BY tag", (STATUS_COMPLETE,)).fetchall()
+        return dict(rows)
+
+    def get_inodes(self, inodes):
+        """
+        :param inodes: The inode numbers to look up.
+        :type inodes: list of ints
+        :returns: A dictionary mapping every inode number that has an owner
+        to its Inode.
+        :rtype: dict
+        """
+        result = {}
+        query = "SELECT {0} FROM inodes WHERE inode IN ({{0}})".format(
+            ", ".join(_INODE_COLUMNS))
+        with self._lock:
+            for start in range(0, len(inodes), _MAX_PARAMETERS):
+                chunk = inodes[start:start + _MAX_PARAMETERS]
+                for row in self._connection.execute(
+                        query.format(", ".join("?" * len(chunk))), chunk):
+                    result[row[0]] = Inode(*row)
+        return result
+
+    def get_orphaned_inodes(self):
+        """
+        :returns: The inodes whose owner is not in the catalog anymore,
+        oldest owner first.
+        :rtype: list of Inode instances
+        """
+        query = ("SELECT {0} FROM inodes WHERE snapshot NOT IN "
+                 "(SELECT name FROM snapshots) ORDER BY birth, inode".format(
+                     ", ".join(_INODE_COLUMNS)))
+        with self._lock:
+            rows = self._connection.execute(query).fetchall()
+        return [Inode(*row) for row in rows]
+
+    def set_inodes(self, snapshot, birth, inodes):
+        """
+        Makes a backup the owner of inodes. Their size is moved from the
+        unique bytes of their previous owners to the unique bytes of the
+        backup, unless these are None.
+        :param snapshot: The name of the backup.
+        :type snapshot: string
+        :param birth: The birth of the backup.
+        :type birth: int
+        :param inodes: The inode number, relative path and size of every
+        inode.
+        :type inodes: list of tuples
+        """
+        with self._lock:
+            with self._connection:
+                previous = []
+                numbers = [inode for (inode, _, _) in inodes]
+                for start in range(0, len(numbers), _MAX_PARAMETERS):
+                    chunk = numbers[start:start + _MAX_PARAMETERS]
+                    previous.extend(self._connection.execute(
+                        "SELECT snapshot, size FROM inodes "
+                        "WHERE inode IN ({0})".format(
+                            ", ".join("?" * len(chunk))), chunk))
+                self._connection.executemany(
+                    "UPDATE snapshots SET unique_bytes = unique_bytes - ? "
+                    "WHERE name = ?",
+                    [(size, owner) for (owner, size) in previous])
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO inodes ({0}) "
+                    "VALUES (?, ?, ?, ?, ?)".format(
+                        ", ".join(_INODE_COLUMNS)),
+                    [(inode, snapshot, birth, path, size)
+                     for (inode, path, size) in inodes])
+                self._connection.execute(
+                    "UPDATE snapshots SET unique_bytes = unique_bytes + ? "
+                    "WHERE name = ?",
+                    (sum(size for (_, _, size) in inodes), snapshot))
+
+    def remove_inodes(self, inodes):
+        """
+        Forgets inodes, e.g. because their files are gone.
+        :param inodes: The inode numbers.
+        :type inodes: list of ints
+        """
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(
+                    "DELETE FROM inodes WHERE inode = ?",
+                    [(inode,) for inode in inodes])
+
+    def get_value(self, key):
+        """
+        Returns a property of the repository, like the state of its
+        directory when it was last listed.
+        :returns: The value of the property, None if it is not set.
+        :rtype: string
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM properties WHERE key = ?",
+                (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_value(self, key, value):
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO properties (key, value) "
+                    "VALUES (?, ?)", (key, value))
+
+    def reconcile(self, snapshots, partials=()):
+        """
+        Makes the catalog match the backups found in the repository. Backups
+        that are not in the catalog yet are added as complete, backups that
+        are gone are removed. Everything else is left alone, so only the
+        differences are written.
+        :param snapshots: The name, tag name and birth of every backup in
+        the repository.
+        :type snapshots: list of tuples
+        :param partials: The names of the backups whose partial directories
+        are in the repository. They are kept, but not added.
+        :type partials: list of strings
+        :returns: A tuple containing the names of the added and of the
+        removed backups.
+        :rtype: tuple
+        """
+        present = dict((name, (tag, birth)) for (name, tag, birth)
+                       in snapshots)
+        with self._lock:
+            with self._connection:
+                known = set(row[0] for row in self._connection.execute(
+                    "SELECT name FROM snapshots"))
+                added = sorted(set(present) - known)
+                removed = sorted(known - set(present) - set(partials))
+                self._connection.executemany(
+                    "INSERT INTO snapshots (name, tag, birth, status) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(name, present[name][0], present[name][1],
+                      STATUS_COMPLETE) for name in added])
+                self._connection.executemany(
+                    "DELETE FROM snapshots WHERE name = ?",
+                    [(name,) for name in removed])
+        return (added, removed)
+
+
+def _check_columns(fields):
+    for column in fields:
+        if column not in _COLUMNS:
+            raise ValueError("Unknown column {}.".format(column))
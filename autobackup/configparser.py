@@ -21,6 +21,7 @@ This module helps reading configuration files of a specific format.
 This format is similar to XML, but not as flexible or powerful.
 """
 
+import datetime
 import os
 import xml.etree.ElementTree as etree
 import getpass
@@ -50,13 +51,17 @@ class XMLParser(Parser):
     The resulting structure is as follows:
     structure : [backups]
     backups : backup[]
-    backup : name -> (source[], destination, tag[])
-    source/destination : (user, host, path, device)
+    backup : name -> (source[], destination, tag[], expire_for_space)
+    source : (user, host, path, device, shards, fingerprint_time_limit)
+    destination : (user, host, path, device)
     user: string
     host: name -> (ip, hostname) or None
     path: string
     device: name -> (uuid, filesystem, mountpoint) or None
-    tag: name -> (cron, max_age, max_count)
+    shards: string or None
+    fingerprint_time_limit: string or None
+    expire_for_space: string or None
+    tag: name -> (cron, max_age, max_count, thinning)
     source/destination: (user, host, path, device)
     """
     def __init__(self, path):
@@ -106,7 +111,11 @@ class XMLParser(Parser):
                 host = _find_in(source.findtext("host"), hosts)
                 path = source.findtext("path")
                 device = _find_in(source.findtext("device"), devices)
-                sources.append((user, host, path, device))
+                shards = source.findtext("shards")
+                fingerprint_time_limit = source.findtext(
+                    "fingerprint_time_limit")
+                sources.append((user, host, path, device, shards,
+                                fingerprint_time_limit))
             destination = backup.find("destination")
             user = destination.findtext("user")
             host = _find_in(destination.findtext("host"), hosts)
@@ -119,11 +128,31 @@ class XMLParser(Parser):
                 cron = tag.findtext("cron")
                 max_age = tag.findtext("max_age")
                 max_count = tag.findtext("max_count")
-                tags.append({name: (cron, max_age, max_count)})
-            backups.append((sources, destination, tags))
+                thinning = tag.findtext("thinning")
+                tags.append({name: (cron, max_age, max_count, thinning)})
+            expire_for_space = backup.findtext("expire_for_space")
+            backups.append((sources, destination, tags, expire_for_space))
         self.structure = [hosts, devices, backups]
         return self.structure
 
+def get_timedelta(timespan):
+    """
+    Converts a timespan of the configuration like "_1y" or "_12h" into a
+    timedelta. Months and years are approximated by 30 and 365 days.
+    :returns: The timespan as a timedelta, or None if timespan is None.
+    :rtype: timedelta instance
+    :raises: ValueError if the timespan is malformed.
+    """
+    if timespan is None:
+        return None
+    units = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400,
+             "M": 30 * 86400, "y": 365 * 86400}
+    timespan = timespan.lstrip("_")
+    if len(timespan) < 2 or timespan[-1] not in units:
+        raise ValueError("{} is not a valid timespan.".format(timespan))
+    return datetime.timedelta(seconds=int(timespan[:-1]) * units[timespan[-1]])
+
+
 def _find_in(string, dictionary):
     if string is not None and not string in dictionary:
         raise ParseError(0,"","Not found.")
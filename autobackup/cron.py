@@ -393,10 +393,11 @@ def _parse_subexpression_at_index(expression, index):
                              "Missing end value for range formatter.")
         start, end = (_get_integer_at_index(parts[0], index),
                       _get_integer_at_index(parts[1], index))
-        if not start:
+        # 0 is a valid value for minutes and hours
+        if start is None or start not in _ranges[index]:
             raise ParseError(expression,
                              "Invalid start value for range formatter.")
-        if not end:
+        if end is None or end not in _ranges[index]:
             raise ParseError(expression,
                              "Invalid end value for range formatter.")
         if start > end:
@@ -406,7 +407,7 @@ def _parse_subexpression_at_index(expression, index):
         possible_values = set(range(start, end + 1))
     elif '*' == rest:
         possible_values = set(_ranges[index])
-    elif _get_integer_at_index(rest, index):
+    elif _get_integer_at_index(rest, index) in _ranges[index]:
         possible_values = {_get_integer_at_index(rest, index)}
     else:
         raise ParseError(expression, "Invalid expression")
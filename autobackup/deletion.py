@@ -0,0 +1,341 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of autobackup.
+#
+# autobackup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autobackup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to delete large directory trees, like expired backups that consist of
+millions of hardlinks. The tree is walked with os.scandir() and the files are
+unlinked by a pool of threads, so the filesystem always has several requests
+to work on. The number of operations per second can be capped, so backups
+running at the same time are not starved.
+
+Before anything is deleted, the tree is renamed by appending
+DELETING_SUFFIX. An interrupted deletion leaves a tree with that suffix
+behind, which is no backup anymore and can be deleted again later on.
+
+This module must only use the standard library, as it is sent to remote
+hosts and run there, see process.func_delete_tree().
+"""
+
+import concurrent.futures
+import errno
+import os
+import subprocess
+import sys
+import threading
+import time
+
+
+DELETING_SUFFIX = ".deleting"
+
+# The number of threads unlinking files.
+DEFAULT_THREADS = 8
+
+# The number of files unlinked by a thread at once.
+_BATCH_SIZE = 256
+
+# in seconds
+# The progress is reported this often.
+_PROGRESS_INTERVAL = 10
+
+
+class DeletionProgress(object):
+    """
+    The progress of a deletion. It is updated by several threads.
+    """
+    def __init__(self):
+        self.files = 0
+        self.directories = 0
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, files=0, directories=0):
+        with self._lock:
+            self.files += files
+            self.directories += directories
+
+    def get_throughput(self):
+        """
+        :returns: The number of files and directories deleted per second.
+        :rtype: float
+        """
+        elapsed = time.time() - self.start_time
+        if elapsed <= 0:
+            return 0.0
+        return (self.files + self.directories) / elapsed
+
+
+class _RateLimiter(object):
+    """Allows at most rate operations per second, over all threads."""
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._next_time = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, count=1):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_time)
+            self._next_time = start + count / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def get_deleting_path(path):
+    """
+    :returns: The path a tree is renamed to while it is deleted.
+    :rtype: string
+    """
+    return path.rstrip("/") + DELETING_SUFFIX
+
+
+def is_deleting_path(path):
+    """
+    :returns: True if the path is a tree whose deletion was interrupted.
+    :rtype: bool
+    """
+    return path.rstrip("/").endswith(DELETING_SUFFIX)
+
+
+def set_idle_io_priority():
+    """
+    Moves the calling thread into the idle I/O scheduling class, so it only
+    gets disk time nobody else wants. Threads started by it inherit the
+    class.
+    :returns: True if the class was changed, False if it is not supported.
+    :rtype: bool
+    """
+    get_native_id = getattr(threading, "get_native_id", None)
+    if get_native_id is None:
+        return False
+    try:
+        exit_code = subprocess.call(
+            ["ionice", "-c", "3", "-p", str(get_native_id())],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        return False
+    return exit_code == 0
+
+
+def delete_tree(path, threads=DEFAULT_THREADS, rate=None,
+                progress_callback=None, time_limit=None,
+                idle_priority=False):
+    """
+    Deletes a directory tree. A tree whose deletion was interrupted is
+    deleted as well, pass either its original path or the path with
+    DELETING_SUFFIX.
+    :param path: The path of the tree.
+    :type path: string
+    :param threads: The number of threads unlinking files.
+    :type threads: int
+    :param rate: The maximum number of files and directories to delete per
+    second, None for no limit.
+    :type rate: float
+    :param progress_callback: Called with a DeletionProgress instance every
+    _PROGRESS_INTERVAL seconds.
+    :type progress_callback: callable
+    :param time_limit: The number of seconds after which to stop. The
+    deletion can be resumed by calling delete_tree() again. None for no
+    limit.
+    :type time_limit: float
+    :param idle_priority: Determines whether to delete with idle I/O
+    priority, see set_idle_io_priority().
+    :type idle_priority: bool
+    :returns: A tuple containing True if the tree is gone, False if the time
+    limit was reached, and the DeletionProgress.
+    :rtype: tuple
+    :raises: OSError if a file or directory cannot be deleted.
+    """
+    progress = DeletionProgress()
+    deadline = None
+    if time_limit is not None:
+        deadline = time.time() + time_limit
+    if is_deleting_path(path):
+        deleting_path = path.rstrip("/")
+    else:
+        deleting_path = get_deleting_path(path)
+        if os.path.lexists(path):
+            if os.path.lexists(deleting_path):
+                # An earlier deletion of a tree with the same name was
+                # interrupted, it has to go first.
+                (finished, earlier_progress) = delete_tree(
+                    deleting_path, threads, rate, progress_callback,
+                    time_limit, idle_priority)
+                progress.add(earlier_progress.files,
+                             earlier_progress.directories)
+                if not finished:
+                    return (False, progress)
+            os.rename(path, deleting_path)
+    if not os.path.lexists(deleting_path):
+        return (True, progress)
+    if not os.path.isdir(deleting_path) or os.path.islink(deleting_path):
+        os.unlink(deleting_path)
+        progress.add(files=1)
+        return (True, progress)
+
+    limiter = None
+    if rate is not None:
+        limiter = _RateLimiter(rate)
+    initializer = None
+    if idle_priority:
+        initializer = set_idle_io_priority
+    # The directories are removed by the pool as well, so all deletions run
+    # with its priority.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads,
+                                                     initializer=initializer)
+    try:
+        (directories, walked) = _unlink_files(
+            deleting_path, executor, threads, limiter, progress,
+            progress_callback, deadline)
+        # If the deadline was reached, only the subtrees that were walked
+        # completely are empty. They are removed right away anyway, so the
+        # next call does not walk them again.
+        executor.submit(_remove_directories, directories, limiter, progress,
+                        not walked).result()
+        finished = walked
+    finally:
+        executor.shutdown(wait=True)
+    return (finished, progress)
+
+
+def _remove_directories(directories, limiter, progress,
+                        skip_non_empty=False):
+    """
+    Removes the (empty) directories of a tree. This takes about as long as
+    walking them, so it is not bound by the deadline.
+    :param skip_non_empty: Determines whether to leave directories that are
+    not empty instead of raising OSError.
+    :type skip_non_empty: bool
+    """
+    # Children come after their parents in the walk, so they are removed
+    # first.
+    for directory in reversed(directories):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            os.rmdir(directory)
+        except FileNotFoundError:
+            continue
+        except OSError as error:
+            if skip_non_empty and error.errno in (errno.ENOTEMPTY,
+                                                  errno.EEXIST):
+                continue
+            raise
+        progress.add(directories=1)
+
+
+def _unlink_files(root, executor, threads, limiter, progress,
+                  progress_callback, deadline):
+    """
+    Walks the tree and unlinks all files in it.
+    :returns: A tuple containing the directories walked, parents before
+    their children, and True if the whole tree was walked, False if the
+    deadline was reached.
+    :rtype: tuple
+    """
+    directories = []
+    stack = [root]
+    futures = []
+    # Walking is much faster than unlinking, so the number of pending batches
+    # is limited to keep the memory bounded.
+    slots = threading.BoundedSemaphore(threads * 2)
+    last_report = time.time()
+
+    def submit(batch):
+        slots.acquire()
+        future = executor.submit(_unlink_batch, batch, limiter, progress)
+        future.add_done_callback(lambda _: slots.release())
+        futures.append(future)
+
+    batch = []
+    # The walk only stops at the deadline once it got to the bottom of the
+    # tree, so at least one directory can be removed. Otherwise a tree too
+    # big to walk in time would be walked again and again without end.
+    leaf_walked = False
+    while stack:
+        if (deadline is not None and time.time() >= deadline and
+                leaf_walked):
+            break
+        directory = stack.pop()
+        directories.append(directory)
+        is_leaf = True
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        is_leaf = False
+                    else:
+                        batch.append(entry.path)
+                        if len(batch) >= _BATCH_SIZE:
+                            submit(batch)
+                            batch = []
+        except FileNotFoundError:
+            continue
+        leaf_walked = leaf_walked or is_leaf
+        # Finished batches are dropped, so their errors are checked now.
+        _check_futures([future for future in futures if future.done()])
+        futures = [future for future in futures if not future.done()]
+        if (progress_callback is not None and
+                time.time() - last_report >= _PROGRESS_INTERVAL):
+            progress_callback(progress)
+            last_report = time.time()
+    if batch:
+        submit(batch)
+    concurrent.futures.wait(futures)
+    _check_futures(futures)
+    return (directories, not stack)
+
+
+def _check_futures(futures):
+    for future in futures:
+        error = future.exception()
+        if error is not None:
+            raise error
+
+
+def _unlink_batch(paths, limiter, progress):
+    if limiter is not None:
+        limiter.acquire(len(paths))
+    count = 0
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            continue
+        count += 1
+    progress.add(files=count)
+
+
+def main():
+    """
+    Entry point when run on a remote host, see process.func_delete_tree().
+    Arguments: path, threads, rate (0 for no limit), time limit in seconds,
+    idle I/O priority (0 or 1). Prints the number of deleted files and
+    directories and whether the tree is gone.
+    """
+    (path, threads, rate, time_limit, idle_priority) = sys.argv[1:6]
+    rate = float(rate) or None
+    (finished, progress) = delete_tree(path, int(threads), rate,
+                                       time_limit=float(time_limit),
+                                       idle_priority=bool(int(idle_priority)))
+    print("{0} {1} {2}".format(progress.files, progress.directories,
+                               int(finished)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of autobackup.
+#
+# autobackup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autobackup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to notice changes to the entries of a directory without listing it.
+Adding, removing or renaming an entry updates the modification and change
+times of the directory, so comparing them with the times seen when the
+directory was last listed tells whether it has to be listed again. On the
+localhost, inotify additionally catches changes within the resolution of
+the timestamps.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+import process
+
+
+# inotify(7) events that change the entries of a directory or the directory
+# itself.
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+# The watch has been removed, e.g. because the filesystem was unmounted.
+_IN_IGNORED = 0x00008000
+_IN_WATCH_MASK = (_IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE |
+                  _IN_DELETE_SELF | _IN_MOVE_SELF)
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
+
+# struct inotify_event without the name that follows it
+_INOTIFY_EVENT = struct.Struct("iIII")
+_INOTIFY_BUFFER_SIZE = 64 * 1024
+
+
+class DirectoryWatcher(object):
+    """
+    Watches a directory for added, removed and renamed entries. A change is
+    reported until it is acknowledged, which has to happen after the
+    directory has been listed successfully:
+
+    if watcher.has_changed():
+        entries = list_directory()
+        watcher.acknowledge()
+    """
+    def __init__(self, host, user, path, state=None):
+        """
+        :param host: The host of the directory.
+        :type host: Host instance
+        :param user: The user as whom to examine the directory.
+        :type user: string
+        :param path: The path of the directory.
+        :type path: string
+        :param state: The state the directory had when it was last listed,
+        e.g. before a restart. If None, the first check reports a change.
+        :type state: string
+        """
+        self.host = host
+        self.user = user
+        self.path = path
+        self.state = state
+        self._pending_state = None
+        self._inotify = None
+        if host.is_localhost():
+            self._inotify = _create_inotify()
+        self._watch = None
+        self._notified = False
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def has_changed(self):
+        """
+        Determines whether the directory changed since the last
+        acknowledge(). A directory that cannot be examined, e.g. because its
+        filesystem is not mounted, has always changed.
+        :returns: True if the directory has to be listed, False otherwise.
+        :rtype: bool
+        :raises: TimeoutError or ConnectionRefusedError if a remote host
+        cannot be reached.
+        """
+        if self._inotify is not None:
+            # Watch first, so changes after the state is taken are caught
+            # next time.
+            if self._watch is None:
+                self._watch = self._inotify.add_watch(self.path,
+                                                      _IN_WATCH_MASK)
+            if self._inotify.read_events():
+                self._notified = True
+            if self._inotify.watch_removed:
+                self._watch = None
+                self._inotify.watch_removed = False
+                self._notified = True
+        self._pending_state = self._get_state()
+        return (self._notified or self._pending_state is None or
+                self._pending_state != self.state)
+
+    def acknowledge(self):
+        """
+        Remembers the state seen by the last has_changed() as listed.
+        """
+        self.state = self._pending_state
+        self._notified = False
+
+    def _get_state(self):
+        if self.host.is_localhost():
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                return None
+            return "{0} {1} {2} {3}".format(stat.st_dev, stat.st_ino,
+                                            stat.st_mtime_ns, stat.st_ctime_ns)
+        try:
+            return process.func_get_file_state(self.host, self.user,
+                                               self.path)
+        except process.ProcessError:
+            return None
+
+
+class _Inotify(object):
+    """A non-blocking inotify instance with at most one watch."""
+    def __init__(self, libc, fd):
+        self._libc = libc
+        self._fd = fd
+        # Set when the kernel dropped the watch.
+        self.watch_removed = False
+
+    def close(self):
+        os.close(self._fd)
+
+    def add_watch(self, path, mask):
+        """
+        :returns: The watch descriptor, or None if the path cannot be
+        watched.
+        """
+        watch = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if watch < 0:
+            return None
+        return watch
+
+    def read_events(self):
+        """
+        Reads all pending events.
+        :returns: True if there were any events, False otherwise.
+        :rtype: bool
+        """
+        found = False
+        while True:
+            try:
+                data = os.read(self._fd, _INOTIFY_BUFFER_SIZE)
+            except OSError as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return found
+                raise
+            offset = 0
+            while offset < len(data):
+                (_, mask, _, length) = _INOTIFY_EVENT.unpack_from(data,
+                                                                  offset)
+                if mask & _IN_IGNORED:
+                    self.watch_removed = True
+                offset += _INOTIFY_EVENT.size + length
+                found = True
+
+
+def _create_inotify():
+    """
+    Returns an inotify instance, or None if the platform does not support
+    it. Without inotify, only the state of the directory is compared.
+    """
+    library = ctypes.util.find_library("c")
+    if library is None:
+        return None
+    try:
+        libc = ctypes.CDLL(library, use_errno=True)
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    return _Inotify(libc, fd)
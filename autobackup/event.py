@@ -7,6 +7,8 @@ class Event(object):
 
     def add_handler(self, handler):
         self.handlers.add(handler)
+        # returned so that += does not replace the event with None
+        return self
 
 
     def remove_handler(self, handler):
@@ -14,6 +16,7 @@ class Event(object):
             raise ValueError("Handler not found.")
         else:
             self.handlers.remove(handler)
+        return self
 
 
     def has_handler(self, handler):
@@ -0,0 +1,182 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of autobackup.
+#
+# autobackup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autobackup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to delete expired backups in the background. Deleting a backup can
+take hours, so checking the backups only puts expired ones into a queue,
+which is worked off by a few threads. Deletions on the same device compete
+for the same disk, so only a limited number of them runs at once per device.
+
+The queue itself is not saved. Expired backups are marked in the catalog of
+their repository and half deleted ones are renamed (see the deletion
+module), so the repositories put them into the queue again after a restart.
+"""
+
+import threading
+
+import deletion
+
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_PER_DEVICE = 1
+
+
+class ExpiryQueue(object):
+    """
+    Deletes backups with a number of worker threads. A backup that is put
+    into the queue while it is already waiting or being deleted is ignored.
+    """
+    def __init__(self, delete_function, workers=DEFAULT_WORKERS,
+                 max_per_device=DEFAULT_MAX_PER_DEVICE):
+        """
+        :param delete_function: Called with the location of a backup to
+        delete it.
+        :type delete_function: callable
+        :param workers: The number of backups deleted at the same time.
+        :type workers: int
+        :param max_per_device: The number of backups deleted at the same time
+        on a single device. Backups without a device count for their host.
+        :type max_per_device: int
+        """
+        self.delete_function = delete_function
+        self.workers = workers
+        self.max_per_device = max_per_device
+        self._pending = []
+        self._running = []
+        self._condition = threading.Condition()
+        self._threads = []
+        self._stopped = False
+
+    def put(self, location, callback=None):
+        """
+        Adds a backup to the queue and returns immediately.
+        :param location: The location of the backup.
+        :type location: FullLocation instance
+        :param callback: Called from a worker thread with the location and
+        the exception that made the deletion fail, or None if it succeeded.
+        :type callback: callable
+        :returns: True if the backup was added, False if it is already in the
+        queue.
+        :rtype: bool
+        """
+        job = _ExpiryJob(location, callback)
+        with self._condition:
+            for other in self._pending + self._running:
+                if other.key == job.key:
+                    return False
+            self._pending.append(job)
+            self._condition.notify_all()
+        return True
+
+    def start(self):
+        """Starts the worker threads."""
+        with self._condition:
+            self._stopped = False
+        for _ in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stops the worker threads after their current deletions. Backups
+        still waiting stay in the queue.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def join(self, timeout=None):
+        """
+        Waits until the queue is empty.
+        :returns: True if the queue is empty, False if the timeout expired.
+        :rtype: bool
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._pending and not self._running, timeout)
+
+    def get_pending_count(self):
+        """
+        :returns: The number of backups that are waiting or being deleted.
+        :rtype: int
+        """
+        with self._condition:
+            return len(self._pending) + len(self._running)
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = None
+                while job is None:
+                    if self._stopped:
+                        return
+                    job = self._get_next_job()
+                    if job is None:
+                        self._condition.wait()
+                self._pending.remove(job)
+                self._running.append(job)
+            error = None
+            try:
+                self.delete_function(job.location)
+            # The worker thread has to survive whatever the deletion raises.
+            except Exception as exception:
+                error = exception
+            finally:
+                with self._condition:
+                    self._running.remove(job)
+                    self._condition.notify_all()
+            if job.callback is not None:
+                try:
+                    job.callback(job.location, error)
+                except Exception as exception:
+                    print("Callback for the deletion of {0} failed: "
+                          "{1}".format(job.location.path, exception))
+
+    def _get_next_job(self):
+        """
+        Returns the oldest waiting job whose device has a free slot, or None
+        if there is none. Must be called with the condition held.
+        """
+        for job in self._pending:
+            running = len([other for other in self._running
+                           if other.device_key == job.device_key])
+            if running < self.max_per_device:
+                return job
+        return None
+
+
+class _ExpiryJob(object):
+    """A single backup in the ExpiryQueue."""
+    def __init__(self, location, callback):
+        self.location = location
+        self.callback = callback
+        # A backup and the remains of its interrupted deletion are the same.
+        path = location.path.rstrip('/')
+        if deletion.is_deleting_path(path):
+            path = path[:-len(deletion.DELETING_SUFFIX)]
+        self.key = (location.host.key, path)
+        if location.device is not None:
+            self.device_key = (location.device.host.key,
+                               location.device.uuid)
+        else:
+            self.device_key = (location.host.key, None)
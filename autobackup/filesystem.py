@@ -19,10 +19,109 @@
 """Module to handle devices and mountpoints, even on remote machines."""
 
 import os
+import re
+import select
+import threading
+import time
 
 import process
 
 
+# The mount table of a host is read from this file instead of parsing the
+# output of "mount", as its format is stable and contains escaped paths.
+_MOUNTINFO_PATH = "/proc/self/mountinfo"
+
+# The kernel signals POLLPRI on this file whenever the mount table of the
+# localhost changes.
+_MOUNTS_PATH = "/proc/self/mounts"
+
+# in seconds
+# Mount tables are invalidated by all mount operations of this module, but
+# changes made by others on remote hosts can only be noticed by rereading the
+# table from time to time. On the localhost, changes are reported by the
+# kernel instead.
+_MOUNT_TABLE_MAX_AGE = 60
+
+# Spaces, tabs, newlines and backslashes in paths are escaped as octal
+# sequences like "\040" in /proc/self/mountinfo.
+_MOUNTINFO_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+# udev maintains a symlink for every filesystem UUID in this directory, so its
+# modification time changes whenever a block device appears or disappears.
+_DEVICE_BY_UUID_PATH = "/dev/disk/by-uuid"
+
+# in seconds
+# Device inventories of remote hosts (and of the localhost, if the udev
+# directory does not exist) are reread after this time.
+_DEVICE_INVENTORY_MAX_AGE = 60
+
+# Matches the KEY="value" pairs of "lsblk --pairs".
+_LSBLK_PAIR = re.compile(r'(\w+)="([^"]*)"')
+
+# Mount tables and device inventories are shared by all devices and
+# mountpoints of a host.
+# host key -> MountTable
+_mount_tables = {}
+# host key -> DeviceInventory
+_device_inventories = {}
+_host_objects_lock = threading.Lock()
+
+
+def get_mount_table(host, user):
+    """
+    Returns the shared mount table of a host. It will be created if it does
+    not exist yet.
+    :param host: The host of the mount table.
+    :type host: Host instance
+    :param user: The user who shall own the processes spawned to read the
+    mount table if it does not exist yet.
+    :type user: string
+    :returns: The mount table of the host.
+    :rtype: MountTable instance
+    """
+    return _get_host_object(_mount_tables, MountTable, host, user)
+
+
+def get_device_inventory(host, user):
+    """
+    Returns the shared block device inventory of a host. It will be created if
+    it does not exist yet.
+    :param host: The host of the device inventory.
+    :type host: Host instance
+    :param user: The user who shall own the processes spawned to read the
+    inventory if it does not exist yet.
+    :type user: string
+    :returns: The device inventory of the host.
+    :rtype: DeviceInventory instance
+    """
+    return _get_host_object(_device_inventories, DeviceInventory, host, user)
+
+
+def _get_host_object(objects, cls, host, user):
+    """
+    Returns the object in objects that belongs to host, after creating it with
+    cls(host, user) if there is none.
+    """
+    with _host_objects_lock:
+        obj = objects.get(host.key)
+        if obj is None:
+            obj = cls(host, user)
+            objects[host.key] = obj
+        return obj
+
+
+def invalidate_mount_table(host):
+    """
+    Invalidates the mount table of a host, so it will be reread the next time
+    it is used. Has to be called whenever the mount table of the host changes.
+    :param host: The host whose mount table has changed.
+    :type host: Host instance
+    """
+    table = _mount_tables.get(host.key)
+    if table is not None:
+        table.invalidate()
+
+
 class Device(object):
     """
     Represents a hardware storage device on a specific host, identified by its
@@ -56,20 +155,13 @@ class Device(object):
         :rtype: bool
         :raises: ProcessError if a process spwaned by this method fails.
         """
-        args = ["mount"]
+        table = get_mount_table(self.host, self.user)
         try:
-            stdoutdata = process.execute_success(self.host, args, self.user)
-            name = os.path.basename(self.get_device_file_path())
+            paths = self.get_device_file_paths()
         except process.ProcessError:
             raise
-        for line in str(stdoutdata).splitlines():
-            if not line:
-                # The last line of the output is empty.
-                continue
-            # The output of mount has the following layout:
-            # <device> on <mountpoint> type <fstype> (<options>)
-            # We want to extract the device.
-            if line.split(' ')[0] == name:
+        for path in paths:
+            if table.get_entries_by_source(path):
                 return True
         return False
 
@@ -81,15 +173,12 @@ class Device(object):
         :rtype: bool
         :raises: ProcessError if a process spawned by this method fails.
         """
+        inventory = get_device_inventory(self.host, self.user)
         try:
-            exists = process.func_file_exists(
-                self.host,
-                self.user,
-                self.get_device_file_path(),
-                process.FileTypes.BLOCK_SPECIAL)
+            info = inventory.get_device(self.uuid)
         except process.ProcessError:
             raise
-        return exists
+        return info is not None
 
     def get_device_file_paths(self):
         """
@@ -100,6 +189,16 @@ class Device(object):
         """
         paths = []
         paths.append(self.get_device_file_path())
+        inventory = get_device_inventory(self.host, self.user)
+        try:
+            info = inventory.get_device(self.uuid)
+        except process.ProcessError:
+            raise
+        if info is not None:
+            paths.append(info.device_file)
+            return paths
+        # The device is unknown to the inventory, so resolving the link will
+        # most likely fail, but we leave reporting that to readlink.
         args = ["readlink", "--no-newline", paths[0]]
         try:
             stdoutdata = process.execute_success(self.host,
@@ -121,6 +220,28 @@ class Device(object):
         """
         return os.path.join("/dev/disk/by-uuid", self.uuid)
 
+    def get_direct_mountpoint(self, mountpoint):
+        """
+        Returns a mountpoint on the host of the device that corresponds to a
+        mountpoint on another host. Mounting there instead of mounting between
+        hosts with sshfs keeps the data on the host of the device, where it
+        can be accessed directly, for example by rsync over ssh.
+        :param mountpoint: The mountpoint the device would be mounted at.
+        :type mountpoint: Mountpoint instance
+        :returns: A mountpoint with the same path and options on the host of
+        the device, or mountpoint itself if it is on the host of the device
+        already.
+        :rtype: Mountpoint instance
+        """
+        if mountpoint.host == self.host:
+            return mountpoint
+        return Mountpoint(host=self.host,
+                          path=mountpoint.path,
+                          options=mountpoint.options,
+                          create_if_not_existent=True,
+                          user=self.user,
+                          backup_options=mountpoint.backup_options)
+
     def mount(self, mountpoint):
         """
         Mounts the device on a mountpoint. If the mountpoint is active or does
@@ -184,11 +305,18 @@ class Device(object):
         # host, but to mount a directory, smiliar to mount's bind option. So
         # we first have to mount the device on the same host, and then use
         # sshfs to mount that directory on the target host.
+        #
+        # In cases 2 and 3 all data passes through FUSE and SFTP, which is
+        # slow. Whenever possible, mount at get_direct_mountpoint() instead
+        # and access the data on the host of the device directly.
 
         # The paths to the temporary mountpoints created in cases 2 and 3
         # Whenever we have to use them, we will mount the device there, so
-        # we can use the self.user's home directory for example.
-        local_temp_mountpoint_path = "/home/{}/mnt/tmp/".format(self.user)
+        # we can use the self.user's home directory for example. Every device
+        # gets its own, as several devices of the same host may be mounted
+        # at the same time.
+        local_temp_mountpoint_path = "/home/{0}/mnt/tmp/{1}/".format(
+            self.user, self.uuid)
         remote_temp_mountpoint_path = local_temp_mountpoint_path
 
         if (self.host == mountpoint.host):
@@ -200,12 +328,16 @@ class Device(object):
                     "-t", self.filesystem,
                     "-U", self.uuid,
                     mountpoint.path]
+            try:
+                _execute_mount_command(mountpoint.host, args, self.user)
+            except process.ProcessError:
+                raise
         elif not self.host.is_localhost() and mountpoint.host.is_localhost():
             # case 2
             remote_temp_mountpoint = Mountpoint(
                 host=self.host,
                 path=remote_temp_mountpoint_path,
-                options=",".join(mountpoint.options).lstrip(','),
+                options=mountpoint.options,
                 create_if_not_existent=True,
                 user=self.user)
             self._temp_mountpoint = remote_temp_mountpoint
@@ -214,7 +346,7 @@ class Device(object):
             if not remote_temp_mountpoint.is_empty():
                 raise MountError("The temporary mountpoint is not empty.")
 
-            self.mount(mountpoint)
+            self.mount(mountpoint=remote_temp_mountpoint)
             args = ["sshfs",
                     "{0}@{1}:{2}".format(
                         remote_temp_mountpoint.user,
@@ -223,7 +355,7 @@ class Device(object):
                     mountpoint.path,
                     "-o", "idmap=user"]
             try:
-                process.execute_success(
+                _execute_mount_command(
                     mountpoint.host,
                     args,
                     mountpoint.user)
@@ -234,7 +366,7 @@ class Device(object):
             local_temp_mountpoint = Mountpoint(
                 host=self.host,
                 path=local_temp_mountpoint_path,
-                options=",".join(mountpoint.options).lstrip(','),
+                options=mountpoint.options,
                 create_if_not_existent=True,
                 user=mountpoint.user)
             self._temp_mountpoint = local_temp_mountpoint
@@ -245,14 +377,14 @@ class Device(object):
 
             self.mount(mountpoint=local_temp_mountpoint)
             args = ["sshfs",
-                    mountpoint.path,
                     "{0}@{1}:{2}".format(
                         local_temp_mountpoint.user,
                         local_temp_mountpoint.host.get_real_ip(),
                         local_temp_mountpoint.path),
+                    mountpoint.path,
                     "-o", "idmap=user"]
             try:
-                process.execute_success(
+                _execute_mount_command(
                     mountpoint.host,
                     args,
                     mountpoint.user)
@@ -286,9 +418,9 @@ class Device(object):
         if self._temp_mountpoint:
             args = ["fusermount", "-u", self._mountpoint.path]
             try:
-                process.execute_success(host=self._mountpoint.host,
-                                        args=args,
-                                        user=self._mountpoint.user)
+                _execute_mount_command(host=self._mountpoint.host,
+                                       args=args,
+                                       user=self._mountpoint.user)
             except process.ProcessError:
                 raise
 
@@ -298,7 +430,7 @@ class Device(object):
 
         args = ["umount", unmount_mountpoint.path]
         try:
-            process.execute_success(
+            _execute_mount_command(
                 host=unmount_mountpoint.host,
                 args=args,
                 user=unmount_mountpoint.user)
@@ -320,13 +452,15 @@ class Mountpoint(object):
     Represents a mountpoint on a specific host and provices methods to mount
     and unmount devices on this mountpoint, among others.
     """
-    def __init__(self, host, path, options, create_if_not_existent, user):
+    def __init__(self, host, path, options, create_if_not_existent, user,
+                 backup_options=None):
         """
         :param host: The host of the mountpoint.
         :type host: Host instance
         :param path: The absolute path on the specified host.
         :type path: string
-        :param options: A tuple containing all mount options.
+        :param options: A tuple containing all mount options. These are the
+        "safe" options used whenever no backup is running.
         :type options: tuple
         :param create_if_not_existent: A boolean that specifies whether the
         mountpoint is to be created automatically if it does not exist and you
@@ -337,12 +471,18 @@ class Mountpoint(object):
         :type create_if_not_existent: bool
         :param user: The user who is own all processes spawned by this class.
         :type user: string
+        :param backup_options: A tuple containing the mount options the
+        mountpoint is remounted with while backups are written to it, e.g.
+        options that reduce metadata writes like "noatime". If None, the
+        mountpoint is never remounted for backups.
+        :type backup_options: tuple
         """
         self.host = host
         self.path = path
         self.options = options
         self.create_if_not_existent = create_if_not_existent
         self.user = user
+        self.backup_options = backup_options
 
     def create(self, create_parents):
         """
@@ -409,9 +549,7 @@ class Mountpoint(object):
                 (','.join(new_options) + ",remount").lstrip(','),
                 self.path]
         try:
-            process.execute_success(self.host,
-                                    args,
-                                    self.user)
+            _execute_mount_command(self.host, args, self.user)
         except process.ProcessError as error:
             if error.exit_code != 0:
                 raise MountError("Remounting failed: " + error.stderrdata)
@@ -463,7 +601,7 @@ class Mountpoint(object):
                 self.path, target_mountpoint.path]
 
         try:
-            process.execute_success(self.host, args, self.user)
+            _execute_mount_command(self.host, args, self.user)
         except process.ProcessError:
             raise
 
@@ -506,31 +644,491 @@ class Mountpoint(object):
         :rtype: bool
         :raises: ProcessError if the any process spawned by this method fails.
         """
-        # Some caching could be implemented.
-        args = ["mount"]
+        table = get_mount_table(self.host, self.user)
+        return table.get_entry_by_mountpoint(self.path) is not None
+
+
+class MountTable(object):
+    """
+    A snapshot of the mount table of a host, indexed by the source and the
+    mountpoint of all mounts. The snapshot is read lazily when it is used for
+    the first time and reread after it has been invalidated. The snapshot of
+    the localhost is reread when the kernel reports a change of the mount
+    table, all others when they are older than _MOUNT_TABLE_MAX_AGE.
+    """
+    def __init__(self, host, user):
+        """
+        :param host: The host of the mount table.
+        :type host: Host instance
+        :param user: The user who shall own all processes spawned to read the
+        mount table.
+        :type user: string
+        """
+        self.host = host
+        self.user = user
+
+        self._entries = None
+        self._by_source = {}
+        self._by_mountpoint = {}
+        self._read_time = None
+        # The table is shared by all threads, one of them may invalidate it
+        # while another one reads it.
+        self._lock = threading.Lock()
+
+        if self.host.is_localhost():
+            self._watcher = _create_mount_table_watcher()
+        else:
+            self._watcher = None
+
+    def invalidate(self):
+        """Invalidates the snapshot, so it will be reread on the next use."""
+        with self._lock:
+            self._entries = None
+
+    def is_valid(self):
+        """
+        Determines whether the snapshot can still be used without rereading
+        it.
+        :returns: True if the snapshot is valid, False otherwise.
+        :rtype: bool
+        """
+        with self._lock:
+            return self._is_valid()
+
+    def refresh(self):
+        """
+        Rereads the mount table and rebuilds the indices.
+        :raises: ProcessError if a process spawned by this method fails.
+        """
+        with self._lock:
+            self._refresh()
+
+    def close(self):
+        """
+        Stops watching the mount table of the localhost. The table can still
+        be used afterwards, but expires after _MOUNT_TABLE_MAX_AGE like the
+        tables of all other hosts.
+        """
+        with self._lock:
+            if self._watcher is not None:
+                self._watcher.close()
+                self._watcher = None
+                self._entries = None
+
+    def get_entries(self):
+        """
+        Returns all entries of the mount table in the order they were mounted.
+        :returns: All entries of the mount table.
+        :rtype: list of MountEntry instances
+        :raises: ProcessError if the mount table has to be reread and a
+        process spawned by this method fails.
+        """
+        (entries, _, _) = self._get_snapshot()
+        return list(entries)
+
+    def get_entries_by_source(self, source):
+        """
+        Returns all entries of the mount table that mount a specific source,
+        e.g. a device file. A source can be mounted at several mountpoints.
+        :param source: The source as shown in the mount table.
+        :type source: string
+        :returns: All entries mounting the source.
+        :rtype: list of MountEntry instances
+        :raises: ProcessError if the mount table has to be reread and a
+        process spawned by this method fails.
+        """
+        (_, by_source, _) = self._get_snapshot()
+        return list(by_source.get(source, ()))
+
+    def get_entry_by_mountpoint(self, path):
+        """
+        Returns the entry of the mount table that is visible at a specific
+        mountpoint. If several mounts are stacked on the same path, the
+        topmost one is returned.
+        :param path: The absolute path of the mountpoint. A trailing slash is
+        ignored.
+        :type path: string
+        :returns: The visible entry at the mountpoint or None if nothing is
+        mounted there.
+        :rtype: MountEntry instance
+        :raises: ProcessError if the mount table has to be reread and a
+        process spawned by this method fails.
+        """
+        (_, _, by_mountpoint) = self._get_snapshot()
+        return by_mountpoint.get(_normalize_mountpoint_path(path))
+
+    def _get_snapshot(self):
+        """
+        Returns the entries and both indices of a valid snapshot, rereading
+        it if necessary. They are taken together under the lock, so they
+        belong to the same snapshot even if it is invalidated right after.
+        :rtype: tuple
+        """
+        with self._lock:
+            if not self._is_valid():
+                self._refresh()
+            return (self._entries, self._by_source, self._by_mountpoint)
+
+    def _is_valid(self):
+        if self._entries is None:
+            return False
+        if self._watcher is not None:
+            if self._watcher.has_changed():
+                self._entries = None
+                return False
+            return True
+        return time.time() - self._read_time < _MOUNT_TABLE_MAX_AGE
+
+    def _refresh(self):
+        if self._watcher is not None:
+            # Polling rearms the notification. It has to happen before
+            # reading, otherwise a change between reading and polling would
+            # be lost.
+            self._watcher.has_changed()
+            with open(_MOUNTINFO_PATH) as mountinfo:
+                data = mountinfo.read()
+        else:
+            try:
+                data = process.func_read_file(self.host, self.user,
+                                              _MOUNTINFO_PATH)
+            except process.ProcessError:
+                raise
+        self._set_entries(_parse_mountinfo(data))
+
+    def _set_entries(self, entries):
+        by_source = {}
+        by_mountpoint = {}
+        for entry in entries:
+            by_source.setdefault(entry.source, []).append(entry)
+            # Later entries are mounted on top of earlier ones, so they
+            # replace them.
+            by_mountpoint[entry.mountpoint] = entry
+        self._by_source = by_source
+        self._by_mountpoint = by_mountpoint
+        self._entries = entries
+        self._read_time = time.time()
+
+
+class DeviceInventory(object):
+    """
+    An inventory of all block devices of a host that carry a filesystem UUID,
+    indexed by that UUID. All devices are enumerated with a single lsblk
+    process. The inventory of the localhost is reread when udev changes
+    /dev/disk/by-uuid, all others when they are older than
+    _DEVICE_INVENTORY_MAX_AGE.
+    """
+    def __init__(self, host, user):
+        """
+        :param host: The host of the inventory.
+        :type host: Host instance
+        :param user: The user who shall own all processes spawned to read the
+        inventory.
+        :type user: string
+        """
+        self.host = host
+        self.user = user
+
+        self._by_uuid = None
+        self._read_time = None
+        self._udev_mtime = None
+        # The inventory is shared by all threads, one of them may invalidate
+        # it while another one reads it.
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Invalidates the inventory, so it will be reread on the next use."""
+        with self._lock:
+            self._by_uuid = None
+
+    def is_valid(self):
+        """
+        Determines whether the inventory can still be used without rereading
+        it.
+        :returns: True if the inventory is valid, False otherwise.
+        :rtype: bool
+        """
+        with self._lock:
+            return self._is_valid()
+
+    def refresh(self):
+        """
+        Rereads the inventory.
+        :raises: ProcessError if a process spawned by this method fails.
+        """
+        with self._lock:
+            self._refresh()
+
+    def get_device(self, uuid):
+        """
+        Returns information about the device with a specific UUID.
+        :param uuid: The UUID of the device.
+        :type uuid: string
+        :returns: Information about the device or None if there is no
+        device with that UUID.
+        :rtype: DeviceInfo instance
+        :raises: ProcessError if the inventory has to be reread and a process
+        spawned by this method fails.
+        """
+        return self._get_snapshot().get(uuid)
+
+    def get_devices(self):
+        """
+        Returns information about all devices of the inventory.
+        :returns: Information about all devices.
+        :rtype: list of DeviceInfo instances
+        :raises: ProcessError if the inventory has to be reread and a process
+        spawned by this method fails.
+        """
+        return list(self._get_snapshot().values())
+
+    def _get_snapshot(self):
+        """
+        Returns the index of a valid inventory, rereading it if necessary.
+        The index is replaced, never changed, so it can be used after the
+        lock has been released.
+        :rtype: dict
+        """
+        with self._lock:
+            if not self._is_valid():
+                self._refresh()
+            return self._by_uuid
+
+    def _is_valid(self):
+        if self._by_uuid is None:
+            return False
+        if self._udev_mtime is not None:
+            return _get_udev_mtime() == self._udev_mtime
+        return time.time() - self._read_time < _DEVICE_INVENTORY_MAX_AGE
+
+    def _refresh(self):
+        if self.host.is_localhost():
+            # Taken before reading, so a change during reading will trigger
+            # another refresh.
+            udev_mtime = _get_udev_mtime()
+        else:
+            udev_mtime = None
+        args = ["lsblk", "--pairs", "--bytes", "--paths",
+                "--output", "UUID,NAME,SIZE,FSTYPE"]
         try:
-            (stdouterr, _) = process.execute_success(self.host,
-                                                     args,
-                                                     self.user)
+            stdoutdata = process.execute_success(self.host, args, self.user)
         except process.ProcessError:
             raise
-        for line in str(stdouterr).splitlines():
-            if not line:
-                # The last line of the output is empty.
-                continue
-            # The output of mount has the following layout:
-            # <device> on <mountpoint> type <fstype> (<options>)
-            # We want to extract the mountpoint.
-            # attention: the path of the mountpoint might contain a trailing
-            # slash, but the output of "mount" never does, so we have to
-            # remove the potential slash
-            if line.split()[2] == self.path.rstrip('/'):
-                return True
-        return False
+        by_uuid = {}
+        for info in _parse_lsblk(stdoutdata):
+            by_uuid[info.uuid] = info
+        self._by_uuid = by_uuid
+        self._read_time = time.time()
+        self._udev_mtime = udev_mtime
+
+
+class DeviceInfo(object):
+    """A block device as listed by lsblk."""
+    def __init__(self, uuid, device_file, size, filesystem):
+        """
+        :param uuid: The UUID of the filesystem on the device.
+        :type uuid: string
+        :param device_file: The absolute path of the device file.
+        :type device_file: string
+        :param size: The size of the device in bytes.
+        :type size: int
+        :param filesystem: The type of the filesystem on the device.
+        :type filesystem: string
+        """
+        self.uuid = uuid
+        self.device_file = device_file
+        self.size = size
+        self.filesystem = filesystem
+
+
+def _parse_lsblk(data):
+    """
+    Parses the output of "lsblk --pairs --bytes --paths --output
+    UUID,NAME,SIZE,FSTYPE". Devices without a filesystem UUID are skipped.
+    :param data: The output of lsblk.
+    :type data: string
+    :returns: All devices with a UUID.
+    :rtype: list of DeviceInfo instances
+    """
+    devices = []
+    for line in str(data).splitlines():
+        fields = dict(_LSBLK_PAIR.findall(line))
+        if not fields.get("UUID"):
+            continue
+        devices.append(DeviceInfo(uuid=fields["UUID"],
+                                  device_file=fields["NAME"],
+                                  size=int(fields["SIZE"] or 0),
+                                  filesystem=fields["FSTYPE"]))
+    return devices
+
+
+def _get_udev_mtime():
+    """
+    Returns the modification time of /dev/disk/by-uuid, or None if it does not
+    exist.
+    """
+    try:
+        return os.stat(_DEVICE_BY_UUID_PATH).st_mtime
+    except OSError:
+        return None
+
+
+class _MountTableWatcher(object):
+    """
+    Watches the mount table of the localhost. The kernel signals POLLPRI and
+    POLLERR on an open /proc/self/mounts when the mount table has changed
+    since the last poll, so checking for changes costs a single poll() and no
+    process has to be spawned.
+    """
+    def __init__(self):
+        """
+        :raises: IOError if /proc/self/mounts cannot be opened.
+        """
+        self._file = None
+        self._file = open(_MOUNTS_PATH)
+        self._poll = select.poll()
+        self._poll.register(self._file.fileno(),
+                            select.POLLPRI | select.POLLERR)
+
+    def has_changed(self):
+        """
+        Determines whether the mount table has changed since the last call.
+        :returns: True if the mount table has changed, False otherwise.
+        :rtype: bool
+        """
+        return len(self._poll.poll(0)) != 0
+
+    def close(self):
+        """Closes /proc/self/mounts. Closing twice has no effect."""
+        if self._file is not None and not self._file.closed:
+            self._poll.unregister(self._file.fileno())
+            self._file.close()
+
+    def __del__(self):
+        # Shared mount tables live as long as the process, their watchers
+        # are only dropped at exit.
+        self.close()
+
+
+def _create_mount_table_watcher():
+    """
+    Returns a watcher for the mount table of the localhost, or None if the
+    platform does not support it. Mount tables without a watcher fall back to
+    _MOUNT_TABLE_MAX_AGE.
+    """
+    if not hasattr(select, "poll"):
+        return None
+    try:
+        return _MountTableWatcher()
+    except IOError:
+        return None
+
+
+class MountEntry(object):
+    """A single line of /proc/self/mountinfo."""
+    def __init__(self, mount_id, parent_id, device_number, root, mountpoint,
+                 options, fstype, source, super_options):
+        """
+        :param mount_id: The unique id of the mount.
+        :type mount_id: int
+        :param parent_id: The id of the parent mount.
+        :type parent_id: int
+        :param device_number: The "major:minor" device number of the
+        filesystem.
+        :type device_number: string
+        :param root: The directory of the filesystem that is the root of the
+        mount.
+        :type root: string
+        :param mountpoint: The absolute path of the mountpoint.
+        :type mountpoint: string
+        :param options: The per-mount options.
+        :type options: tuple
+        :param fstype: The type of the filesystem.
+        :type fstype: string
+        :param source: The source of the mount, e.g. a device file.
+        :type source: string
+        :param super_options: The per-filesystem options.
+        :type super_options: tuple
+        """
+        self.mount_id = mount_id
+        self.parent_id = parent_id
+        self.device_number = device_number
+        self.root = root
+        self.mountpoint = mountpoint
+        self.options = options
+        self.fstype = fstype
+        self.source = source
+        self.super_options = super_options
+
+
+def _parse_mountinfo(data):
+    """
+    Parses the content of /proc/self/mountinfo.
+    :param data: The content of the file.
+    :type data: string
+    :returns: All entries in the order of the file.
+    :rtype: list of MountEntry instances
+    :raises: ValueError if a line is malformed.
+    """
+    entries = []
+    for line in str(data).splitlines():
+        if not line:
+            continue
+        # The layout of a line is:
+        # <id> <parent id> <major:minor> <root> <mountpoint> <options>
+        # [<optional field> ...] - <fstype> <source> <super options>
+        # The number of optional fields varies, so everything after the
+        # separator has to be located from the separator.
+        fields = line.split(' ')
+        try:
+            separator = fields.index('-', 6)
+        except ValueError:
+            raise ValueError("Malformed mountinfo line: " + line)
+        if len(fields) < separator + 4:
+            raise ValueError("Malformed mountinfo line: " + line)
+        entries.append(MountEntry(
+            mount_id=int(fields[0]),
+            parent_id=int(fields[1]),
+            device_number=fields[2],
+            root=_unescape_mountinfo(fields[3]),
+            mountpoint=_unescape_mountinfo(fields[4]),
+            options=tuple(fields[5].split(',')),
+            fstype=fields[separator + 1],
+            source=_unescape_mountinfo(fields[separator + 2]),
+            super_options=tuple(fields[separator + 3].split(','))))
+    return entries
+
+
+def _unescape_mountinfo(field):
+    """Replaces the octal escape sequences of a mountinfo field."""
+    return _MOUNTINFO_ESCAPE.sub(lambda match: chr(int(match.group(1), 8)),
+                                 field)
+
+
+def _normalize_mountpoint_path(path):
+    """
+    Removes trailing slashes from a path, as the mount table never contains
+    them. The root directory is kept as it is.
+    """
+    return path.rstrip('/') or '/'
+
+
+def _execute_mount_command(host, args, user):
+    """
+    Executes a command that changes the mount table of a host and invalidates
+    the cached mount table of that host. The table is invalidated even if the
+    command fails, as it may have changed the mount table nevertheless.
+    :returns: The output of the command to stdout.
+    :rtype: string
+    :raises: ProcessError if the command fails.
+    """
+    try:
+        return process.execute_success(host, args, user)
+    finally:
+        invalidate_mount_table(host)
 
 
 class MountError(Exception):
     """An exception that is raised when a mounting operation fails."""
     def __init__(self, message):
-        Exception.__init__()
+        Exception.__init__(self, message)
         self.message = message
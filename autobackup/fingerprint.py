@@ -0,0 +1,111 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of autobackup.
+#
+# autobackup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autobackup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to tell whether a source changed since the last backup without
+running rsync. The fingerprint of a tree is a digest of the metadata of
+everything in it, which only takes a walk of the tree on the source host,
+while rsync also builds and sends its file list and walks the destination.
+
+The change time of a file is updated by every write, chmod, chown, link or
+rename and cannot be set by hand, unlike the modification time. A file
+that was deleted or added changes its directory. So a tree whose
+fingerprint did not change holds the same files as before.
+
+This module must only use the standard library, as it is sent to remote
+hosts and run there, see process.func_get_fingerprint().
+"""
+
+import hashlib
+import os
+import sys
+import time
+
+
+def get_fingerprint(path, time_limit=None):
+    """
+    Returns the fingerprint of a directory tree or a single file. Symbolic
+    links are not followed.
+    :param path: The path of the tree.
+    :type path: string
+    :param time_limit: The number of seconds after which the walk is given
+    up, None for no limit.
+    :type time_limit: float
+    :returns: The fingerprint as a hex string, None if the time limit was
+    exceeded.
+    :rtype: string
+    :raises: OSError if the tree cannot be walked.
+    """
+    start = time.time()
+    digest = hashlib.sha1()
+    _add_entry(digest, "", os.lstat(path))
+    stack = [""]
+    if not os.path.isdir(path) or os.path.islink(path):
+        stack = []
+    while stack:
+        if time_limit is not None and time.time() - start > time_limit:
+            return None
+        directory = stack.pop()
+        with os.scandir(os.path.join(path, directory)) as entries:
+            # The order of scandir() is up to the filesystem.
+            entries = sorted(entries, key=lambda entry: entry.name)
+        for entry in entries:
+            relative_path = os.path.join(directory, entry.name)
+            _add_entry(digest, relative_path,
+                       entry.stat(follow_symlinks=False))
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(relative_path)
+    return digest.hexdigest()
+
+
+def combine(fingerprints):
+    """
+    Returns a single fingerprint for several sources.
+    :param fingerprints: The sources and their fingerprints.
+    :type fingerprints: list of (string, string) tuples
+    :returns: The fingerprint, None if any of the fingerprints is None.
+    :rtype: string
+    """
+    digest = hashlib.sha1()
+    for (source, fingerprint) in fingerprints:
+        if fingerprint is None:
+            return None
+        digest.update("{0}\0{1}\n".format(source, fingerprint).encode(
+            "utf-8", "surrogateescape"))
+    return digest.hexdigest()
+
+
+def _add_entry(digest, relative_path, stat):
+    digest.update(os.fsencode(relative_path))
+    digest.update("\0{0} {1} {2} {3} {4} {5} {6}\n".format(
+        stat.st_mode, stat.st_ino, stat.st_size, stat.st_mtime_ns,
+        stat.st_ctime_ns, stat.st_uid, stat.st_gid).encode("ascii"))
+
+
+def main():
+    """
+    Entry point when run on a remote host, see process.func_get_fingerprint().
+    Arguments: path, time limit in seconds. Prints the fingerprint, or
+    nothing if the time limit was exceeded.
+    """
+    (path, time_limit) = sys.argv[1:3]
+    print(get_fingerprint(path, float(time_limit)) or "")
+
+
+if __name__ == '__main__':
+    main()
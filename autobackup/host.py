@@ -64,6 +64,14 @@ class Host(object):
         return self._ip
     ip = property(_get_ip)
 
+    # A hashable key for the host, e.g. for dictionaries of hosts. All ips
+    # of the localhost map to the same key, just like they compare equal.
+    def _get_key(self):
+        if self.is_localhost():
+            return "127.0.0.1"
+        return self.ip
+    key = property(_get_key)
+
     # Needs to be overloaded, as a simple comparison of the ips is not
     # sufficient. All ips in 127.*.*.* refer to the localhost, so for instance
     # 127.0.0.1 and 27.42.13.37 are the same machine.
@@ -0,0 +1,297 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of autobackup.
+#
+# autobackup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autobackup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to run the backups of several repositories at the same time. Every
+job is run by one of a few worker threads, so a slow backup over a WAN does
+not hold up a fast local one. Jobs reading from the same host or writing to
+the same device compete for the same network link or disk, so only a limited
+number of them runs at once per host and per device.
+
+Threads cannot be stopped from the outside, so cancelling a running job only
+sets its cancelled event. The job has to check it, see get_current_job() and
+process.execute().
+"""
+
+import threading
+
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_PER_HOST = 2
+DEFAULT_MAX_PER_DEVICE = 1
+
+# The states of a job.
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_FINISHED = "finished"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+JOB_TIMED_OUT = "timed out"
+
+# The job run by the current thread, see get_current_job().
+_current = threading.local()
+
+
+def get_current_job():
+    """
+    :returns: The job run by the calling thread, None if it is not a worker
+    thread of a JobExecutor.
+    :rtype: Job instance
+    """
+    return getattr(_current, "job", None)
+
+
+class JobExecutor(object):
+    """
+    Runs jobs with a number of worker threads, oldest first. Jobs with the
+    same key never run at the same time.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS,
+                 max_per_host=DEFAULT_MAX_PER_HOST,
+                 max_per_device=DEFAULT_MAX_PER_DEVICE):
+        """
+        :param workers: The number of jobs run at the same time.
+        :type workers: int
+        :param max_per_host: The number of jobs run at the same time that
+        involve a single host.
+        :type max_per_host: int
+        :param max_per_device: The number of jobs run at the same time that
+        involve a single device.
+        :type max_per_device: int
+        """
+        self.workers = workers
+        self.max_per_host = max_per_host
+        self.max_per_device = max_per_device
+        self._pending = []
+        self._running = []
+        self._condition = threading.Condition()
+        self._threads = []
+        self._stopped = False
+
+    def submit(self, function, key=None, hosts=(), devices=(), timeout=None,
+               callback=None):
+        """
+        Adds a job and returns immediately. A job whose key is already
+        waiting is not added again.
+        :param function: Called without arguments by a worker thread.
+        :type function: callable
+        :param key: Jobs with the same key run one after another, e.g. the
+        name of a repository. None for no key.
+        :type key: string
+        :param hosts: The hosts the job involves, counted for max_per_host.
+        :type hosts: list of Host instances
+        :param devices: The devices the job involves, counted for
+        max_per_device.
+        :type devices: list of Device instances
+        :param timeout: The number of seconds after which a running job is
+        cancelled, None for no limit.
+        :type timeout: float
+        :param callback: Called with the job when it is done, either from a
+        worker thread or from the thread cancelling a waiting job.
+        :type callback: callable
+        :returns: The new job, None if a job with the same key is waiting.
+        :rtype: Job instance
+        """
+        job = Job(self, function, key, hosts, devices, timeout, callback)
+        with self._condition:
+            if key is not None:
+                for other in self._pending:
+                    if other.key == key:
+                        return None
+            self._pending.append(job)
+            self._condition.notify_all()
+        return job
+
+    def start(self):
+        """Starts the worker threads."""
+        with self._condition:
+            self._stopped = False
+        for _ in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, cancel=False):
+        """
+        Stops the worker threads after their current jobs. Jobs still
+        waiting stay in the executor.
+        :param cancel: Determines whether to cancel the running jobs.
+        :type cancel: bool
+        """
+        with self._condition:
+            self._stopped = True
+            running = list(self._running)
+            self._condition.notify_all()
+        if cancel:
+            for job in running:
+                job.cancel()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def join(self, timeout=None):
+        """
+        Waits until all jobs are done.
+        :returns: True if all jobs are done, False if the timeout expired.
+        :rtype: bool
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._pending and not self._running, timeout)
+
+    def get_pending_count(self):
+        """
+        :returns: The number of jobs that are waiting or running.
+        :rtype: int
+        """
+        with self._condition:
+            return len(self._pending) + len(self._running)
+
+    def _cancel_pending(self, job):
+        """
+        Removes a waiting job.
+        :returns: True if the job was waiting, False if it already started.
+        :rtype: bool
+        """
+        with self._condition:
+            if job not in self._pending:
+                return False
+            self._pending.remove(job)
+            job.state = JOB_CANCELLED
+            self._condition.notify_all()
+        return True
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = None
+                while job is None:
+                    if self._stopped:
+                        return
+                    job = self._get_next_job()
+                    if job is None:
+                        self._condition.wait()
+                self._pending.remove(job)
+                self._running.append(job)
+                job.state = JOB_RUNNING
+            _current.job = job
+            try:
+                job.run()
+                # The job only counts as done after its callback, so join()
+                # waits for it.
+                if job.callback is not None:
+                    job.callback(job)
+            finally:
+                _current.job = None
+                with self._condition:
+                    self._running.remove(job)
+                    self._condition.notify_all()
+
+    def _get_next_job(self):
+        """
+        Returns the oldest waiting job whose key is not running and whose
+        hosts and devices have a free slot, or None if there is none. Must be
+        called with the condition held.
+        """
+        # A job must not overtake an older job with the same key.
+        keys = set(job.key for job in self._running)
+        for job in self._pending:
+            if job.key is not None and job.key in keys:
+                continue
+            keys.add(job.key)
+            if (self._has_free_slot(job.host_keys, "host_keys",
+                                    self.max_per_host) and
+                    self._has_free_slot(job.device_keys, "device_keys",
+                                        self.max_per_device)):
+                return job
+        return None
+
+    def _has_free_slot(self, keys, attribute, maximum):
+        for key in keys:
+            running = len([other for other in self._running
+                           if key in getattr(other, attribute)])
+            if running >= maximum:
+                return False
+        return True
+
+
+class Job(object):
+    """A single job of a JobExecutor."""
+    def __init__(self, executor, function, key, hosts, devices, timeout,
+                 callback):
+        self.function = function
+        self.key = key
+        self.timeout = timeout
+        self.callback = callback
+        # One of the JOB_* constants.
+        self.state = JOB_PENDING
+        # The return value of the function, or the exception it raised.
+        self.result = None
+        self.error = None
+        # Set when the job is cancelled or timed out.
+        self.cancelled = threading.Event()
+        self.host_keys = set(host.key for host in hosts)
+        self.device_keys = set((device.host.key, device.uuid)
+                               for device in devices)
+        self._executor = executor
+        self._timed_out = False
+
+    def cancel(self):
+        """
+        Cancels the job. A waiting job is removed, a running job is asked to
+        stop, see is_cancelled().
+        """
+        self.cancelled.set()
+        if (self._executor._cancel_pending(self) and
+                self.callback is not None):
+            self.callback(self)
+
+    def is_cancelled(self):
+        """
+        :returns: True if the job was cancelled or timed out.
+        :rtype: bool
+        """
+        return self.cancelled.is_set()
+
+    def run(self):
+        """Runs the function of the job. Called by a worker thread."""
+        timer = None
+        if self.timeout is not None:
+            timer = threading.Timer(self.timeout, self._time_out)
+            timer.daemon = True
+            timer.start()
+        try:
+            self.result = self.function()
+            state = JOB_FINISHED
+        # The worker thread has to survive whatever the job raises.
+        except Exception as exception:
+            self.error = exception
+            state = JOB_FAILED
+        finally:
+            if timer is not None:
+                timer.cancel()
+        if self._timed_out:
+            state = JOB_TIMED_OUT
+        elif self.is_cancelled():
+            state = JOB_CANCELLED
+        self.state = state
+
+    def _time_out(self):
+        self._timed_out = True
+        self.cancelled.set()
@@ -0,0 +1,309 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of autobackup.
+#
+# autobackup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autobackup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to share mounted devices between backups. A device is mounted when the
+first backup needs it, stays mounted as long as backups use it and is
+unmounted when no backup has used it for a configurable time. While backups
+use a device, its mountpoint is remounted with its backup options.
+"""
+
+import threading
+import time
+
+import filesystem
+import process
+
+# The mount options of destinations while no backup is written to them
+# (the safe profile) and while backups are written (the backup profile),
+# see get_profiles(). Creating a snapshot touches the metadata of every
+# file, so access time updates and frequent journal commits cost a lot of
+# writes. The safe profile is set explicitly, a remount without options
+# would keep those of the backup profile.
+_SAFE_OPTIONS = ("relatime", "nolazytime")
+_BACKUP_OPTIONS = ("noatime", "lazytime")
+# Only ext3 and ext4 understand the commit interval option, 5 seconds is
+# their default.
+_SAFE_OPTIONS_EXT = _SAFE_OPTIONS + ("commit=5",)
+_BACKUP_OPTIONS_EXT = _BACKUP_OPTIONS + ("commit=60",)
+
+
+def get_profiles(filesystem_type):
+    """
+    Returns the mount options of the safe and of the backup profile of a
+    destination.
+    :param filesystem_type: The filesystem of the destination, e.g. "ext4".
+    :type filesystem_type: string
+    :returns: A tuple containing the options of both profiles.
+    :rtype: tuple of tuples
+    """
+    if filesystem_type in ("ext3", "ext4"):
+        return (_SAFE_OPTIONS_EXT, _BACKUP_OPTIONS_EXT)
+    return (_SAFE_OPTIONS, _BACKUP_OPTIONS)
+
+
+class MountManager(object):
+    """
+    Keeps a reference count for every (device, mountpoint) pair. Devices are
+    only mounted when their count rises from zero and unmounted by
+    unmount_idle() when their count has been zero for idle_timeout seconds.
+    Devices that were already mounted when they were acquired for the first
+    time are never unmounted by the manager.
+
+    If a mountpoint has backup options, it is remounted with them when the
+    reference count of a device mounted by the manager rises from zero, and
+    with its normal options when it drops to zero again. All mounts,
+    unmounts and remounts are timed, see pop_timings().
+    """
+    def __init__(self, idle_timeout):
+        """
+        :param idle_timeout: The time in seconds a device stays mounted after
+        it has been released by the last backup. If 0, devices are unmounted
+        immediately on release.
+        :type idle_timeout: int
+        """
+        self.idle_timeout = idle_timeout
+
+        # key of the pair, see _get_reference_key() -> reference
+        self._references = {}
+        self._timings = []
+        self._lock = threading.Lock()
+        # Timings are recorded while self._lock may be held.
+        self._timings_lock = threading.Lock()
+
+    def acquire(self, device, mountpoint):
+        """
+        Makes sure that the device is mounted at the mountpoint and increases
+        its reference count. Every call has to be followed by a call to
+        release() when the device is not needed anymore.
+        :param device: The device to mount.
+        :type device: Device instance
+        :param mountpoint: The mountpoint to mount the device at.
+        :type mountpoint: Mountpoint instance
+        :raises: MountError if mounting the device or remounting it with the
+        backup options fails.
+        :raises: ProcessError if any process spawned by this method fails.
+        """
+        with self._lock:
+            key = _get_reference_key(device, mountpoint)
+            reference = self._references.get(key)
+            if reference is None:
+                reference = _MountReference(device, mountpoint)
+                self._references[key] = reference
+            reference.count += 1
+            reference.release_time = None
+
+        # Mounting may take a while, so only this reference is locked. Other
+        # threads acquiring the same pair will wait here until it is mounted.
+        with reference.lock:
+            try:
+                if not reference.mounted:
+                    if device.is_mounted() and mountpoint.is_active():
+                        reference.owned = False
+                    else:
+                        start = time.time()
+                        device.mount(mountpoint)
+                        self._record_timing("mount", reference, start)
+                        reference.owned = True
+                    reference.mounted = True
+                self._switch_profile(reference, backup=True)
+            except (filesystem.MountError, process.ProcessError):
+                with self._lock:
+                    reference.count -= 1
+                    if reference.count == 0 and not reference.mounted:
+                        del self._references[reference.key]
+                    elif reference.count == 0:
+                        reference.release_time = time.time()
+                raise
+
+    def release(self, device, mountpoint, now=None):
+        """
+        Decreases the reference count of a device that was acquired before.
+        :param device: The device to release.
+        :type device: Device instance
+        :param mountpoint: The mountpoint the device was acquired at.
+        :type mountpoint: Mountpoint instance
+        :param now: The current time in seconds since the epoch. If None,
+        time.time() is used.
+        :type now: float
+        :raises: ValueError if the device was not acquired at the mountpoint.
+        :raises: MountError if remounting with the normal options fails or if
+        idle_timeout is 0 and unmounting fails.
+        :raises: ProcessError if any process spawned by this method fails.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            reference = self._find_reference(device, mountpoint)
+            if reference is None or reference.count == 0:
+                raise ValueError("The device has not been acquired.")
+            reference.count -= 1
+            if reference.count == 0:
+                reference.release_time = now
+        # Taking self._lock here could deadlock with unmount_idle(). Reading
+        # the count without it is fine: if somebody acquires the device in
+        # the meantime, the count is not zero anymore, and if somebody
+        # acquires it right after the check, the acquiring thread waits for
+        # reference.lock and switches back to the backup options.
+        with reference.lock:
+            if reference.count == 0:
+                self._switch_profile(reference, backup=False)
+        if self.idle_timeout == 0:
+            self.unmount_idle(now)
+
+    def unmount_idle(self, now=None):
+        """
+        Unmounts all devices that have not been used for idle_timeout seconds.
+        Meant to be called periodically.
+        :param now: The current time in seconds since the epoch. If None,
+        time.time() is used.
+        :type now: float
+        :returns: The number of unmounted devices.
+        :rtype: int
+        :raises: MountError if unmounting a device fails.
+        :raises: ProcessError if any process spawned by this method fails.
+        """
+        if now is None:
+            now = time.time()
+        unmounted = 0
+        # The lock is held during unmounting, so nobody can acquire a device
+        # that is just being unmounted.
+        with self._lock:
+            for reference in list(self._references.values()):
+                if (reference.count != 0 or
+                        now - reference.release_time < self.idle_timeout):
+                    continue
+                with reference.lock:
+                    if reference.mounted and reference.owned:
+                        start = time.time()
+                        reference.device.unmount()
+                        self._record_timing("unmount", reference, start)
+                        unmounted += 1
+                    del self._references[reference.key]
+        return unmounted
+
+    def unmount_all(self):
+        """
+        Unmounts all devices that are not in use, regardless of idle_timeout.
+        :returns: The number of unmounted devices.
+        :rtype: int
+        :raises: MountError if unmounting a device fails.
+        :raises: ProcessError if any process spawned by this method fails.
+        """
+        return self.unmount_idle(now=float("inf"))
+
+    def get_reference_count(self, device, mountpoint):
+        """
+        Returns how many users currently hold a device.
+        :param device: The device.
+        :type device: Device instance
+        :param mountpoint: The mountpoint the device was acquired at.
+        :type mountpoint: Mountpoint instance
+        :returns: The reference count, 0 if the device is not held.
+        :rtype: int
+        """
+        with self._lock:
+            reference = self._find_reference(device, mountpoint)
+            if reference is None:
+                return 0
+            return reference.count
+
+    def pop_timings(self):
+        """
+        Returns the timings of all mounts, unmounts and remounts since the
+        last call.
+        :returns: The timings in the order the operations finished.
+        :rtype: list of MountTiming instances
+        """
+        with self._timings_lock:
+            timings = self._timings
+            self._timings = []
+        return timings
+
+    def _switch_profile(self, reference, backup):
+        """
+        Remounts the mountpoint of a reference with its backup options or its
+        normal options, if it is not already mounted with them. Mounts not
+        made by the manager are left alone. Has to be called with
+        reference.lock held.
+        """
+        mountpoint = reference.mountpoint
+        if (not reference.owned or mountpoint.backup_options is None or
+                reference.backup_profile == backup):
+            return
+        start = time.time()
+        if backup:
+            mountpoint.remount(mountpoint.backup_options)
+            self._record_timing("backup profile", reference, start)
+        else:
+            mountpoint.remount(mountpoint.options)
+            self._record_timing("safe profile", reference, start)
+        reference.backup_profile = backup
+
+    def _record_timing(self, operation, reference, start):
+        timing = MountTiming(operation, reference.device,
+                             reference.mountpoint, time.time() - start)
+        with self._timings_lock:
+            self._timings.append(timing)
+
+    def _find_reference(self, device, mountpoint):
+        return self._references.get(_get_reference_key(device, mountpoint))
+
+
+class MountTiming(object):
+    """The duration of a single operation of MountManager."""
+    def __init__(self, operation, device, mountpoint, duration):
+        """
+        :param operation: The operation, one of "mount", "unmount",
+        "backup profile" and "safe profile".
+        :type operation: string
+        :param device: The device of the operation.
+        :type device: Device instance
+        :param mountpoint: The mountpoint of the operation.
+        :type mountpoint: Mountpoint instance
+        :param duration: The duration of the operation in seconds.
+        :type duration: float
+        """
+        self.operation = operation
+        self.device = device
+        self.mountpoint = mountpoint
+        self.duration = duration
+
+
+class _MountReference(object):
+    """The bookkeeping of MountManager for a single (device, mountpoint)."""
+    def __init__(self, device, mountpoint):
+        self.device = device
+        self.mountpoint = mountpoint
+        self.key = _get_reference_key(device, mountpoint)
+        self.count = 0
+        self.mounted = False
+        self.owned = False
+        self.backup_profile = False
+        self.release_time = None
+        self.lock = threading.Lock()
+
+
+def _get_reference_key(device, mountpoint):
+    """
+    Returns a hashable key for a (device, mountpoint) pair. Different Device
+    and Mountpoint instances may describe the same pair, so the objects
+    themselves cannot be used.
+    """
+    return (device.host.key, device.uuid, mountpoint.host.key,
+            mountpoint.path.rstrip('/'))
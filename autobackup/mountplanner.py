@@ -0,0 +1,196 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of autobackup.
+#
+# autobackup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autobackup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to mount many devices at once. Mounts that do not depend on each other
+are executed in parallel, with a limit of concurrent mounts per host.
+"""
+
+import threading
+import time
+
+import filesystem
+import process
+
+
+class MountPlanner(object):
+    """
+    Collects (device, mountpoint) pairs and acquires all of them from a mount
+    manager in parallel. A mount has to wait for another one if
+    - its mountpoint lies below the mountpoint of the other one on the same
+      host, or
+    - both mount the same device, as checking whether it is mounted already
+      and mounting it cannot happen at the same time. This includes the
+      temporary mountpoint of the device, see Device.mount().
+    """
+    def __init__(self, mount_manager, max_mounts_per_host):
+        """
+        :param mount_manager: The mount manager used to mount the devices.
+        :type mount_manager: MountManager instance
+        :param max_mounts_per_host: The maximum number of mounts that may be
+        executed on a single host at the same time. A mount between two
+        hosts counts for both of them.
+        :type max_mounts_per_host: int
+        """
+        self.mount_manager = mount_manager
+        self.max_mounts_per_host = max_mounts_per_host
+        self._jobs = []
+
+    def add(self, device, mountpoint):
+        """
+        Adds a device that has to be mounted. Adding the same pair several
+        times has no effect.
+        :param device: The device to mount.
+        :type device: Device instance
+        :param mountpoint: The mountpoint to mount the device at.
+        :type mountpoint: Mountpoint instance
+        """
+        for job in self._jobs:
+            if job.matches(device, mountpoint):
+                return
+        self._jobs.append(_MountJob(device, mountpoint))
+
+    def execute(self):
+        """
+        Acquires all added devices from the mount manager and waits until all
+        mounts have finished. Mounts that fail do not stop the others, but
+        all mounts depending on them are skipped. Every successful mount has
+        to be released from the mount manager again.
+        :returns: The results of all mounts in the order they were added.
+        :rtype: list of MountResult instances
+        """
+        jobs = list(self._jobs)
+        # Sorting by depth ensures that all dependencies point to jobs earlier
+        # in the list, so there cannot be any cycles.
+        ordered = sorted(jobs, key=lambda job: job.get_depth())
+        for index, job in enumerate(ordered):
+            job.dependencies = [other for other in ordered[:index]
+                                if job.depends_on(other)]
+
+        semaphores = {}
+        for job in jobs:
+            for key in job.get_host_keys():
+                if key not in semaphores:
+                    semaphores[key] = threading.Semaphore(
+                        self.max_mounts_per_host)
+
+        threads = []
+        for job in ordered:
+            thread = threading.Thread(target=self._run_job,
+                                      args=(job, semaphores))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        return [job.result for job in jobs]
+
+    def _run_job(self, job, semaphores):
+        for dependency in job.dependencies:
+            dependency.done.wait()
+        failed = [dependency for dependency in job.dependencies
+                  if dependency.result.error is not None]
+        if failed:
+            job.result = MountResult(
+                job.device, job.mountpoint, duration=0,
+                error=filesystem.MountError(
+                    "Skipped, as the mount of {0} failed.".format(
+                        failed[0].mountpoint.path)))
+            job.done.set()
+            return
+
+        # Semaphores are always taken in the same order, so two jobs between
+        # the same hosts cannot deadlock.
+        keys = sorted(job.get_host_keys())
+        for key in keys:
+            semaphores[key].acquire()
+        start = time.time()
+        error = None
+        try:
+            self.mount_manager.acquire(job.device, job.mountpoint)
+        except (filesystem.MountError, process.ProcessError) as exception:
+            error = exception
+        finally:
+            duration = time.time() - start
+            for key in reversed(keys):
+                semaphores[key].release()
+        job.result = MountResult(job.device, job.mountpoint, duration, error)
+        job.done.set()
+
+
+class MountResult(object):
+    """The outcome of a single mount executed by MountPlanner."""
+    def __init__(self, device, mountpoint, duration, error):
+        """
+        :param device: The device that was mounted.
+        :type device: Device instance
+        :param mountpoint: The mountpoint the device was mounted at.
+        :type mountpoint: Mountpoint instance
+        :param duration: The time the mount took in seconds, without the time
+        spent waiting for other mounts.
+        :type duration: float
+        :param error: The exception that made the mount fail, None if it
+        succeeded.
+        :type error: Exception instance
+        """
+        self.device = device
+        self.mountpoint = mountpoint
+        self.duration = duration
+        self.error = error
+
+
+class _MountJob(object):
+    """A single mount of MountPlanner and its dependencies."""
+    def __init__(self, device, mountpoint):
+        self.device = device
+        self.mountpoint = mountpoint
+        self.dependencies = []
+        self.result = None
+        self.done = threading.Event()
+
+    def matches(self, device, mountpoint):
+        """Determines whether the job mounts the given pair."""
+        return (self.device.uuid == device.uuid and
+                self.device.host == device.host and
+                self.mountpoint.host == mountpoint.host and
+                _normalize_path(self.mountpoint.path) ==
+                _normalize_path(mountpoint.path))
+
+    def get_depth(self):
+        """Returns the number of components of the mountpoint path."""
+        return len([part for part in self.mountpoint.path.split('/') if part])
+
+    def get_host_keys(self):
+        """Returns the keys of all hosts that are involved in the mount."""
+        return set([self.device.host.key, self.mountpoint.host.key])
+
+    def depends_on(self, other):
+        """Determines whether this job has to wait for another one."""
+        if self.mountpoint.host == other.mountpoint.host:
+            path = _normalize_path(self.mountpoint.path)
+            other_path = _normalize_path(other.mountpoint.path)
+            if path.startswith(other_path.rstrip('/') + '/'):
+                return True
+        return (self.device.uuid == other.device.uuid and
+                self.device.host == other.device.host)
+
+
+def _normalize_path(path):
+    """Removes trailing slashes from a path, but keeps the root directory."""
+    return path.rstrip('/') or '/'
@@ -14,6 +14,33 @@ class Location(object):
 
 
 class FullLocation(Location):
-    def __init__(self, user, host, path, device):
+    def __init__(self, user, host, path, device, mountpoint=None):
         super(FullLocation, self).__init__(user, host, path)
         self.device = device
+        # The mountpoint the device has to be mounted at for path to be
+        # accessible, None if there is no device.
+        self.mountpoint = mountpoint
+
+
+    def is_direct(self):
+        """
+        Determines whether the path can be accessed without mounting the
+        device between different hosts.
+        """
+        return self.device is None or self.device.host == self.host
+
+
+    def get_direct_location(self):
+        """
+        Returns a location that reaches the same path on the host of the
+        device, where the device is mounted at the same path with
+        Device.get_direct_mountpoint().
+        """
+        if self.is_direct():
+            return self
+        return FullLocation(user=self.user,
+                            host=self.device.host,
+                            path=self.path,
+                            device=self.device,
+                            mountpoint=self.device.get_direct_mountpoint(
+                                self.mountpoint))
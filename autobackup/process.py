@@ -28,11 +28,15 @@ It also contains some functions to execute frequently needed processes, like
 creating/deleting a directory or testing whether a file exists.
 """
 
+import base64
 import getpass
 import os
 import pwd
 import subprocess
+import threading
 
+import deletion
+import fingerprint
 import networkconnection
 
 
@@ -43,8 +47,33 @@ _CONNECTION_REMOTE_SHELL = "/bin/bash"
 _COMMAND_TIMEOUT = 10 * 1000
 _connections = []
 
-
-def execute(host, args, user, remote_user=None):
+# in seconds
+# Deleting a tree on a remote host is split into runs of this length, so no
+# single command hits _COMMAND_TIMEOUT. The deletion resumes where the last
+# run stopped.
+_REMOTE_DELETION_TIME_LIMIT = 5
+# The default time a source is walked for its fingerprint, see
+# func_get_fingerprint(). The remote command may take this long plus
+# _COMMAND_TIMEOUT, on a connection of its own.
+FINGERPRINT_TIME_LIMIT = 120
+# How often a local command checks whether it was cancelled, see execute().
+_CANCEL_POLL_INTERVAL = 1
+# How long a cancelled local command may take to exit before it is killed.
+_TERMINATE_TIMEOUT = 30
+# Loads the module sent as the next argument and runs it as __main__. The
+# commands are quoted with subprocess.list2cmdline(), so it must not contain
+# characters the remote shell expands in double quotes.
+_REMOTE_MODULE_LOADER = ("import base64,sys;"
+                         "exec(base64.b64decode(sys.argv.pop(1)))")
+
+# Commands may be executed from several threads. A connection is a single
+# shell, so only one command at a time may be executed through it.
+_connections_lock = threading.Lock()
+_connection_locks = []
+
+
+def execute(host, args, user, remote_user=None, cancel_event=None,
+            timeout=_COMMAND_TIMEOUT, shared=True):
     """
     Executes a command on a specific as a user. Will connect to the host and
     maintain the connection if the host is remote until you explicitly
@@ -61,6 +90,18 @@ def execute(host, args, user, remote_user=None):
     If none is given, the same user as the local one will be used. If the
     command is executed on the localhost, the parameter will be ignored.
     :type remote_user: string
+    :param cancel_event: If given, a command executed on the localhost is
+    terminated as soon as the event is set. Commands on remote hosts are
+    bound by the timeout instead.
+    :type cancel_event: threading.Event instance
+    :param timeout: The time in milliseconds after which a command executed
+    on a remote host is given up.
+    :type timeout: int
+    :param shared: Determines whether a command executed on a remote host
+    uses the connection shared by all commands to the host. It executes one
+    command at a time, so commands that may run for long have to use a
+    connection of their own, which is closed afterwards.
+    :type shared: bool
     :returns: A tuple which contains the exit code of the command, the whole
     output to stdout and the whole output to stderr as strings.
     :rtype: tuple
@@ -72,33 +113,49 @@ def execute(host, args, user, remote_user=None):
         # Connect to a remote host
         if remote_user is None:
             remote_user = user
-        # see if connection already exists
-        connection = None
-        for conn in _connections:
-            if (conn.host == host and conn.local_user == user and
-                    conn.remote_user == remote_user):
-                connection = conn
-                break
-        if not connection:
+        if not shared:
             connection = _CONNECTION_CLASS(host=host,
                                            local_user=user,
                                            remote_user=remote_user,
                                            port=_CONNECTION_PORT)
-
-        if not connection.is_connected():
+            connection.connect(timeout=_CONNECTION_TIMEOUT,
+                               remote_shell=_CONNECTION_REMOTE_SHELL)
             try:
-                connection.connect(timeout=_CONNECTION_TIMEOUT,
-                                   remote_shell=_CONNECTION_REMOTE_SHELL)
-            except (TimeoutError, ConnectionRefusedError):
-                raise
+                return connection.execute(command=args, timeout=timeout)
+            finally:
+                connection.disconnect()
+        # see if connection already exists
+        with _connections_lock:
+            connection = None
+            for conn in _connections:
+                if (conn.host == host and conn.local_user == user and
+                        conn.remote_user == remote_user):
+                    connection = conn
+                    break
+            if not connection:
+                connection = _CONNECTION_CLASS(host=host,
+                                               local_user=user,
+                                               remote_user=remote_user,
+                                               port=_CONNECTION_PORT)
+                _connections.append(connection)
+                _connection_locks.append(threading.Lock())
+            connection_lock = _connection_locks[_connections.index(connection)]
+
+        with connection_lock:
+            if not connection.is_connected():
+                try:
+                    connection.connect(timeout=_CONNECTION_TIMEOUT,
+                                       remote_shell=_CONNECTION_REMOTE_SHELL)
+                except (TimeoutError, ConnectionRefusedError):
+                    raise
 
             try:
                 (exit_code, stdoutdata, stderrdata) = connection.execute(
-                    command=args, timeout=_COMMAND_TIMEOUT)
+                    command=args, timeout=timeout)
             except TimeoutError:
                 raise
 
-            return (exit_code, stdoutdata, stderrdata)
+        return (exit_code, stdoutdata, stderrdata)
     else:
         # Just execute the command locally.
 
@@ -111,15 +168,40 @@ def execute(host, args, user, remote_user=None):
         else:
             preexec = None
 
+        # The output is decoded, so it is a string just like the output
+        # of commands executed on a remote host.
         process = subprocess.Popen(args,
                                    stdout=subprocess.PIPE,
                                    stderr=subprocess.PIPE,
                                    bufsize=-1,
+                                   universal_newlines=True,
                                    preexec_fn=preexec)
-        (stdoutdata, stderrdata) = process.communicate()
+        if cancel_event is None:
+            (stdoutdata, stderrdata) = process.communicate()
+        else:
+            (stdoutdata, stderrdata) = _communicate(process, cancel_event)
         return (process.returncode, stdoutdata, stderrdata)
 
 
+def _communicate(process, cancel_event):
+    """
+    Like Popen.communicate(), but terminates the process when the event is
+    set. It is killed if it does not exit in time after that.
+    """
+    while True:
+        try:
+            return process.communicate(timeout=_CANCEL_POLL_INTERVAL)
+        except subprocess.TimeoutExpired:
+            if cancel_event.is_set():
+                break
+    process.terminate()
+    try:
+        return process.communicate(timeout=_TERMINATE_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        return process.communicate()
+
+
 def disconnect(host, user=None, remote_user=None):
     """
     Terminates all connections to a host as a specific user/remote_user. If no
@@ -136,13 +218,16 @@ def disconnect(host, user=None, remote_user=None):
     host.
     """
     any_disconnects = False
-    for conn in _connections:
-        if conn.host == host:
-            if ((user is None or user == conn.local_user) and
-                    (remote_user is None or remote_user == conn.remote_user)):
-                conn.disconnect()
-                _connections.remove(conn)
-                any_disconnects = True
+    with _connections_lock:
+        for conn in list(_connections):
+            if conn.host == host:
+                if ((user is None or user == conn.local_user) and
+                        (remote_user is None or
+                         remote_user == conn.remote_user)):
+                    conn.disconnect()
+                    del _connection_locks[_connections.index(conn)]
+                    _connections.remove(conn)
+                    any_disconnects = True
     return any_disconnects
 
 
@@ -154,7 +239,8 @@ def disconnect_all():
         conn.disconnect()
 
 
-def execute_success(host, args, user, remote_user=None):
+def execute_success(host, args, user, remote_user=None,
+                    timeout=_COMMAND_TIMEOUT, shared=True):
     """
     Executes a command and returns its output to stdout. If the command returns
     a failure status (!= 0), raises a ProcessError.
@@ -177,7 +263,8 @@ def execute_success(host, args, user, remote_user=None):
     :raises: ConnectionRefusedError connecting to a remote host fails.
     :raises: ProcessError if the command exits with a failure status.
     """
-    (exit_code, stdoutdata, stderrdata) = execute(host, args, user, remote_user)
+    (exit_code, stdoutdata, stderrdata) = execute(
+        host, args, user, remote_user, timeout=timeout, shared=shared)
     if exit_code != 0:
         raise ProcessError(exit_code, stdoutdata, stderrdata)
     return stdoutdata
@@ -303,6 +390,93 @@ def func_directory_get_files(host, user, path, remote_user=None):
     return dirs
 
 
+def func_read_file(host, user, path, remote_user=None):
+    """
+    Function that returns the content of a file.
+    :param host: Host on which to execute the command.
+    :type host: Host instance
+    :param user: The user as whom to run the command on the local machine or
+    the local connection command if executing to a remote host.
+    :type user: string
+    :param path: The path of the file.
+    :type path: string
+    :param remote_user: The username to use when connecting to a remote host.
+    If none is given, the same user as the local one will be used. If the
+    command is executed on the localhost, the parameter will be ignored.
+    :type remote_user: string
+    :returns: The content of the file.
+    :rtype: string
+    :raises: TimeoutError if connecting to or executing a command on a remote
+    host and a timeout occurs.
+    :raises: ConnectionRefusedError connecting to a remote host fails.
+    :raises: ProcessError if reading the file failed.
+    """
+    args = ["cat", path]
+    return execute_success(host, args, user, remote_user)
+
+
+def func_get_filesystem_usage(host, user, path, remote_user=None):
+    """
+    Function that determines the size and free space of the filesystem a path
+    lies on, like statvfs(3).
+    :param host: Host on which to execute the command.
+    :type host: Host instance
+    :param user: The user as whom to run the command on the local machine or
+    the local connection command if executing to a remote host.
+    :type user: string
+    :param path: Any path on the filesystem.
+    :type path: string
+    :param remote_user: The username to use when connecting to a remote host.
+    If none is given, the same user as the local one will be used. If the
+    command is executed on the localhost, the parameter will be ignored.
+    :type remote_user: string
+    :returns: A tuple with the bytes available to unprivileged users and the
+    total size of the filesystem in bytes.
+    :rtype: tuple
+    :raises: TimeoutError if connecting to or executing a command on a remote
+    host and a timeout occurs.
+    :raises: ConnectionRefusedError connecting to a remote host fails.
+    :raises: ProcessError if the filesystem could not be examined.
+    """
+    # %a: free blocks available to non-superusers, %b: total blocks,
+    # %S: the size of these blocks
+    args = ["stat", "--file-system", "--format", "%a %b %S", path]
+    stdoutdata = execute_success(host, args, user, remote_user)
+    (available, total, block_size) = [int(field) for field in
+                                      str(stdoutdata).split()]
+    return (available * block_size, total * block_size)
+
+
+def func_get_file_state(host, user, path, remote_user=None):
+    """
+    Function that returns the identity and the modification and change times
+    of a file. If the state of a directory is the same as before, no entries
+    have been added, removed or renamed.
+    :param host: Host on which to execute the command.
+    :type host: Host instance
+    :param user: The user as whom to run the command on the local machine or
+    the local connection command if executing to a remote host.
+    :type user: string
+    :param path: The path of the file.
+    :type path: string
+    :param remote_user: The username to use when connecting to a remote host.
+    If none is given, the same user as the local one will be used. If the
+    command is executed on the localhost, the parameter will be ignored.
+    :type remote_user: string
+    :returns: The state of the file, only meaningful for comparison.
+    :rtype: string
+    :raises: TimeoutError if connecting to or executing a command on a remote
+    host and a timeout occurs.
+    :raises: ConnectionRefusedError connecting to a remote host fails.
+    :raises: ProcessError if the file could not be examined.
+    """
+    # %d: device, %i: inode, %y and %z: modification and change times with
+    # the full resolution of the filesystem
+    args = ["stat", "--format", "%d %i %y %z", path]
+    stdoutdata = execute_success(host, args, user, remote_user)
+    return str(stdoutdata).strip()
+
+
 def func_create_directory(host, user, path, create_parents, remote_user=None):
     """
     Function to create a directory.
@@ -331,6 +505,35 @@ def func_create_directory(host, user, path, create_parents, remote_user=None):
     execute_success(host, args, user, remote_user)
 
 
+def func_rename(host, user, path, new_path, remote_user=None):
+    """
+    Function to rename a file or directory atomically. Both paths have to be
+    on the same filesystem.
+    :param host: Host on which to execute the command.
+    :type host: Host instance
+    :param user: The user as whom to run the command on the local machine or
+    the local connection command if executing to a remote host.
+    :type user: string
+    :param path: The path of the file or directory to rename.
+    :type path: string
+    :param new_path: The new path. It must not exist, unless it is an empty
+    directory.
+    :type new_path: string
+    :param remote_user: The username to use when connecting to a remote host.
+    If none is given, the same user as the local one will be used. If the
+    command is executed on the localhost, the parameter will be ignored.
+    :type remote_user: string
+    :raises: TimeoutError if connecting to or executing a command on a remote
+    host and a timeout occurs.
+    :raises: ConnectionRefusedError connecting to a remote host fails.
+    :raises: ProcessError if renaming failed.
+    """
+    # Without --no-target-directory, a directory would be moved into an
+    # existing directory new_path instead of replacing it.
+    args = ["mv", "--no-target-directory", path, new_path]
+    execute_success(host, args, user, remote_user)
+
+
 def func_remove_directory(host, user, path, recursive, remote_user=None):
     """
     Function to remove a directory.
@@ -358,6 +561,159 @@ def func_remove_directory(host, user, path, recursive, remote_user=None):
     return execute_success(host, args, user, remote_user)
 
 
+def func_delete_tree(host, user, path, threads=deletion.DEFAULT_THREADS,
+                     rate=None, progress_callback=None, idle_priority=False,
+                     remote_user=None):
+    """
+    Function that deletes a directory tree with the deletion module, which is
+    much faster than rm for trees with many files. On the localhost, the
+    deletion runs in this process, on remote hosts the module is sent to and
+    run by python3 on the host.
+    :param host: Host on which to delete the tree.
+    :type host: Host instance
+    :param user: The local connection user if deleting on a remote host.
+    On the localhost, the tree is deleted as the user running this process.
+    :type user: string
+    :param path: The path of the tree.
+    :type path: string
+    :param threads: The number of threads unlinking files.
+    :type threads: int
+    :param rate: The maximum number of files and directories to delete per
+    second, None for no limit.
+    :type rate: float
+    :param progress_callback: Called with a DeletionProgress instance from
+    time to time.
+    :type progress_callback: callable
+    :param idle_priority: Determines whether to delete with idle I/O
+    priority, so other processes using the disk are not slowed down.
+    :type idle_priority: bool
+    :param remote_user: The username to use when connecting to a remote host.
+    If none is given, the same user as the local one will be used. If the
+    command is executed on the localhost, the parameter will be ignored.
+    :type remote_user: string
+    :returns: The progress of the finished deletion.
+    :rtype: DeletionProgress instance
+    :raises: TimeoutError if connecting to or executing a command on a remote
+    host and a timeout occurs.
+    :raises: ConnectionRefusedError connecting to a remote host fails.
+    :raises: ProcessError if the tree could not be deleted.
+    """
+    if host.is_localhost():
+        try:
+            (_, progress) = deletion.delete_tree(
+                path, threads, rate, progress_callback,
+                idle_priority=idle_priority)
+        except OSError as error:
+            raise ProcessError(1, "", str(error))
+        return progress
+
+    source = base64.b64encode(_get_module_source(deletion)).decode("ascii")
+    progress = deletion.DeletionProgress()
+    while True:
+        args = ["python3", "-c", _REMOTE_MODULE_LOADER, source, path,
+                str(threads), str(rate or 0),
+                str(_REMOTE_DELETION_TIME_LIMIT), str(int(idle_priority))]
+        stdoutdata = execute_success(host, args, user, remote_user)
+        (files, directories, finished) = [
+            int(field) for field in str(stdoutdata).split()[-3:]]
+        progress.add(files, directories)
+        if finished:
+            return progress
+        if progress_callback is not None:
+            progress_callback(progress)
+
+
+def func_get_fingerprint(host, user, path,
+                         time_limit=FINGERPRINT_TIME_LIMIT, remote_user=None):
+    """
+    Function to get the fingerprint of a directory tree with the fingerprint
+    module. On the localhost, the tree is walked by this process, on remote
+    hosts the module is sent to and run by python3 on the host.
+    :param host: Host on which the tree is.
+    :type host: Host instance
+    :param user: The user as whom to run the command on the local machine or
+    the local connection command if executing to a remote host.
+    :type user: string
+    :param path: The path of the tree.
+    :type path: string
+    :param time_limit: The number of seconds after which the walk is given
+    up.
+    :type time_limit: float
+    :param remote_user: The username to use when connecting to a remote host.
+    If none is given, the same user as the local one will be used. If the
+    command is executed on the localhost, the parameter will be ignored.
+    :type remote_user: string
+    :returns: The fingerprint, None if the tree was too big to walk in time.
+    :rtype: string
+    :raises: TimeoutError if connecting to or executing a command on a remote
+    host and a timeout occurs.
+    :raises: ConnectionRefusedError connecting to a remote host fails.
+    :raises: ProcessError if the tree could not be walked.
+    """
+    if host.is_localhost():
+        try:
+            return fingerprint.get_fingerprint(path, time_limit)
+        except OSError as error:
+            raise ProcessError(1, "", str(error))
+
+    source = base64.b64encode(_get_module_source(fingerprint)).decode(
+        "ascii")
+    args = ["python3", "-c", _REMOTE_MODULE_LOADER, source, path,
+            str(time_limit)]
+    # The walk stops by itself after the time limit, the command must not
+    # time out before that. Other commands to the host must not wait for it.
+    stdoutdata = execute_success(
+        host, args, user, remote_user,
+        timeout=int(time_limit * 1000) + _COMMAND_TIMEOUT, shared=False)
+    return str(stdoutdata).strip() or None
+
+
+def func_clone_tree(host, user, path, new_path, time_limit=None,
+                    remote_user=None):
+    """
+    Function to copy a directory tree by hardlinking all its files, which
+    only creates the directories anew. Both paths have to be on the same
+    filesystem. On a remote host, the copy runs on a connection of its own,
+    so it does not hold up other commands to the host.
+    :param host: Host on which to execute the command.
+    :type host: Host instance
+    :param user: The user as whom to run the command on the local machine or
+    the local connection command if executing to a remote host.
+    :type user: string
+    :param path: The path of the tree to copy.
+    :type path: string
+    :param new_path: The path of the copy. It must not exist.
+    :type new_path: string
+    :param time_limit: The number of seconds after which copying on a remote
+    host is given up, which should grow with the number of files in the
+    tree. At least _COMMAND_TIMEOUT.
+    :type time_limit: float
+    :param remote_user: The username to use when connecting to a remote host.
+    If none is given, the same user as the local one will be used. If the
+    command is executed on the localhost, the parameter will be ignored.
+    :type remote_user: string
+    :raises: TimeoutError if connecting to or executing a command on a remote
+    host and a timeout occurs.
+    :raises: ConnectionRefusedError connecting to a remote host fails.
+    :raises: ProcessError if copying failed.
+    """
+    args = ["cp", "--archive", "--link", "--no-target-directory", path,
+            new_path]
+    timeout = _COMMAND_TIMEOUT
+    if time_limit is not None:
+        timeout = max(timeout, int(time_limit * 1000))
+    execute_success(host, args, user, remote_user, timeout=timeout,
+                    shared=False)
+
+
+def _get_module_source(module):
+    path = module.__file__
+    if path.endswith(".pyc"):
+        path = path[:-1]
+    with open(path, "rb") as source:
+        return source.read()
+
+
 class ProcessError(Exception):
     """Exception raised when a process of this module fails."""
     def __init__(self, exit_code, stdoutdata, stderrdata):
@@ -0,0 +1,218 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of autobackup.
+#
+# autobackup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autobackup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to determine which backups of a repository have expired. All backups
+are evaluated at once, given as parallel sequences of their births and the
+indices of their tags, so no backup is looked at more than a few times no
+matter how many of them expire.
+
+The rules of a tag are applied in the following order:
+1. Backups older than max_age expire.
+2. If the tag thins out its backups, only the newest backup of every bucket
+   (hour, day, week or month) is kept.
+3. Of the remaining backups, only the newest max_count are kept.
+
+NumPy is used if it is installed, otherwise the backups are sorted in pure
+python.
+"""
+
+import calendar
+import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# The buckets a tag can thin its backups out to.
+HOURLY = "hourly"
+DAILY = "daily"
+WEEKLY = "weekly"
+MONTHLY = "monthly"
+THINNING_BUCKETS = (HOURLY, DAILY, WEEKLY, MONTHLY)
+
+_SECONDS_PER_HOUR = 3600
+_SECONDS_PER_DAY = 86400
+# 1970-01-01 was a thursday, weeks start on mondays.
+_EPOCH_WEEKDAY = 3
+
+
+def to_timestamp(date_time):
+    """
+    Converts the birth of a backup into a timestamp. Births are naive local
+    times, so they are converted as if they were UTC. This way, every day has
+    24 hours and buckets are not shifted by daylight saving time.
+    :param date_time: The time to convert.
+    :type date_time: datetime instance
+    :returns: The seconds since the epoch.
+    :rtype: int
+    """
+    return calendar.timegm(date_time.timetuple())
+
+
+def get_expired(births, tag_ids, tags, now):
+    """
+    Determines all expired backups.
+    :param births: The timestamps of the births of all backups, see
+    to_timestamp().
+    :type births: sequence of ints
+    :param tag_ids: The index of the tag of every backup in tags.
+    :type tag_ids: sequence of ints
+    :param tags: The tags. A tag may be None, its backups never expire.
+    :type tags: list of Tag instances
+    :param now: The timestamp of the current time, see to_timestamp().
+    :type now: int
+    :returns: The indices of all expired backups in ascending order.
+    :rtype: list of ints
+    :raises: ValueError if a tag thins its backups out to an unknown bucket.
+    """
+    if len(births) != len(tag_ids):
+        raise ValueError("There has to be a tag for every birth.")
+    for tag in tags:
+        if tag is not None and tag.thinning not in THINNING_BUCKETS + (None,):
+            raise ValueError("Unknown bucket {}.".format(tag.thinning))
+    if len(births) == 0:
+        return []
+    if numpy is not None:
+        return _get_expired_numpy(births, tag_ids, tags, now)
+    return _get_expired_sorted(births, tag_ids, tags, now)
+
+
+def _get_limits(tags):
+    """
+    Returns the maximum age in seconds and the maximum count of every tag,
+    -1 if there is no limit.
+    """
+    max_ages = []
+    max_counts = []
+    for tag in tags:
+        if tag is None or tag.max_age is None:
+            max_ages.append(-1)
+        else:
+            max_ages.append(int(tag.max_age.total_seconds()))
+        if tag is None or tag.max_count is None:
+            max_counts.append(-1)
+        else:
+            max_counts.append(tag.max_count)
+    return (max_ages, max_counts)
+
+
+def get_bucket(birth, thinning):
+    """
+    :returns: The bucket a backup falls into when thinning out to hourly,
+    daily, weekly or monthly backups. Backups with the same bucket were born
+    in the same hour, day, week or month.
+    :rtype: int
+    """
+    if thinning == HOURLY:
+        return birth // _SECONDS_PER_HOUR
+    elif thinning == DAILY:
+        return birth // _SECONDS_PER_DAY
+    elif thinning == WEEKLY:
+        return (birth // _SECONDS_PER_DAY + _EPOCH_WEEKDAY) // 7
+    date_time = (datetime.datetime(1970, 1, 1) +
+                 datetime.timedelta(seconds=birth))
+    return date_time.year * 12 + date_time.month - 1
+
+
+def _get_expired_sorted(births, tag_ids, tags, now):
+    (max_ages, max_counts) = _get_limits(tags)
+    # newest backups of every tag first
+    order = sorted(range(len(births)),
+                   key=lambda index: (tag_ids[index], -births[index]))
+    expired = []
+    previous_tag = None
+    for index in order:
+        tag_id = tag_ids[index]
+        if tag_id != previous_tag:
+            previous_tag = tag_id
+            kept = 0
+            previous_bucket = None
+        tag = tags[tag_id]
+        if tag is None:
+            continue
+        birth = births[index]
+        if max_ages[tag_id] != -1 and birth < now - max_ages[tag_id]:
+            expired.append(index)
+            continue
+        if tag.thinning is not None:
+            bucket = get_bucket(birth, tag.thinning)
+            if bucket == previous_bucket:
+                expired.append(index)
+                continue
+            previous_bucket = bucket
+        if max_counts[tag_id] != -1 and kept >= max_counts[tag_id]:
+            expired.append(index)
+            continue
+        kept += 1
+    return sorted(expired)
+
+
+def _get_expired_numpy(births, tag_ids, tags, now):
+    (max_ages, max_counts) = _get_limits(tags)
+    births = numpy.asarray(births, dtype=numpy.int64)
+    tag_ids = numpy.asarray(tag_ids, dtype=numpy.int64)
+    max_ages = numpy.asarray(max_ages, dtype=numpy.int64)[tag_ids]
+    max_counts = numpy.asarray(max_counts, dtype=numpy.int64)[tag_ids]
+    count = len(births)
+
+    expired = (max_ages != -1) & (births < now - max_ages)
+
+    # Every backup of a tag that is not thinned out gets a bucket of its own.
+    buckets = -numpy.arange(1, count + 1, dtype=numpy.int64)
+    for (tag_id, tag) in enumerate(tags):
+        if tag is None or tag.thinning is None:
+            continue
+        selected = tag_ids == tag_id
+        buckets[selected] = get_buckets_numpy(births[selected], tag.thinning)
+    # Sorted by tag, bucket and birth, the newest backup of a bucket is the
+    # last one before the tag or bucket changes. Of backups born at the same
+    # time, the first one is kept, like in _get_expired_sorted().
+    order = numpy.lexsort((-numpy.arange(count), births, buckets, tag_ids))
+    newest = numpy.ones(count, dtype=bool)
+    newest[:-1] = ((tag_ids[order][1:] != tag_ids[order][:-1]) |
+                   (buckets[order][1:] != buckets[order][:-1]))
+    expired[order[~newest]] = True
+
+    # Rank the remaining backups of every tag, newest first.
+    remaining = numpy.flatnonzero(~expired)
+    order = remaining[numpy.lexsort((-births[remaining],
+                                     tag_ids[remaining]))]
+    sorted_tags = tag_ids[order]
+    ranks = (numpy.arange(len(order)) -
+             numpy.searchsorted(sorted_tags, sorted_tags, side="left"))
+    limits = max_counts[order]
+    expired[order[(limits != -1) & (ranks >= limits)]] = True
+    return numpy.flatnonzero(expired).tolist()
+
+
+def get_buckets_numpy(births, thinning):
+    """
+    Like get_bucket(), but for a NumPy array of births.
+    :rtype: NumPy array
+    """
+    if thinning == HOURLY:
+        return births // _SECONDS_PER_HOUR
+    elif thinning == DAILY:
+        return births // _SECONDS_PER_DAY
+    elif thinning == WEEKLY:
+        return (births // _SECONDS_PER_DAY + _EPOCH_WEEKDAY) // 7
+    return (births.astype("datetime64[s]").astype("datetime64[M]")
+            .astype(numpy.int64))
@@ -0,0 +1,159 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of autobackup.
+#
+# autobackup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autobackup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to split a huge source into shards that are copied by several rsyncs
+at the same time. A single rsync builds its file list on a single core, which
+takes most of the time for sources with millions of files.
+
+The top-level directories of a source are distributed over the shards, so
+that every shard holds about the same number of bytes. The size of every
+directory is estimated from the statistics of the previous backup, which are
+kept in the catalog of the repository. rsync only reports the size of a whole
+shard, so directories sharing a shard split its size by their previous
+estimates. A directory that has a shard of its own is measured exactly.
+"""
+
+import json
+import os
+
+
+# The key under which the sizes of the directories of a source are kept in
+# the catalog, followed by the source.
+_SIZES_KEY = "shard_sizes "
+
+
+def plan_shards(entries, sizes, count):
+    """
+    Distributes directories over shards of about the same size. The biggest
+    directories are placed first, every one into the smallest shard so far.
+    :param entries: The names of the directories.
+    :type entries: list of strings
+    :param sizes: The estimated size of every directory in bytes. Directories
+    without an estimate are assumed to be of average size.
+    :type sizes: dict
+    :param count: The maximum number of shards.
+    :type count: int
+    :returns: The names of the directories of every shard, sorted. Empty
+    shards are left out.
+    :rtype: list of lists of strings
+    """
+    estimates = _get_estimates(entries, sizes)
+    shards = [[] for _ in range(max(1, count))]
+    totals = [0.0] * len(shards)
+    for entry in sorted(entries, key=lambda entry: (-estimates[entry],
+                                                    entry)):
+        index = totals.index(min(totals))
+        shards[index].append(entry)
+        totals[index] += estimates[entry]
+    return [sorted(shard) for shard in shards if shard]
+
+
+def update_sizes(sizes, shards, totals):
+    """
+    Estimates the size of every directory from the sizes of the shards they
+    were copied in.
+    :param sizes: The previous estimates, see plan_shards().
+    :type sizes: dict
+    :param shards: The shards as returned by plan_shards().
+    :type shards: list of lists of strings
+    :param totals: The size of every shard in bytes, None for shards that
+    failed.
+    :type totals: list of ints
+    :returns: The new estimates of all directories of the shards. Shards
+    that failed keep their previous estimates.
+    :rtype: dict
+    """
+    estimates = _get_estimates([entry for shard in shards for entry in shard],
+                               sizes)
+    new_sizes = {}
+    for (shard, total) in zip(shards, totals):
+        if total is None:
+            for entry in shard:
+                if entry in sizes:
+                    new_sizes[entry] = sizes[entry]
+            continue
+        weights = [estimates[entry] for entry in shard]
+        weight_sum = float(sum(weights))
+        for (entry, weight) in zip(shard, weights):
+            if weight_sum > 0:
+                new_sizes[entry] = total * weight / weight_sum
+            else:
+                new_sizes[entry] = float(total) / len(shard)
+    return new_sizes
+
+
+def _get_estimates(entries, sizes):
+    """
+    Returns the estimated size of every directory. Directories without an
+    estimate are assumed to be of average size.
+    :rtype: dict
+    """
+    known = [sizes[entry] for entry in entries if entry in sizes]
+    if known:
+        default = float(sum(known)) / len(known)
+    else:
+        default = 1.0
+    return dict((entry, sizes.get(entry, default)) for entry in entries)
+
+
+def get_shard_paths(source_path, entries):
+    """
+    Returns the paths rsync has to copy with --relative, so every directory
+    ends up where copying the whole source would put it. The part before
+    "/./" is left out of the path in the target.
+    :param source_path: The path of the source as passed to rsync. With a
+    trailing slash, its contents are copied instead of the directory itself.
+    :type source_path: string
+    :param entries: The names of the directories of a shard.
+    :type entries: list of strings
+    :rtype: list of strings
+    """
+    if source_path.endswith("/"):
+        directory = source_path.rstrip("/")
+        prefix = ""
+    else:
+        (directory, name) = os.path.split(source_path)
+        prefix = name + "/"
+    if directory == "" and not source_path.startswith("/"):
+        marker = "./"
+    else:
+        marker = directory.rstrip("/") + "/./"
+    return [marker + prefix + entry for entry in entries]
+
+
+def load_sizes(repository_catalog, source):
+    """
+    :param repository_catalog: The catalog of the repository.
+    :type repository_catalog: Catalog instance
+    :param source: The source as passed to rsync.
+    :type source: string
+    :returns: The estimates stored by save_sizes(), an empty dictionary if
+    there are none.
+    :rtype: dict
+    """
+    value = repository_catalog.get_value(_SIZES_KEY + source)
+    if value is None:
+        return {}
+    return json.loads(value)
+
+
+def save_sizes(repository_catalog, source, sizes):
+    """Stores the estimates of the directories of a source."""
+    repository_catalog.set_value(_SIZES_KEY + source,
+                                 json.dumps(sizes, sort_keys=True))
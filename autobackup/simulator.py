@@ -0,0 +1,561 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of autobackup.
+#
+# autobackup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autobackup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to predict what the tags of a repository will do over a period of
+time, without creating a single backup. It answers how many backups are
+created (every backup is an rsync run), how many expire, how many exist at
+most at the same time and how many expire at once.
+
+The simulation follows BackupRepository.check_backups(), which runs every
+minute: expired backups are removed first, then a backup is created for
+every tag whose cron matches. Nothing is simulated minute by minute:
+- The occurrences of a cron are generated from the values of its fields,
+  day by day.
+- The retention rules of a tag only look at the backups of that tag, so
+  every tag is replayed on its own, from one backup to the next, and the
+  time every backup expires is computed right away.
+
+Repositories with the same tags behave the same, so they are only simulated
+once. The backups of a repository are only kept while it is simulated, the
+expiries of all repositories are added up per check, see CheckHistogram.
+NumPy is used if it is installed, otherwise everything is done with lists.
+
+Run it with the configuration file and the number of years to simulate:
+
+python simulator.py <path to config file> [years]
+"""
+
+import bisect
+import calendar
+import collections
+import datetime
+import itertools
+import sys
+
+import backuprepository
+import configparser
+import cron
+import retention
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# in seconds
+# The backups are checked this often, see BackupRepository.check_backups().
+CHECK_INTERVAL = 60
+
+_SECONDS_PER_DAY = 86400
+
+# A repository whose backups are born or expire in at least every this many
+# checks is counted in an array with an element for every check, otherwise
+# its births and expiries are sorted, see simulate().
+_DENSE_FRACTION = 8
+
+
+class SimulationResult(object):
+    """The outcome of simulating the tags of a single repository."""
+    def __init__(self, created, expired, remaining, peak, peak_time,
+                 burst, burst_time):
+        """
+        :param created: The number of backups created, i.e. of rsync runs.
+        :type created: int
+        :param expired: The number of backups that expired.
+        :type expired: int
+        :param remaining: The number of backups left at the end.
+        :type remaining: int
+        :param peak: The maximum number of backups at the same time.
+        :type peak: int
+        :param peak_time: The first time the peak was reached, None if there
+        were no backups.
+        :type peak_time: datetime instance
+        :param burst: The maximum number of backups expiring in a single
+        check.
+        :type burst: int
+        :param burst_time: The first check with the maximum burst, None if
+        no backup expired.
+        :type burst_time: datetime instance
+        """
+        self.created = created
+        self.expired = expired
+        self.remaining = remaining
+        self.peak = peak
+        self.peak_time = peak_time
+        self.burst = burst
+        self.burst_time = burst_time
+
+
+class CheckHistogram(object):
+    """
+    Counts events, like backups expiring, per check of a period. All events
+    are added up right away, so the events themselves do not have to be
+    kept. With NumPy, the counts are kept in an array with an element for
+    every check, otherwise only the checks with events are kept.
+    """
+    def __init__(self, start, end):
+        """
+        :param start: The start of the period (inclusive).
+        :type start: datetime instance
+        :param end: The end of the period (exclusive).
+        :type end: datetime instance
+        """
+        self.origin = (retention.to_timestamp(start) // CHECK_INTERVAL *
+                       CHECK_INTERVAL)
+        size = ((retention.to_timestamp(end) - self.origin) //
+                CHECK_INTERVAL + 1)
+        # Histograms with an element for every check.
+        self._dense = numpy is not None
+        if self._dense:
+            self._counts = numpy.zeros(size, dtype=numpy.int64)
+        else:
+            self._counts = collections.Counter()
+
+    def add(self, checks, counts, weight=1):
+        """
+        Counts events.
+        :param checks: The distinct timestamps of checks within the period,
+        see retention.to_timestamp().
+        :type checks: list of ints, or a NumPy array
+        :param counts: The number of events in every check.
+        :type counts: list of ints, or a NumPy array
+        :param weight: How often every event is counted.
+        :type weight: int
+        """
+        if self._dense:
+            indices = ((numpy.asarray(checks, dtype=numpy.int64) -
+                        self.origin) // CHECK_INTERVAL)
+            # The indices are distinct, so none of the additions is lost.
+            self._counts[indices] += (
+                numpy.asarray(counts, dtype=numpy.int64) * weight)
+            return
+        for (check, count) in zip(checks, counts):
+            self._counts[(check - self.origin) // CHECK_INTERVAL] += (
+                count * weight)
+
+    def get_maximum(self):
+        """
+        :returns: A tuple containing the maximum number of events in a
+        single check and the first check with that many events, or (0, None)
+        if there are no events.
+        :rtype: tuple
+        """
+        if self._dense:
+            index = int(numpy.argmax(self._counts))
+            maximum = int(self._counts[index])
+        elif self._counts:
+            maximum = max(self._counts.values())
+            index = min(index for (index, count) in self._counts.items()
+                        if count == maximum)
+        else:
+            maximum = 0
+        if maximum == 0:
+            return (0, None)
+        return (maximum,
+                _from_timestamp(self.origin + index * CHECK_INTERVAL))
+
+    def get_counts(self):
+        """
+        :returns: The number of events of every check with events, by the
+        timestamp of the check.
+        :rtype: dict
+        """
+        if self._dense:
+            indices = numpy.flatnonzero(self._counts)
+            return dict((self.origin + int(index) * CHECK_INTERVAL,
+                         int(self._counts[index])) for index in indices)
+        return dict((self.origin + index * CHECK_INTERVAL, count)
+                    for (index, count) in self._counts.items() if count)
+
+
+def get_occurrences(cronjob, start, end):
+    """
+    Returns all times a cron matches in a period, without checking every
+    minute of it.
+    :param cronjob: The cron.
+    :type cronjob: Cronjob instance
+    :param start: The start of the period (inclusive).
+    :type start: datetime instance
+    :param end: The end of the period (exclusive).
+    :type end: datetime instance
+    :returns: The timestamps of all matching minutes in ascending order,
+    see retention.to_timestamp().
+    :rtype: list of ints, or a NumPy array if NumPy is installed
+    """
+    (minutes, hours, days, months, years) = [
+        sorted(values) for values in cronjob.schedule[:5]]
+    # The seconds within a day the cron matches at.
+    offsets = [hour * 3600 + minute * 60 for hour in hours
+               for minute in minutes]
+    start_timestamp = retention.to_timestamp(start)
+    end_timestamp = retention.to_timestamp(end)
+    midnights = []
+    for year in years:
+        if year < start.year:
+            continue
+        if year > end.year:
+            break
+        for month in months:
+            if not 1 <= month <= 12:
+                continue
+            month_length = calendar.monthrange(year, month)[1]
+            first_midnight = retention.to_timestamp(
+                datetime.datetime(year, month, 1))
+            for day in days:
+                if not 1 <= day <= month_length:
+                    continue
+                midnight = first_midnight + (day - 1) * _SECONDS_PER_DAY
+                if (midnight + _SECONDS_PER_DAY > start_timestamp and
+                        midnight < end_timestamp):
+                    midnights.append(midnight)
+    if numpy is not None:
+        occurrences = numpy.add.outer(
+            numpy.asarray(midnights, dtype=numpy.int64),
+            numpy.asarray(offsets, dtype=numpy.int64)).ravel()
+        # Only the first and the last day may exceed the period.
+        (first, last) = numpy.searchsorted(
+            occurrences, [start_timestamp, end_timestamp])
+        return occurrences[first:last]
+    occurrences = [midnight + offset for midnight in midnights
+                   for offset in offsets]
+    first = bisect.bisect_left(occurrences, start_timestamp)
+    last = bisect.bisect_left(occurrences, end_timestamp)
+    return occurrences[first:last]
+
+
+def simulate_tag(tag, start, end):
+    """
+    Replays the backups of a single tag.
+    :param tag: The tag.
+    :type tag: Tag instance
+    :param start: The start of the period (inclusive), the repository is
+    empty then.
+    :type start: datetime instance
+    :param end: The end of the period (exclusive).
+    :type end: datetime instance
+    :returns: A tuple containing the timestamps of the births of all backups
+    in ascending order and the timestamps of the checks the backups that
+    expired before the end expired in, in the order of their births. They
+    are lists of ints, or NumPy arrays if NumPy is installed.
+    :rtype: tuple
+    :raises: ValueError if the tag thins its backups out to an unknown
+    bucket.
+    """
+    if tag.thinning not in retention.THINNING_BUCKETS + (None,):
+        raise ValueError("Unknown bucket {}.".format(tag.thinning))
+    births = get_occurrences(tag.cron, start, end)
+    # Every rule gives the check a backup expires in by itself, the earliest
+    # one wins. The backups are created in the order of their births, so
+    # every rule only depends on the backups born after a backup:
+    # - Age: The first check after the backup got too old.
+    # - Thinning: The check after the next backup was created, if that one
+    #   falls into the same bucket.
+    # - Count: The check after the first backup of the max_count-th bucket
+    #   after its own was created. The newest backup of a bucket counts as
+    #   kept as soon as it is born, even if a later one replaces it. Without
+    #   thinning, every backup has a bucket of its own. Backups that expire
+    #   by age before are always older, so they do not change that.
+    if numpy is not None:
+        return (births, _get_expiries_numpy(births, tag, end))
+    return (births, _get_expiries_sorted(births, tag, end))
+
+
+def _get_expiries_sorted(births, tag, end):
+    never = retention.to_timestamp(end)
+    count = len(births)
+    expiries = [never] * count
+    if tag.max_age is not None:
+        max_age = int(tag.max_age.total_seconds())
+        expiries = [((birth + max_age) // CHECK_INTERVAL + 1) *
+                    CHECK_INTERVAL for birth in births]
+    # The index of the first backup of every bucket, and the position of
+    # the bucket of every backup in it.
+    firsts = list(range(count))
+    groups = list(range(count))
+    if tag.thinning is not None:
+        buckets = [retention.get_bucket(birth, tag.thinning)
+                   for birth in births]
+        firsts = []
+        groups = []
+        for index in range(count):
+            if index == 0 or buckets[index] != buckets[index - 1]:
+                firsts.append(index)
+            groups.append(len(firsts) - 1)
+        for index in range(count - 1):
+            if buckets[index] == buckets[index + 1]:
+                expiry = births[index + 1] + CHECK_INTERVAL
+                if expiry < expiries[index]:
+                    expiries[index] = expiry
+    if tag.max_count is not None:
+        for index in range(count):
+            group = groups[index] + tag.max_count
+            if group >= len(firsts):
+                continue
+            expiry = births[firsts[group]] + CHECK_INTERVAL
+            if expiry < expiries[index]:
+                expiries[index] = expiry
+    return [expiry for expiry in expiries if expiry < never]
+
+
+def _get_expiries_numpy(births, tag, end):
+    never = retention.to_timestamp(end)
+    count = len(births)
+    expiries = numpy.full(count, never, dtype=numpy.int64)
+    if tag.max_age is not None:
+        max_age = int(tag.max_age.total_seconds())
+        expiries = ((births + max_age) // CHECK_INTERVAL + 1) * CHECK_INTERVAL
+    # See _get_expiries_sorted().
+    firsts = numpy.arange(count)
+    groups = numpy.arange(count)
+    if tag.thinning is not None and count:
+        buckets = retention.get_buckets_numpy(births, tag.thinning)
+        thinned = numpy.flatnonzero(buckets[:-1] == buckets[1:])
+        expiries[thinned] = numpy.minimum(
+            expiries[thinned], births[thinned + 1] + CHECK_INTERVAL)
+        starts = numpy.append(True, buckets[1:] != buckets[:-1])
+        firsts = numpy.flatnonzero(starts)
+        groups = numpy.cumsum(starts) - 1
+    if tag.max_count is not None:
+        counted = numpy.flatnonzero(groups + tag.max_count < len(firsts))
+        expiries[counted] = numpy.minimum(
+            expiries[counted],
+            births[firsts[groups[counted] + tag.max_count]] + CHECK_INTERVAL)
+    return expiries[expiries < never]
+
+
+def simulate(tags, start, end, expiry_counts=None, weight=1):
+    """
+    Replays the backups of a repository.
+    :param tags: The tags of the repository.
+    :type tags: list of Tag instances
+    :param start: The start of the period (inclusive), the repository is
+    empty then.
+    :type start: datetime instance
+    :param end: The end of the period (exclusive).
+    :type end: datetime instance
+    :param expiry_counts: If given, the number of backups expiring in every
+    check is added to it.
+    :type expiry_counts: CheckHistogram instance
+    :param weight: How often the expiries are added to expiry_counts, e.g.
+    the number of repositories with the same tags.
+    :type weight: int
+    :rtype: SimulationResult instance
+    :raises: ValueError if a tag thins its backups out to an unknown bucket.
+    """
+    births = []
+    expiries = []
+    for tag in tags:
+        (tag_births, tag_expiries) = simulate_tag(tag, start, end)
+        births.append(tag_births)
+        expiries.append(tag_expiries)
+    created = sum(len(tag_births) for tag_births in births)
+    origin = (retention.to_timestamp(start) // CHECK_INTERVAL *
+              CHECK_INTERVAL)
+    size = (retention.to_timestamp(end) - origin) // CHECK_INTERVAL + 1
+    if (numpy is not None and
+            (created + sum(len(tag_expiries) for tag_expiries in expiries)) *
+            _DENSE_FRACTION >= size):
+        (peak, peak_time, checks, counts) = _count_on_grid(
+            births, expiries, origin, size)
+    else:
+        (peak, peak_time) = _get_peak(births, expiries)
+        (checks, counts) = _count_expiries(expiries)
+    expired = int(numpy.sum(counts)) if numpy is not None else sum(counts)
+    (burst, burst_time) = (0, None)
+    if len(counts):
+        # The checks are in ascending order, so the first maximum is the
+        # first check with the burst.
+        position = int(numpy.argmax(counts)) if numpy is not None else (
+            counts.index(max(counts)))
+        (burst, burst_time) = (int(counts[position]),
+                               _from_timestamp(int(checks[position])))
+    if expiry_counts is not None:
+        expiry_counts.add(checks, counts, weight)
+    return SimulationResult(
+        created=created, expired=expired, remaining=created - expired,
+        peak=peak, peak_time=peak_time, burst=burst, burst_time=burst_time)
+
+
+def _count_on_grid(births, expiries, origin, size):
+    """
+    Does the work of _get_peak() and _count_expiries() with an array with an
+    element for every check, which is faster than sorting the births and
+    expiries if there are many.
+    :returns: A tuple containing the peak, the time of the peak, the checks
+    with expiries and the number of expiries in every one of them.
+    :rtype: tuple
+    """
+    birth_counts = numpy.zeros(size, dtype=numpy.int64)
+    for tag_births in births:
+        birth_counts += numpy.bincount(
+            (tag_births - origin) // CHECK_INTERVAL, minlength=size)
+    expiry_counts = numpy.zeros(size, dtype=numpy.int64)
+    for tag_expiries in expiries:
+        expiry_counts += numpy.bincount(
+            (tag_expiries - origin) // CHECK_INTERVAL, minlength=size)
+    # Within a check, backups expire before new ones are created, so the
+    # number of backups after every check is all that counts.
+    backups = numpy.cumsum(birth_counts - expiry_counts)
+    position = int(numpy.argmax(backups))
+    (peak, peak_time) = (int(backups[position]), _from_timestamp(
+        origin + position * CHECK_INTERVAL))
+    if peak <= 0:
+        (peak, peak_time) = (0, None)
+    indices = numpy.flatnonzero(expiry_counts)
+    return (peak, peak_time, origin + indices * CHECK_INTERVAL,
+            expiry_counts[indices])
+
+
+def _count_expiries(expiries):
+    """
+    Counts the backups expiring in every check.
+    :param expiries: The expiries of every tag.
+    :type expiries: list of lists of ints, or of NumPy arrays
+    :returns: A tuple containing the checks with expiries in ascending order
+    and the number of expiries in every one of them.
+    :rtype: tuple
+    """
+    if numpy is not None:
+        if not expiries:
+            return (numpy.zeros(0, dtype=numpy.int64),
+                    numpy.zeros(0, dtype=numpy.int64))
+        return numpy.unique(numpy.concatenate(expiries), return_counts=True)
+    counts = collections.Counter(itertools.chain.from_iterable(expiries))
+    checks = sorted(counts)
+    return (checks, [counts[check] for check in checks])
+
+
+def _get_peak(births, expiries):
+    """
+    Returns the maximum number of backups at the same time and the first
+    time it was reached, from the births and expiries of every tag.
+    """
+    # Births and expiries are merged into one sorted list of events. Within
+    # a check, backups expire before new ones are created, so expiries are
+    # encoded as even and births as odd numbers. Births only increase the
+    # number of backups, so the peak is reached right after one.
+    if numpy is not None and births:
+        events = numpy.sort(numpy.concatenate(
+            [tag_births * 2 + 1 for tag_births in births] +
+            [tag_expiries * 2 for tag_expiries in expiries]))
+        if len(events) == 0:
+            return (0, None)
+        counts = numpy.cumsum((events & 1) * 2 - 1)
+        position = int(numpy.argmax(counts))
+        return (int(counts[position]),
+                _from_timestamp(int(events[position]) // 2))
+    events = []
+    for tag_births in births:
+        events.extend([birth * 2 + 1 for birth in tag_births])
+    for tag_expiries in expiries:
+        events.extend([expiry * 2 for expiry in tag_expiries])
+    if len(events) == 0:
+        return (0, None)
+    events.sort()
+    counts = list(itertools.accumulate(
+        [(event & 1) * 2 - 1 for event in events]))
+    peak = max(counts)
+    return (peak, _from_timestamp(events[counts.index(peak)] // 2))
+
+
+def simulate_repositories(repositories, start, end):
+    """
+    Replays the backups of many repositories. Repositories with the same
+    tags are only simulated once.
+    :param repositories: The tags of every repository.
+    :type repositories: list of lists of Tag instances
+    :param start: The start of the period (inclusive).
+    :type start: datetime instance
+    :param end: The end of the period (exclusive).
+    :type end: datetime instance
+    :returns: A tuple containing the result of every repository and the
+    maximum number of backups expiring in a single check over all
+    repositories.
+    :rtype: tuple
+    """
+    results = {}
+    # Repositories with the same tags expire their backups at the same time.
+    counts = collections.Counter()
+    for tags in repositories:
+        counts[tuple(_get_tag_key(tag) for tag in tags)] += 1
+    expiry_counts = CheckHistogram(start, end)
+    for tags in repositories:
+        key = tuple(_get_tag_key(tag) for tag in tags)
+        if key not in results:
+            results[key] = simulate(tags, start, end, expiry_counts,
+                                    counts[key])
+    (burst, _) = expiry_counts.get_maximum()
+    return ([results[tuple(_get_tag_key(tag) for tag in tags)]
+             for tags in repositories], burst)
+
+
+def _get_tag_key(tag):
+    return (tag.cron.cronstring, tag.max_age, tag.max_count, tag.thinning)
+
+
+def _from_timestamp(timestamp):
+    return (datetime.datetime(1970, 1, 1) +
+            datetime.timedelta(seconds=timestamp))
+
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        print("Usage: {} <path to config file> [years]".format(sys.argv[0]))
+        sys.exit(1)
+    years = 10
+    if len(sys.argv) == 3:
+        years = int(sys.argv[2])
+
+    parser = configparser.XMLParser(sys.argv[1])
+    (_, _, c_backups) = parser.parse()
+    names = []
+    repositories = []
+    for (_, c_destination, c_tags, _) in c_backups:
+        tags = []
+        for c_tag in c_tags:
+            c_tag_name = list(c_tag.keys())[0]
+            (c_cron, c_max_age, c_max_count, c_thinning) = \
+                list(c_tag.values())[0]
+            tags.append(backuprepository.Tag(
+                cron=cron.Cronjob(c_cron),
+                max_age=configparser.get_timedelta(c_max_age),
+                max_count=None if c_max_count is None else int(c_max_count),
+                name=c_tag_name,
+                thinning=c_thinning))
+        names.append(c_destination[2])
+        repositories.append(tags)
+
+    start = datetime.datetime.now().replace(second=0, microsecond=0)
+    end = start + datetime.timedelta(days=365 * years)
+    (results, burst) = simulate_repositories(repositories, start, end)
+    for (name, result) in zip(names, results):
+        print("{0}: {1} backups created, {2} expired, {3} left, at most {4} "
+              "at once ({5}), at most {6} expiring at once ({7}).".format(
+                  name, result.created, result.expired, result.remaining,
+                  result.peak, result.peak_time, result.burst,
+                  result.burst_time))
+    print("{0} rsync runs and {1} deletions in {2} years, at most {3} "
+          "deletions at once over all repositories.".format(
+              sum(result.created for result in results),
+              sum(result.expired for result in results), years, burst))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of autobackup.
+#
+# autobackup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autobackup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to account how much space every backup of a repository takes up.
+Backups hardlink unchanged files to older backups, so a file is shared by
+all backups holding it. du either counts it for every backup or only for
+the one it happens to walk first. Here every inode is attributed to the
+oldest backup holding it instead, so the unique bytes of all backups add up
+to the space the repository takes up.
+
+The owner of every inode is kept in the catalog of the repository, so every
+backup is walked only once: inodes that already have an older owner are
+shared with it. When a backup is gone, its inodes are handed on to the
+oldest newer backup still holding them. It is enough to look at the same
+path in the newer backups, as rsync only hardlinks files at the same path.
+
+Only repositories on the local machine can be accounted.
+"""
+
+import bisect
+import os
+
+import catalog
+
+
+# The number of files looked up in the catalog at once.
+_BATCH_SIZE = 10000
+
+# st_blocks is always counted in units of this size.
+_BLOCK_SIZE = 512
+
+
+def account_backup(repository_catalog, repository_path, snapshot):
+    """
+    Walks a backup and records its unique bytes in the catalog. Every inode
+    without an owner or with a newer owner becomes owned by the backup.
+    :param repository_catalog: The catalog of the repository.
+    :type repository_catalog: Catalog instance
+    :param repository_path: The path of the repository.
+    :type repository_path: string
+    :param snapshot: The backup as recorded in the catalog.
+    :type snapshot: Snapshot instance
+    :returns: The unique bytes of the backup.
+    :rtype: int
+    :raises: OSError if the backup cannot be walked.
+    """
+    root = os.path.join(repository_path, snapshot.name)
+    # Directories are never hardlinked, every backup has its own.
+    unique_bytes = _get_size(os.lstat(root))
+    batch = []
+    for (inode, path, size, is_directory) in _walk(root):
+        if is_directory:
+            unique_bytes += size
+            continue
+        batch.append((inode, path, size))
+        if len(batch) >= _BATCH_SIZE:
+            unique_bytes += _claim_inodes(repository_catalog, snapshot,
+                                          batch)
+            batch = []
+    if batch:
+        unique_bytes += _claim_inodes(repository_catalog, snapshot, batch)
+    repository_catalog.update(snapshot.name, unique_bytes=unique_bytes)
+    return unique_bytes
+
+
+def release_inodes(repository_catalog, repository_path, window):
+    """
+    Hands on the inodes of backups that are not in the catalog anymore to
+    the oldest newer backup holding them. Inodes that no backup holds
+    anymore are forgotten.
+    :param repository_catalog: The catalog of the repository.
+    :type repository_catalog: Catalog instance
+    :param repository_path: The path of the repository.
+    :type repository_path: string
+    :param window: The number of newer backups to look for an inode in.
+    Every backup hardlinks to a limited number of older backups, so the
+    first newer backup holding an inode comes soon after its owner.
+    :type window: int
+    :returns: A tuple containing the number of inodes handed on and the
+    number of inodes forgotten.
+    :rtype: tuple
+    """
+    orphans = repository_catalog.get_orphaned_inodes()
+    if not orphans:
+        return (0, 0)
+    snapshots = [snapshot for snapshot in repository_catalog.get_snapshots(
+                     catalog.STATUS_COMPLETE)
+                 if snapshot.unique_bytes is not None]
+    births = [snapshot.birth for snapshot in snapshots]
+    # name -> (snapshot, inodes)
+    released = {}
+    gone = []
+    for orphan in orphans:
+        start = bisect.bisect_left(births, orphan.birth)
+        for snapshot in snapshots[start:start + window]:
+            try:
+                stat = os.lstat(os.path.join(repository_path, snapshot.name,
+                                             orphan.path))
+            except OSError:
+                continue
+            if stat.st_ino == orphan.inode:
+                released.setdefault(snapshot.name, (snapshot, []))[1].append(
+                    (orphan.inode, orphan.path, _get_size(stat)))
+                break
+        else:
+            gone.append(orphan.inode)
+    count = 0
+    for (snapshot, inodes) in released.values():
+        repository_catalog.set_inodes(snapshot.name, snapshot.birth, inodes)
+        count += len(inodes)
+    repository_catalog.remove_inodes(gone)
+    return (count, len(gone))
+
+
+def _claim_inodes(repository_catalog, snapshot, batch):
+    """
+    Makes a backup the owner of the inodes of a batch of its files that are
+    not owned by an older backup.
+    :returns: The number of bytes of the inodes the backup owns.
+    :rtype: int
+    """
+    owners = repository_catalog.get_inodes(
+        [inode for (inode, _, _) in batch])
+    claimed = []
+    unique_bytes = 0
+    for (inode, path, size) in batch:
+        owner = owners.get(inode)
+        if owner is not None and owner.snapshot == snapshot.name:
+            if owner.path == path:
+                # Claimed by an earlier walk that was interrupted.
+                unique_bytes += size
+            # Otherwise hardlinked within the backup and already counted.
+            continue
+        # An owner with another path held an inode number that was freed
+        # and reused since.
+        if (owner is None or owner.path != path or
+                owner.birth > snapshot.birth):
+            claimed.append((inode, path, size))
+            owners[inode] = catalog.Inode(inode, snapshot.name,
+                                          snapshot.birth, path, size)
+            unique_bytes += size
+    repository_catalog.set_inodes(snapshot.name, snapshot.birth, claimed)
+    return unique_bytes
+
+
+def _walk(root):
+    """
+    Walks a directory tree without following symbolic links.
+    :returns: The inode number, the path relative to root, the size and
+    whether it is a directory of everything below root.
+    :rtype: iterator of tuples
+    """
+    stack = [""]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(os.path.join(root, directory)) as entries:
+            for entry in entries:
+                stat = entry.stat(follow_symlinks=False)
+                path = os.path.join(directory, entry.name)
+                is_directory = entry.is_dir(follow_symlinks=False)
+                if is_directory:
+                    stack.append(path)
+                yield (stat.st_ino, path, _get_size(stat), is_directory)
+
+
+def _get_size(stat):
+    """Returns the number of bytes a file occupies, as du counts them."""
+    return stat.st_blocks * _BLOCK_SIZE
@@ -0,0 +1,100 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of autobackup.
+#
+# autobackup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autobackup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compares parsing backup names with datetime.strptime() and with the parser
+of the backuprepository module. Run it from the root of the repository:
+
+python benchmarks/parse_names.py [count]
+"""
+
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "autobackup"))
+
+import backuprepository
+import retention
+
+
+def make_names(count):
+    start = datetime.datetime(2000, 1, 1)
+    tags = [None, "hourly", "daily"]
+    return [backuprepository.make_name(
+                start + datetime.timedelta(minutes=index),
+                tags[index % len(tags)])
+            for index in range(count)]
+
+
+def parse_strptime(names):
+    """The parser as it was before, including the timestamp conversion."""
+    suffix = ".{0}".format(backuprepository.SUFFIX)
+    timestamps = []
+    for name in names:
+        if not name.endswith(suffix):
+            raise ValueError("Invalid extension.")
+        parts = name[:-len(suffix)].split('.', 1)
+        birth = datetime.datetime.strptime(parts[0],
+                                           backuprepository.TIMEFORMAT)
+        timestamps.append(retention.to_timestamp(birth))
+    return timestamps
+
+
+def parse_fast(names):
+    backuprepository._name_cache.clear()
+    return [backuprepository._parse_name(name)[2] for name in names]
+
+
+def parse_cached(names):
+    return backuprepository.get_timestamps(names)
+
+
+def measure(function, names):
+    start = time.time()
+    result = function(names)
+    return (time.time() - start, result)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    names = make_names(count)
+    # The cache is cleared whenever it grows too large, so it only holds
+    # names if they fit.
+    cached_names = names[:backuprepository._NAME_CACHE_SIZE]
+
+    (strptime_time, expected) = measure(parse_strptime, names)
+    (fast_time, result) = measure(parse_fast, names)
+    assert result == expected
+    parse_fast(cached_names)
+    (cached_time, result) = measure(parse_cached, cached_names)
+    assert result == expected[:len(cached_names)]
+
+    print("{0} names".format(count))
+    print("strptime: {0:.2f}s".format(strptime_time))
+    print("fixed offsets: {0:.2f}s ({1:.1f}x)".format(
+        fast_time, strptime_time / fast_time))
+    print("memoized, {0} names: {1:.2f}s ({2:.1f}x)".format(
+        len(cached_names), cached_time,
+        strptime_time * len(cached_names) / count / cached_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,16 @@ import datetime
 import backuprepository
 import filesystem
 import path
+import retention
+
+
+class FakeCron(object):
+
+    def __init__(self, matches=False):
+        self._matches = matches
+
+    def matches(self, date_time):
+        return self._matches
 
 
 class Tests(unittest.TestCase):
@@ -18,11 +28,11 @@ class Tests(unittest.TestCase):
 
     def test_backup_date(self):
         self.assertEqual(
-            self.backup1.birth, datetime.datetime(2010,12,15,21,13,02))
+            self.backup1.birth, datetime.datetime(2010,12,15,21,13,2))
         self.assertEqual(
-            self.backup2.birth, datetime.datetime(2011,03,23,13,59,45))
+            self.backup2.birth, datetime.datetime(2011,3,23,13,59,45))
         self.assertEqual(
-            self.backup3.birth, datetime.datetime(2005,10,01,01,10,30))
+            self.backup3.birth, datetime.datetime(2005,10,1,1,10,30))
 
     def test_wrong_time_format(self):
         self.assertRaises(ValueError,
@@ -47,3 +57,168 @@ class Tests(unittest.TestCase):
                           path.FullLocation(
                               None, None,
                               "error@wrong_in_every_way:fail", None))
+
+    def test_tag(self):
+        backup = backuprepository.Backup(path.FullLocation(
+            None, None, "/whatevsz/2010-12-15T21:13:02.hourly.bak/", None))
+        self.assertEqual(backup.tag, "hourly")
+        self.assertEqual(backup.name, "2010-12-15T21:13:02.hourly.bak")
+        self.assertIsNone(self.backup1.tag)
+        self.assertEqual(
+            backuprepository.make_name(backup.birth, "hourly"), backup.name)
+
+
+class IndexTests(unittest.TestCase):
+
+    def setUp(self):
+        directories = ["2010-12-15T21:13:02.hourly.bak",
+                       "2011-03-23T13:59:45.daily.bak/",
+                       "2005-10-01T01:10:30.hourly.bak",
+                       "2009-01-01T00:00:00.hourly.bak",
+                       "lost+found"]
+        self.hourly = backuprepository.Tag(FakeCron(), None, 2, "hourly")
+        self.daily = backuprepository.Tag(FakeCron(), None, None, "daily")
+        self.repository = backuprepository.BackupRepository(
+            source_locations=[],
+            repository_location=path.FullLocation(None, None, "/backup",
+                                                  None),
+            repository_directories=directories,
+            tags=[self.hourly, self.daily])
+        self.expired = []
+        self.repository.backup_expired += self.expired.append
+
+    def test_sorted(self):
+        births = [backup.birth for backup
+                  in self.repository.get_backups_between()]
+        self.assertEqual(births, sorted(births))
+        self.assertEqual(len(births), 4)
+        self.assertEqual(self.repository._get_latest_backup().tag, "daily")
+        self.assertEqual(
+            self.repository._get_latest_backup("hourly").birth,
+            datetime.datetime(2010,12,15,21,13,2))
+        self.assertEqual(
+            self.repository._get_oldest_backup("hourly").birth,
+            datetime.datetime(2005,10,1,1,10,30))
+
+    def test_range(self):
+        backups = self.repository.get_backups_between(
+            datetime.datetime(2009,1,1), datetime.datetime(2011,1,1))
+        self.assertEqual([backup.birth.year for backup in backups],
+                         [2009, 2010])
+        backups = self.repository.get_backups_between(
+            start=datetime.datetime(2009,1,1), tag="daily")
+        self.assertEqual([backup.birth.year for backup in backups], [2011])
+
+    def test_expire_count(self):
+        self.repository.check_backups()
+        self.assertEqual([location.path for location in self.expired],
+                         ["/backup/2005-10-01T01:10:30.hourly.bak"])
+        self.assertEqual(len(self.repository.backups["hourly"]), 2)
+        self.assertEqual(len(self.repository.get_backups_between()), 3)
+
+    def test_expire_age(self):
+        self.daily.max_age = datetime.timedelta(days=1)
+        self.repository.check_backups()
+        self.assertEqual(len(self.repository.backups["daily"]), 0)
+        self.assertEqual(len(self.expired), 2)
+
+    def test_required(self):
+        self.hourly.cron = FakeCron(matches=True)
+        required = []
+        self.repository.backup_required += (
+            lambda *args: required.append(args))
+        self.repository.check_backups()
+        (_, _, link_backups, new_backup, partial_name) = required[0]
+        self.assertEqual([backup.birth.year for backup in link_backups],
+                         [2011, 2010, 2009])
+        self.assertEqual(new_backup.tag, "hourly")
+        self.assertEqual(self.repository._get_latest_backup().name,
+                         new_backup.name)
+        self.assertIsNone(partial_name)
+
+    def test_partial(self):
+        self.hourly.cron = FakeCron(matches=True)
+        self.hourly.max_count = None
+        required = []
+
+        def fail(*args):
+            required.append(args)
+            raise RuntimeError("rsync died")
+        self.repository.backup_required += fail
+        self.assertRaises(RuntimeError, self.repository.check_backups)
+        failed = backuprepository.get_partial_name(required[0][3].name)
+        # without a catalog, the sources of other partial directories are
+        # unknown, so they are left alone
+        self.repository.reconcile(
+            ["2010-12-15T21:13:02.hourly.bak",
+             "2012-01-01T00:00:00.daily.bak.partial",
+             failed + "/"])
+        self.assertEqual(len(self.repository.get_backups_between()), 1)
+        self.assertRaises(RuntimeError, self.repository.check_backups)
+        self.assertEqual(required[1][4], failed)
+
+
+class SortedBackupsTests(unittest.TestCase):
+
+    def test_equal_births(self):
+        backups = backuprepository._SortedBackups()
+        backups.add(20, 0)
+        backups.add(10, 1)
+        backups.add(20, 1)
+        backups.remove(20, 0)
+        self.assertEqual(list(backups.get_keys()), [(10, 1), (20, 1)])
+        self.assertRaises(ValueError, backups.remove, 20, 0)
+        self.assertEqual(backups.get_range(10, 15), range(0, 1))
+
+    def test_extend(self):
+        added = backuprepository._SortedBackups()
+        extended = backuprepository._SortedBackups()
+        for backups in [added, extended]:
+            backups.add(50, 0)
+            backups.add(10, 0)
+        keys = [((index * 7) % 100, index % 3) for index in range(100)]
+        for (birth, tag_id) in keys:
+            added.add(birth, tag_id)
+        extended.extend(keys)
+        self.assertEqual(list(extended.get_keys()), list(added.get_keys()))
+        # A few backups are inserted, more are appended after the latest.
+        extended.extend([(200, 1), (150, 2)])
+        extended.extend((300 + index, 0) for index in range(20))
+        self.assertEqual(list(extended.births),
+                         sorted(list(added.births) + [150, 200] +
+                                list(range(300, 320))))
+
+
+class ParserTests(unittest.TestCase):
+
+    def test_strict(self):
+        for name in ["2010-12-15 21:13:02.bak",
+                     "2010-12-15T21:13:2.bak",
+                     "2010-12-15T21:13:0a.bak",
+                     "2010-12-15T21:13:٢٢.bak",
+                     "2010-02-30T21:13:02.bak",
+                     "2010-12-15T21:13:02..bak",
+                     "2010-12-15T21:13:02hourly.bak",
+                     "2010-12-15T21:13:02.hourly.bakk",
+                     ".bak"]:
+            self.assertRaises(ValueError, backuprepository._parse_name, name)
+
+    def test_same_as_strptime(self):
+        for name in ["2010-12-15T21:13:02.bak", "1999-01-01T00:00:00.bak",
+                     "2012-02-29T23:59:59.daily.bak"]:
+            (tag, birth, timestamp) = backuprepository._parse_name(name)
+            self.assertEqual(birth, datetime.datetime.strptime(
+                name[:19], backuprepository.TIMEFORMAT))
+            self.assertEqual(timestamp, retention.to_timestamp(birth))
+
+    def test_tag_with_dots(self):
+        (tag, _, _) = backuprepository._parse_name(
+            "2010-12-15T21:13:02.every.hour.bak")
+        self.assertEqual(tag, "every.hour")
+
+    def test_timestamps(self):
+        names = ["2010-12-15T21:13:02.bak", "1970-01-02T00:00:01.daily.bak"]
+        self.assertEqual(backuprepository.get_timestamps(names),
+                         [1292447582, 86401])
+        self.assertRaises(ValueError, backuprepository.get_timestamps,
+                          ["lost+found"])
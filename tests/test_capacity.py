@@ -0,0 +1,153 @@
+import unittest
+import getpass
+import os
+import tempfile
+
+import backuprepository
+import capacity
+import catalog
+import host
+import path
+
+
+class GrowthModelTests(unittest.TestCase):
+
+    def test_no_samples(self):
+        self.assertIsNone(capacity.GrowthModel().predict())
+
+    def test_constant_growth(self):
+        model = capacity.GrowthModel()
+        for _ in range(50):
+            model.add_sample(1000)
+        self.assertAlmostEqual(model.predict(), 1000, delta=10)
+
+    def test_prediction_above_mean(self):
+        model = capacity.GrowthModel()
+        for size in [1000, 3000] * 10:
+            model.add_sample(size)
+        self.assertGreater(model.predict(), 3000)
+
+    def test_adapts_to_growth(self):
+        model = capacity.GrowthModel()
+        for _ in range(20):
+            model.add_sample(1000)
+        for _ in range(20):
+            model.add_sample(100000)
+        self.assertGreater(model.predict(), 90000)
+
+
+class CapacityEstimatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        location = path.Location(getpass.getuser(), host.get_localhost(),
+                                 self.directory)
+        self.estimator = capacity.CapacityEstimator(location)
+
+    def tearDown(self):
+        os.rmdir(self.directory)
+
+    def test_free_space(self):
+        self.assertGreater(self.estimator.get_free_space(), 0)
+
+    def test_will_fit(self):
+        self.assertTrue(self.estimator.will_fit())
+        self.estimator.growth.add_sample(
+            self.estimator.get_free_space() * 2)
+        self.assertFalse(self.estimator.will_fit())
+
+    def test_backup_sample(self):
+        self.estimator.get_free_space()
+        self.estimator.backup_finished(1000)
+        self.assertEqual(self.estimator.growth.samples, 1)
+        self.assertGreaterEqual(self.estimator.growth.predict(), 1000)
+        # Backups of unknown size teach nothing.
+        self.estimator.backup_finished(None)
+        self.assertEqual(self.estimator.growth.samples, 1)
+        self.assertIsNone(self.estimator._free_space)
+
+
+class FakeCapacity(object):
+
+    def __init__(self, log):
+        self.log = log
+        self.free = 0
+        self.growth = capacity.GrowthModel()
+
+    def get_free_space(self, refresh=False):
+        self.log.append("measure")
+        return self.free
+
+    def will_fit(self):
+        return self.free >= 2
+
+    def backup_finished(self, size):
+        self.log.append("finished")
+
+
+class FakeCron(object):
+
+    def matches(self, date_time):
+        return True
+
+
+class RepositoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.log = []
+        self.capacity = FakeCapacity(self.log)
+        self.repository = backuprepository.BackupRepository(
+            source_locations=[],
+            repository_location=path.FullLocation(None, None, "/backup",
+                                                  None),
+            repository_directories=["2010-12-15T21:13:02.hourly.bak",
+                                    "2011-03-23T13:59:45.hourly.bak",
+                                    "2012-01-01T00:00:00.hourly.bak"],
+            tags=[backuprepository.Tag(FakeCron(), None, None, "hourly")],
+            capacity=self.capacity,
+            acquire_destination=lambda location: self.log.append("acquire"),
+            release_destination=lambda location: self.log.append("release"))
+        self.repository.backup_required += (
+            lambda *args: self.log.append("required"))
+
+        def expire(location):
+            self.log.append("expired")
+            self.capacity.free += 1
+        self.repository.backup_expired += expire
+
+    def test_acquire_first(self):
+        self.capacity.free = 2
+        self.repository.check_backups()
+        self.assertEqual(self.log, ["acquire", "measure", "required",
+                                    "finished", "release"])
+
+    def test_expire_for_space(self):
+        self.repository.check_backups()
+        self.assertNotIn("required", self.log)
+        self.assertEqual(self.log[-1], "release")
+        self.repository.expire_for_space = True
+        del self.log[:]
+        self.repository.check_backups()
+        self.assertEqual(self.log.count("expired"), 2)
+        self.assertIn("required", self.log)
+
+    def test_seed_from_catalog(self):
+        repository_catalog = catalog.Catalog(":memory:")
+        for (birth, name, size) in [
+                (1, "2010-12-15T21:13:02.hourly.bak", 1000),
+                (2, "2011-03-23T13:59:45.hourly.bak", None),
+                (3, "2012-01-01T00:00:00.hourly.bak", 3000)]:
+            repository_catalog.add(name, "hourly", birth,
+                                   catalog.STATUS_COMPLETE, size=size)
+        growth = capacity.GrowthModel()
+        self.capacity.growth = growth
+        backuprepository.BackupRepository(
+            source_locations=[],
+            repository_location=path.FullLocation(None, None, "/backup",
+                                                  None),
+            repository_directories=None,
+            tags=[backuprepository.Tag(FakeCron(), None, None, "hourly")],
+            capacity=self.capacity,
+            catalog=repository_catalog)
+        self.assertEqual(growth.samples, 2)
+        self.assertIsNotNone(growth.predict())
@@ -0,0 +1,249 @@
+import unittest
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import backuprepository
+import catalog
+import path
+
+
+class FakeCron(object):
+
+    def __init__(self, matches=False):
+        self._matches = matches
+
+    def matches(self, date_time):
+        return self._matches
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = catalog.Catalog(":memory:")
+
+    def tearDown(self):
+        self.catalog.close()
+
+    def test_add_update(self):
+        self.assertTrue(self.catalog.is_empty())
+        self.catalog.add("b", "hourly", 20, catalog.STATUS_RUNNING)
+        self.catalog.add("a", None, 10, catalog.STATUS_COMPLETE, size=5)
+        self.catalog.update("b", status=catalog.STATUS_COMPLETE,
+                            transferred=100)
+        snapshots = self.catalog.get_snapshots()
+        self.assertEqual([snapshot.name for snapshot in snapshots],
+                         ["a", "b"])
+        self.assertEqual(snapshots[0].size, 5)
+        self.assertEqual(snapshots[1].transferred, 100)
+        self.assertEqual(snapshots[1].status, catalog.STATUS_COMPLETE)
+        self.assertFalse(self.catalog.is_empty())
+
+    def test_latest(self):
+        for birth in range(5):
+            self.catalog.add(str(birth), None, birth, catalog.STATUS_COMPLETE,
+                             sources="a" if birth % 2 else "b")
+        self.catalog.update("3", status=catalog.STATUS_EXPIRED)
+        self.assertEqual(
+            [snapshot.name for snapshot in self.catalog.get_latest_snapshots(
+                2, catalog.STATUS_COMPLETE)],
+            ["4", "2"])
+        self.assertEqual(
+            [snapshot.name for snapshot in self.catalog.get_latest_snapshots(
+                5, catalog.STATUS_COMPLETE, "a")],
+            ["1"])
+
+    def test_migration(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "old.sqlite")
+            connection = sqlite3.connect(path)
+            connection.execute(
+                "CREATE TABLE snapshots (name TEXT PRIMARY KEY, tag TEXT, "
+                "birth INTEGER NOT NULL, status TEXT NOT NULL, size INTEGER, "
+                "transferred INTEGER, duration REAL, fingerprint TEXT)")
+            connection.commit()
+            connection.close()
+            old = catalog.Catalog(path)
+            old.add("a", None, 1, catalog.STATUS_COMPLETE, new_files=3)
+            self.assertEqual(old.get_snapshot("a").new_files, 3)
+            old.update("a", unique_bytes=7)
+            self.assertEqual(old.get_usage_by_tag(), {None: 7})
+            old.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_unknown_column(self):
+        self.assertRaises(ValueError, self.catalog.update, "a",
+                          colour="red")
+
+    def test_reconcile(self):
+        self.catalog.add("a", None, 10, catalog.STATUS_COMPLETE, size=5)
+        self.catalog.add("b", None, 20, catalog.STATUS_EXPIRED)
+        (added, removed) = self.catalog.reconcile(
+            [("a", None, 10), ("c", "daily", 30)])
+        self.assertEqual(added, ["c"])
+        self.assertEqual(removed, ["b"])
+        self.assertEqual(self.catalog.get_snapshot("a").size, 5)
+        self.assertEqual(self.catalog.get_snapshot("c").status,
+                         catalog.STATUS_COMPLETE)
+        self.assertIsNone(self.catalog.get_snapshot("b"))
+
+
+class RepositoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "repository.sqlite")
+        self.tag = backuprepository.Tag(FakeCron(), None, 1, "hourly")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _make_repository(self, directories):
+        return backuprepository.BackupRepository(
+            source_locations=[],
+            repository_location=path.FullLocation(None, None, "/backup",
+                                                  None),
+            repository_directories=directories,
+            tags=[self.tag],
+            catalog=catalog.Catalog(self.path))
+
+    def test_restart(self):
+        repository = self._make_repository(
+            ["2010-12-15T21:13:02.hourly.bak",
+             "2011-03-23T13:59:45.hourly.bak"])
+        repository.check_backups()
+        self.tag.cron = FakeCron(matches=True)
+        repository.backup_required += lambda *args: None
+        repository.check_backups()
+        repository.catalog.close()
+
+        repository = self._make_repository(None)
+        names = [backup.name for backup
+                 in repository.get_backups_between()]
+        # the new backup is created after the old ones have expired
+        self.assertEqual(names[0], "2011-03-23T13:59:45.hourly.bak")
+        self.assertEqual(len(names), 2)
+        self.assertEqual(
+            repository.catalog.get_snapshot(
+                "2010-12-15T21:13:02.hourly.bak").status,
+            catalog.STATUS_EXPIRED)
+        snapshot = repository.catalog.get_snapshot(names[1])
+        self.assertEqual(snapshot.status, catalog.STATUS_COMPLETE)
+        self.assertIsNotNone(snapshot.duration)
+        repository.catalog.close()
+
+    def test_failed_backup(self):
+        repository = self._make_repository([])
+        self.tag.cron = FakeCron(matches=True)
+
+        def fail(*args):
+            raise RuntimeError("rsync died")
+        repository.backup_required += fail
+        self.assertRaises(RuntimeError, repository.check_backups)
+        (snapshot,) = repository.catalog.get_snapshots()
+        self.assertEqual(snapshot.status, catalog.STATUS_FAILED)
+        self.assertEqual(repository.reconcile([snapshot.name]), (0, 0))
+        self.assertEqual(len(repository.get_backups_between()), 0)
+        repository.catalog.close()
+
+    def test_continue_failed_backup(self):
+        repository = self._make_repository([])
+        self.tag.cron = FakeCron(matches=True)
+        required = []
+
+        def fail(*args):
+            required.append(args)
+            raise RuntimeError("connection lost")
+        repository.backup_required += fail
+        self.assertRaises(RuntimeError, repository.check_backups)
+        (failed,) = repository.catalog.get_snapshots()
+        self.assertRaises(RuntimeError, repository.check_backups)
+        self.assertEqual(required[1][4],
+                         backuprepository.get_partial_name(failed.name))
+        repository.catalog.close()
+
+        # after a restart, the newest failed backup is continued
+        repository = self._make_repository(None)
+        repository.backup_required += lambda *args: required.append(args)
+        repository.check_backups()
+        self.assertEqual(
+            required[2][4],
+            backuprepository.get_partial_name(required[1][3].name))
+        repository.catalog.close()
+
+    def test_reconcile_partial(self):
+        repository = self._make_repository([])
+        self.tag.cron = FakeCron(matches=True)
+        required = []
+
+        def fail(*args):
+            required.append(args)
+            raise RuntimeError("connection lost")
+        repository.backup_required += fail
+        self.assertRaises(RuntimeError, repository.check_backups)
+        failed = required[0][3].name
+        repository.catalog.add("2009-01-01T00:00:00.hourly.bak", "hourly", 1,
+                               catalog.STATUS_FAILED, sources="other")
+        repository.reconcile(
+            [backuprepository.get_partial_name(failed),
+             "2009-01-01T00:00:00.hourly.bak.partial"])
+        # the records of the failed backups survive
+        self.assertEqual(
+            [snapshot.name for snapshot in repository.catalog.get_snapshots()],
+            ["2009-01-01T00:00:00.hourly.bak", failed])
+        # but only the backup of the same sources is continued
+        self.assertEqual(repository._partials,
+                         [backuprepository.get_partial_name(failed)])
+        self.assertRaises(RuntimeError, repository.check_backups)
+        self.assertEqual(required[1][4],
+                         backuprepository.get_partial_name(failed))
+        repository.catalog.close()
+
+    def test_link_candidates(self):
+        repository = self._make_repository(
+            ["2010-12-15T21:13:02.hourly.bak",
+             "2011-03-23T13:59:45.daily.bak"])
+        self.tag.cron = FakeCron(matches=True)
+        self.tag.max_count = None
+        created = []
+
+        def create(repository_location, source_locations, link_backups,
+                   new_backup, partial_name):
+            new_backup.transferred = 1024
+            new_backup.new_files = 2
+            new_backup.fingerprint = "0a1b"
+            created.append(new_backup)
+        repository.backup_required += create
+        repository.check_backups()
+        self.assertEqual(
+            [backup.name for backup in repository.get_link_candidates(2)],
+            [created[0].name, "2011-03-23T13:59:45.daily.bak"])
+        # backups of the same sources come first
+        repository.catalog.update("2010-12-15T21:13:02.hourly.bak",
+                                  sources="old")
+        repository._sources = "old"
+        self.assertEqual(
+            [backup.name for backup in repository.get_link_candidates()],
+            ["2010-12-15T21:13:02.hourly.bak", created[0].name,
+             "2011-03-23T13:59:45.daily.bak"])
+        snapshot = repository.catalog.get_snapshot(created[0].name)
+        self.assertEqual((snapshot.transferred, snapshot.new_files), (1024, 2))
+        self.assertEqual(snapshot.fingerprint, "0a1b")
+        self.assertEqual(snapshot.sources, "")
+        repository.catalog.close()
+
+    def test_reconcile(self):
+        repository = self._make_repository(
+            ["2010-12-15T21:13:02.hourly.bak"])
+        self.assertEqual(
+            repository.reconcile(["2011-03-23T13:59:45.hourly.bak",
+                                  "lost+found"]),
+            (1, 1))
+        self.assertEqual(
+            [snapshot.name for snapshot
+             in repository.catalog.get_snapshots()],
+            ["2011-03-23T13:59:45.hourly.bak"])
+        repository.catalog.close()
@@ -0,0 +1,41 @@
+import unittest
+import os
+
+import backuprepository
+import configparser
+import cron
+import retention
+
+
+_EXAMPLE_CONFIG = os.path.join(os.path.dirname(__file__), "..", "config",
+                               "xml", "config.example.xml")
+
+
+class Tests(unittest.TestCase):
+
+    def test_example_config(self):
+        parser = configparser.XMLParser(_EXAMPLE_CONFIG)
+        (hosts, devices, backups) = parser.parse()
+        self.assertEqual(len(backups), 1)
+        for (sources, destination, tags, expire_for_space) in backups:
+            self.assertEqual(len(sources), 2)
+            self.assertEqual(expire_for_space, "true")
+            self.assertEqual(len(tags), 3)
+            for tag in tags:
+                (name, (c_cron, c_max_age, c_max_count, c_thinning)) = list(
+                    tag.items())[0]
+                # Everything the example sets has to be accepted.
+                backuprepository.Tag(
+                    cron=cron.Cronjob(c_cron),
+                    max_age=configparser.get_timedelta(c_max_age),
+                    max_count=(None if c_max_count is None
+                               else int(c_max_count)),
+                    name=name, thinning=c_thinning)
+                self.assertIn(c_thinning,
+                              retention.THINNING_BUCKETS + (None,))
+
+    def test_timedelta(self):
+        self.assertEqual(configparser.get_timedelta("_12h").total_seconds(),
+                         12 * 3600)
+        self.assertIsNone(configparser.get_timedelta(None))
+        self.assertRaises(ValueError, configparser.get_timedelta, "_12x")
@@ -104,3 +104,15 @@ class Tests(unittest.TestCase):
         for d in self.d_all:
             self.assertEqual(self.c1.has_occured_between(d, d),
                              self.c1.matches(d))
+
+    def test_zero(self):
+        hourly = cron.Cronjob("0 * * * * *")
+        self.assertTrue(hourly.matches(datetime.datetime(2014, 8, 7, 23, 0)))
+        self.assertFalse(hourly.matches(datetime.datetime(2014, 8, 7, 23, 1)))
+        self.assertEqual(cron.Cronjob("0-2 0 * * * *").schedule[0],
+                         {0, 1, 2})
+
+    def test_out_of_range(self):
+        for cronstring in ["0 0 0 0 * *", "60 * * * * *", "0 0-24 * * * *",
+                           "0 0 1 13 * *"]:
+            self.assertRaises(cron.ParseError, cron.Cronjob, cronstring)
@@ -0,0 +1,108 @@
+import unittest
+import getpass
+import os
+import shutil
+import tempfile
+import time
+
+import deletion
+import host
+import process
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tree = os.path.join(self.directory, "2010-12-15T21:13:02.bak")
+        self.outside = os.path.join(self.directory, "outside")
+        with open(self.outside, "w") as outside:
+            outside.write("keep")
+        os.makedirs(os.path.join(self.tree, "a", "b"))
+        os.mkdir(os.path.join(self.tree, "c"))
+        for name in ["1", "a/2", "a/b/3", "c/4"]:
+            with open(os.path.join(self.tree, name), "w") as new_file:
+                new_file.write(name)
+        # hardlinks and symlinks are unlinked, their targets are kept
+        os.link(self.outside, os.path.join(self.tree, "a", "hardlink"))
+        os.symlink(self.outside, os.path.join(self.tree, "symlink"))
+        os.symlink(self.directory, os.path.join(self.tree, "c", "dirlink"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_delete(self):
+        (finished, progress) = deletion.delete_tree(self.tree, threads=2)
+        self.assertTrue(finished)
+        self.assertEqual(progress.files, 7)
+        self.assertEqual(progress.directories, 4)
+        self.assertEqual(os.listdir(self.directory), ["outside"])
+        with open(self.outside) as outside:
+            self.assertEqual(outside.read(), "keep")
+
+    def test_resume(self):
+        (finished, first) = deletion.delete_tree(self.tree, time_limit=0)
+        self.assertFalse(finished)
+        deleting_path = deletion.get_deleting_path(self.tree)
+        self.assertFalse(os.path.lexists(self.tree))
+        self.assertTrue(os.path.isdir(deleting_path))
+
+        # the original path resumes the deletion
+        (finished, second) = deletion.delete_tree(self.tree)
+        self.assertTrue(finished)
+        self.assertEqual(first.files + second.files, 7)
+        self.assertEqual(first.directories + second.directories, 4)
+        self.assertEqual(sorted(os.listdir(self.directory)), ["outside"])
+
+    def test_resume_slices(self):
+        # a tree that cannot be walked within a single call
+        for name in ["d/e/f", "d/g", "h/i"]:
+            os.makedirs(os.path.join(self.tree, name))
+            with open(os.path.join(self.tree, name, "file"), "w") as new_file:
+                new_file.write(name)
+        files = 0
+        directories = 0
+        for _ in range(20):
+            (finished, progress) = deletion.delete_tree(self.tree,
+                                                        time_limit=0)
+            # every call removes at least one directory
+            self.assertGreater(progress.directories, 0)
+            files += progress.files
+            directories += progress.directories
+            if finished:
+                break
+        self.assertTrue(finished)
+        self.assertEqual((files, directories), (10, 10))
+        self.assertEqual(os.listdir(self.directory), ["outside"])
+
+    def test_resume_before_same_name(self):
+        (_, first) = deletion.delete_tree(self.tree, time_limit=0)
+        os.mkdir(self.tree)
+        (finished, second) = deletion.delete_tree(self.tree)
+        self.assertTrue(finished)
+        self.assertEqual(first.directories + second.directories, 5)
+        self.assertEqual(os.listdir(self.directory), ["outside"])
+
+    def test_missing(self):
+        (finished, progress) = deletion.delete_tree(
+            os.path.join(self.directory, "missing"))
+        self.assertTrue(finished)
+        self.assertEqual(progress.files + progress.directories, 0)
+
+    def test_rate(self):
+        start = time.time()
+        (finished, progress) = deletion.delete_tree(self.tree, rate=40)
+        self.assertTrue(finished)
+        # 11 operations, the first batch is free
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+    def test_deleting_path(self):
+        self.assertTrue(deletion.is_deleting_path(
+            deletion.get_deleting_path("/backup/2010-12-15T21:13:02.bak/")))
+        self.assertFalse(deletion.is_deleting_path(self.tree))
+
+    def test_localhost(self):
+        progress = process.func_delete_tree(host.get_localhost(),
+                                            getpass.getuser(), self.tree)
+        self.assertEqual(progress.files, 7)
+        self.assertEqual(os.listdir(self.directory), ["outside"])
@@ -0,0 +1,124 @@
+import unittest
+import getpass
+import os
+import shutil
+import tempfile
+
+import backuprepository
+import catalog
+import dirwatch
+import host
+import path
+import process
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.watcher = dirwatch.DirectoryWatcher(host.get_localhost(), None,
+                                                 self.directory)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.directory)
+
+    def test_first_check(self):
+        self.assertTrue(self.watcher.has_changed())
+        self.watcher.acknowledge()
+        self.assertFalse(self.watcher.has_changed())
+
+    def test_changes(self):
+        self.watcher.has_changed()
+        self.watcher.acknowledge()
+        os.mkdir(os.path.join(self.directory, "new"))
+        self.assertTrue(self.watcher.has_changed())
+        # not acknowledged, so the change is reported again
+        self.assertTrue(self.watcher.has_changed())
+        self.watcher.acknowledge()
+        self.assertFalse(self.watcher.has_changed())
+        os.rename(os.path.join(self.directory, "new"),
+                  os.path.join(self.directory, "old"))
+        self.assertTrue(self.watcher.has_changed())
+
+    def test_change_during_listing(self):
+        self.watcher.has_changed()
+        os.mkdir(os.path.join(self.directory, "new"))
+        self.watcher.acknowledge()
+        self.assertTrue(self.watcher.has_changed())
+
+    def test_without_inotify(self):
+        self.watcher.close()
+        self.watcher.has_changed()
+        self.watcher.acknowledge()
+        self.assertFalse(self.watcher.has_changed())
+        os.mkdir(os.path.join(self.directory, "new"))
+        self.assertTrue(self.watcher.has_changed())
+
+    def test_restart(self):
+        self.watcher.has_changed()
+        self.watcher.acknowledge()
+        watcher = dirwatch.DirectoryWatcher(host.get_localhost(), None,
+                                            self.directory,
+                                            state=self.watcher.state)
+        self.assertFalse(watcher.has_changed())
+        watcher.close()
+
+    def test_missing_directory(self):
+        watcher = dirwatch.DirectoryWatcher(
+            host.get_localhost(), None,
+            os.path.join(self.directory, "missing"))
+        self.assertTrue(watcher.has_changed())
+        watcher.acknowledge()
+        self.assertTrue(watcher.has_changed())
+        watcher.close()
+
+    def test_file_state(self):
+        self.assertEqual(
+            process.func_get_file_state(host.get_localhost(),
+                                        getpass.getuser(), self.directory),
+            process.func_get_file_state(host.get_localhost(),
+                                        getpass.getuser(), self.directory))
+
+
+class RepositoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, "2010-12-15T21:13:02.bak"))
+        # The journal of the catalog would change the repository.
+        self.catalog_directory = tempfile.mkdtemp()
+        self.catalog_path = os.path.join(self.catalog_directory,
+                                         "catalog.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.catalog_directory)
+
+    def _make_repository(self, directories):
+        return backuprepository.BackupRepository(
+            source_locations=[],
+            repository_location=path.FullLocation(
+                getpass.getuser(), host.get_localhost(), self.directory,
+                None),
+            repository_directories=directories,
+            tags=[],
+            catalog=catalog.Catalog(self.catalog_path),
+            watcher=dirwatch.DirectoryWatcher(host.get_localhost(), None,
+                                              self.directory))
+
+    def test_rescan(self):
+        repository = self._make_repository([])
+        self.assertEqual(repository.rescan(), (1, 0))
+        self.assertEqual(repository.rescan(), (0, 0))
+        os.mkdir(os.path.join(self.directory, "2011-03-23T13:59:45.bak"))
+        self.assertEqual(repository.rescan(), (1, 0))
+        repository.watcher.close()
+        repository.catalog.close()
+
+        # the state of the directory survives a restart
+        repository = self._make_repository(None)
+        self.assertFalse(repository.watcher.has_changed())
+        self.assertEqual(len(repository.get_backups_between()), 2)
+        repository.watcher.close()
+        repository.catalog.close()
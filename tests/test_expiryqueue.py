@@ -0,0 +1,173 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+
+import backuprepository
+import catalog
+import deletion
+import expiryqueue
+import filesystem
+import host
+import path
+import process
+
+
+class FakeCron(object):
+
+    def matches(self, date_time):
+        return False
+
+
+def make_location(location_path, uuid=None):
+    device = None
+    if uuid is not None:
+        device = filesystem.Device(host.get_localhost(), uuid, "ext4", None)
+    return path.FullLocation(None, host.get_localhost(), location_path,
+                             device)
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.deleted = []
+        self.release = threading.Event()
+
+    def delete(self, location):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        self.release.wait(5)
+        with self.lock:
+            self.running -= 1
+            self.deleted.append(location.path)
+        if location.path.endswith("fail"):
+            raise process.ProcessError(1, "", "failed")
+
+    def test_deduplication(self):
+        queue = expiryqueue.ExpiryQueue(self.delete)
+        self.assertTrue(queue.put(make_location("/backup/a.bak")))
+        self.assertFalse(queue.put(make_location("/backup/a.bak/")))
+        self.assertFalse(queue.put(make_location(
+            deletion.get_deleting_path("/backup/a.bak"))))
+        self.assertTrue(queue.put(make_location("/backup/b.bak")))
+        self.assertEqual(queue.get_pending_count(), 2)
+        self.release.set()
+        queue.start()
+        self.assertTrue(queue.join(5))
+        queue.stop()
+        self.assertEqual(sorted(self.deleted),
+                         ["/backup/a.bak", "/backup/b.bak"])
+
+    def test_per_device_limit(self):
+        queue = expiryqueue.ExpiryQueue(self.delete, workers=4,
+                                        max_per_device=2)
+        for name in ["a", "b", "c", "d"]:
+            queue.put(make_location("/backup/" + name, uuid="1"))
+        queue.put(make_location("/other/e", uuid="2"))
+        queue.start()
+        self.assertFalse(queue.join(0.2))
+        self.assertEqual(self.max_running, 3)
+        self.release.set()
+        self.assertTrue(queue.join(5))
+        queue.stop()
+        self.assertEqual(len(self.deleted), 5)
+
+    def test_callback(self):
+        results = []
+        queue = expiryqueue.ExpiryQueue(self.delete)
+        queue.put(make_location("/backup/fail"),
+                  lambda location, error: results.append(error))
+        queue.put(make_location("/backup/ok"),
+                  lambda location, error: results.append(error))
+        self.release.set()
+        queue.start()
+        queue.join(5)
+        queue.stop()
+        self.assertEqual(len(results), 2)
+        self.assertEqual(
+            len([error for error in results
+                 if isinstance(error, process.ProcessError)]), 1)
+
+    def test_worker_survives(self):
+        results = []
+
+        def delete(location):
+            raise RuntimeError("unexpected")
+
+        def callback(location, error):
+            results.append(error)
+            raise RuntimeError("unexpected")
+
+        queue = expiryqueue.ExpiryQueue(delete, workers=1)
+        queue.put(make_location("/backup/a"), callback)
+        queue.put(make_location("/backup/b"), callback)
+        queue.start()
+        self.assertTrue(queue.join(5))
+        queue.stop()
+        self.assertEqual(len(results), 2)
+        self.assertIsInstance(results[0], RuntimeError)
+
+
+class RepositoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.names = ["2010-12-15T21:13:02.hourly.bak",
+                      "2011-03-23T13:59:45.hourly.bak",
+                      "2012-01-01T00:00:00.hourly.bak"]
+        for name in self.names:
+            os.makedirs(os.path.join(self.directory, name, "data"))
+        self.catalog = catalog.Catalog(":memory:")
+        self.queue = expiryqueue.ExpiryQueue(self.delete)
+        self.tag = backuprepository.Tag(FakeCron(), None, 1, "hourly")
+
+    def tearDown(self):
+        self.queue.stop()
+        self.catalog.close()
+        shutil.rmtree(self.directory)
+
+    def delete(self, location):
+        deletion.delete_tree(location.path)
+
+    def _make_repository(self, directories):
+        return backuprepository.BackupRepository(
+            source_locations=[],
+            repository_location=make_location(self.directory),
+            repository_directories=directories,
+            tags=[self.tag],
+            catalog=self.catalog,
+            expiry_queue=self.queue)
+
+    def test_background(self):
+        repository = self._make_repository(self.names)
+        repository.check_backups()
+        # only queued so far
+        self.assertEqual(self.queue.get_pending_count(), 2)
+        self.assertEqual(len(repository.get_backups_between()), 1)
+        self.assertEqual(
+            len(self.catalog.get_snapshots(catalog.STATUS_EXPIRED)), 2)
+
+        self.queue.start()
+        self.assertTrue(self.queue.join(5))
+        self.assertEqual(os.listdir(self.directory), [self.names[2]])
+        self.assertEqual([snapshot.name for snapshot
+                          in self.catalog.get_snapshots()], [self.names[2]])
+
+    def test_resume(self):
+        repository = self._make_repository(self.names)
+        repository.check_backups()
+        # restart before anything was deleted, with one deletion interrupted
+        self.queue = expiryqueue.ExpiryQueue(self.delete)
+        os.rename(os.path.join(self.directory, self.names[0]),
+                  deletion.get_deleting_path(
+                      os.path.join(self.directory, self.names[0])))
+        repository = self._make_repository(os.listdir(self.directory))
+        self.assertEqual(self.queue.get_pending_count(), 2)
+        self.queue.start()
+        self.assertTrue(self.queue.join(5))
+        self.assertEqual(os.listdir(self.directory), [self.names[2]])
@@ -1,3 +1,232 @@
+import unittest
+import getpass
+import threading
+
+import filesystem
+import host
+
+
+_MOUNTINFO = (
+    "22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n"
+    "36 22 8:17 / /media/backup rw,noatime shared:2 master:1 - ext4 "
+    "/dev/sdb1 rw,errors=remount-ro\n"
+    "37 22 8:17 /sub /media/with\\040space rw - ext4 /dev/sdb1 rw\n"
+    "38 36 0:42 / /media/backup rw - tmpfs tmpfs rw\n"
+    "\n")
+
+
+_LSBLK = (
+    'UUID="" NAME="/dev/sda" SIZE="500107862016" FSTYPE=""\n'
+    'UUID="c3a1cc6b-56f4-4822-a768-bd7d11ad0663" NAME="/dev/sda1" '
+    'SIZE="500106813440" FSTYPE="ext4"\n'
+    'UUID="1F2E-3D4C" NAME="/dev/sdb1" SIZE="" FSTYPE="vfat"\n')
+
+
+class DeviceInventoryTests(unittest.TestCase):
+
+    def test_parse_lsblk(self):
+        devices = filesystem._parse_lsblk(_LSBLK)
+        self.assertEqual(len(devices), 2)
+        self.assertEqual(devices[0].uuid,
+                         "c3a1cc6b-56f4-4822-a768-bd7d11ad0663")
+        self.assertEqual(devices[0].device_file, "/dev/sda1")
+        self.assertEqual(devices[0].size, 500106813440)
+        self.assertEqual(devices[0].filesystem, "ext4")
+        self.assertEqual(devices[1].size, 0)
+
+    def test_shared_inventory(self):
+        inventory = filesystem.get_device_inventory(host.get_localhost(),
+                                                    getpass.getuser())
+        self.assertIs(inventory, filesystem.get_device_inventory(
+            host.Host(ip="127.0.0.2"), getpass.getuser()))
+        device = filesystem.Device(host=host.get_localhost(), uuid="lelly",
+                                   filesystem="ext4", user=getpass.getuser())
+        self.assertFalse(device.is_available())
+        self.assertTrue(inventory.is_valid())
+        inventory.invalidate()
+        self.assertFalse(inventory.is_valid())
+
+    def test_invalidate_while_reading(self):
+        inventory = filesystem.DeviceInventory(host.get_localhost(),
+                                               getpass.getuser())
+        refresh = inventory._refresh
+        threads = []
+
+        def refresh_and_invalidate():
+            refresh()
+            # Another thread invalidates the inventory right after it was
+            # read.
+            thread = threading.Thread(target=inventory.invalidate)
+            thread.start()
+            thread.join(0.1)
+            threads.append(thread)
+
+        inventory._refresh = refresh_and_invalidate
+        self.assertIsNone(inventory.get_device("lelly"))
+        threads[0].join()
+        self.assertFalse(inventory.is_valid())
+
+
+class MountinfoTests(unittest.TestCase):
+
+    def test_parse_fields(self):
+        entries = filesystem._parse_mountinfo(_MOUNTINFO)
+        self.assertEqual(len(entries), 4)
+        self.assertEqual(entries[1].mount_id, 36)
+        self.assertEqual(entries[1].parent_id, 22)
+        self.assertEqual(entries[1].mountpoint, "/media/backup")
+        self.assertEqual(entries[1].options, ("rw", "noatime"))
+        self.assertEqual(entries[1].fstype, "ext4")
+        self.assertEqual(entries[1].source, "/dev/sdb1")
+        self.assertEqual(entries[1].super_options,
+                         ("rw", "errors=remount-ro"))
+
+    def test_parse_escaped_path(self):
+        entries = filesystem._parse_mountinfo(_MOUNTINFO)
+        self.assertEqual(entries[2].mountpoint, "/media/with space")
+        self.assertEqual(entries[2].root, "/sub")
+
+    def test_parse_malformed(self):
+        self.assertRaises(ValueError, filesystem._parse_mountinfo,
+                          "22 1 8:1 / / rw ext4 /dev/sda1 rw")
+
+    def test_index(self):
+        table = filesystem.MountTable(host.get_localhost(), getpass.getuser())
+        self.addCleanup(table.close)
+        table._set_entries(filesystem._parse_mountinfo(_MOUNTINFO))
+        self.assertEqual(len(table.get_entries_by_source("/dev/sdb1")), 2)
+        self.assertEqual(table.get_entries_by_source("/dev/sdc1"), [])
+        # The tmpfs is stacked on top of the device.
+        self.assertEqual(
+            table.get_entry_by_mountpoint("/media/backup/").fstype, "tmpfs")
+        self.assertEqual(table.get_entry_by_mountpoint("/").source,
+                         "/dev/sda1")
+        self.assertIsNone(table.get_entry_by_mountpoint("/media"))
+
+    def test_invalidate(self):
+        table = filesystem.MountTable(host.get_localhost(), getpass.getuser())
+        self.addCleanup(table.close)
+        self.assertFalse(table.is_valid())
+        table._set_entries(filesystem._parse_mountinfo(_MOUNTINFO))
+        self.assertTrue(table.is_valid())
+        table.invalidate()
+        self.assertFalse(table.is_valid())
+
+    def test_watched_table(self):
+        table = filesystem.MountTable(host.get_localhost(), getpass.getuser())
+        self.addCleanup(table.close)
+        self.assertIsNotNone(table._watcher)
+        self.assertFalse(table._watcher.has_changed())
+        table.refresh()
+        # A watched table does not expire, only a change or an explicit
+        # invalidation makes it stale.
+        table._read_time = 0
+        self.assertTrue(table.is_valid())
+        table.invalidate()
+        self.assertFalse(table.is_valid())
+
+    def test_close(self):
+        table = filesystem.MountTable(host.get_localhost(), getpass.getuser())
+        watcher = table._watcher
+        table.refresh()
+        table.close()
+        self.assertTrue(watcher._file.closed)
+        # The table falls back to expiring.
+        self.assertIsNone(table._watcher)
+        self.assertNotEqual(table.get_entries(), [])
+        table.close()
+
+    def test_unwatched_table(self):
+        table = filesystem.MountTable(host.Host(ip="192.0.2.1"),
+                                      getpass.getuser())
+        self.assertIsNone(table._watcher)
+        table._set_entries(filesystem._parse_mountinfo(_MOUNTINFO))
+        self.assertTrue(table.is_valid())
+        table._read_time = 0
+        self.assertFalse(table.is_valid())
+
+    def test_invalidate_while_reading(self):
+        table = filesystem.MountTable(host.get_localhost(), getpass.getuser())
+        self.addCleanup(table.close)
+        set_entries = table._set_entries
+        threads = []
+
+        def set_entries_and_invalidate(entries):
+            set_entries(entries)
+            # Another thread invalidates the table right after it was read.
+            thread = threading.Thread(target=table.invalidate)
+            thread.start()
+            thread.join(0.1)
+            threads.append(thread)
+
+        table._set_entries = set_entries_and_invalidate
+        self.assertNotEqual(table.get_entries(), [])
+        threads[0].join()
+        self.assertFalse(table.is_valid())
+
+    def test_shared_table(self):
+        localhost = host.get_localhost()
+        table = filesystem.get_mount_table(localhost, getpass.getuser())
+        self.assertIs(table, filesystem.get_mount_table(
+            host.Host(ip="127.0.0.2"), getpass.getuser()))
+        mountpoint = filesystem.Mountpoint(host=localhost, path="/proc/",
+                                           options=(),
+                                           create_if_not_existent=False,
+                                           user=getpass.getuser())
+        self.assertTrue(mountpoint.is_active())
+        filesystem.invalidate_mount_table(localhost)
+        self.assertFalse(table.is_valid())
+
+
+class FakeDevice(filesystem.Device):
+
+    def is_available(self):
+        return True
+
+    def is_mounted(self):
+        return False
+
+
+class FakeMountpoint(filesystem.Mountpoint):
+
+    def exists(self):
+        return True
+
+    def is_active(self):
+        return False
+
+    def is_empty(self):
+        return True
+
+
+class DeviceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.commands = []
+        self.mountpoint_class = filesystem.Mountpoint
+        self.execute_mount_command = filesystem._execute_mount_command
+        # The temporary mountpoints are created by Device.mount() itself.
+        filesystem.Mountpoint = FakeMountpoint
+        filesystem._execute_mount_command = (
+            lambda mount_host, args, user: self.commands.append(args))
+
+    def tearDown(self):
+        filesystem.Mountpoint = self.mountpoint_class
+        filesystem._execute_mount_command = self.execute_mount_command
+
+    def test_temporary_mountpoints(self):
+        remotehost = host.Host(ip="192.0.2.1")
+        for uuid in ("a", "b"):
+            device = FakeDevice(remotehost, uuid, "ext4", "backup")
+            device.mount(FakeMountpoint(host.get_localhost(),
+                                        "/media/{0}".format(uuid), (),
+                                        False, "backup"))
+        sources = [args[1] for args in self.commands if args[0] == "sshfs"]
+        self.assertEqual(sources,
+                         ["backup@192.0.2.1:/home/backup/mnt/tmp/a/",
+                          "backup@192.0.2.1:/home/backup/mnt/tmp/b/"])
+
+
 #import getpass
 
 
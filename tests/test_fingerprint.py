@@ -0,0 +1,96 @@
+import unittest
+import getpass
+import os
+import shutil
+import tempfile
+import time
+
+import fingerprint
+import host
+import process
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tree = os.path.join(self.directory, "source")
+        os.makedirs(os.path.join(self.tree, "a", "b"))
+        for name in ["1", "a/2", "a/b/3"]:
+            self._write(name, name)
+        os.symlink(self.directory, os.path.join(self.tree, "link"))
+        self.fingerprint = fingerprint.get_fingerprint(self.tree)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, content):
+        with open(os.path.join(self.tree, name), "w") as new_file:
+            new_file.write(content)
+
+    def _assert_changed(self):
+        self.assertNotEqual(fingerprint.get_fingerprint(self.tree),
+                            self.fingerprint)
+
+    def test_unchanged(self):
+        self.assertEqual(fingerprint.get_fingerprint(self.tree),
+                         self.fingerprint)
+        # reading does not change anything
+        with open(os.path.join(self.tree, "a", "b", "3")) as existing:
+            existing.read()
+        self.assertEqual(fingerprint.get_fingerprint(self.tree),
+                         self.fingerprint)
+
+    def test_content(self):
+        stat = os.stat(os.path.join(self.tree, "a", "b", "3"))
+        # the change time is updated even if the modification time is reset
+        time.sleep(0.01)
+        self._write("a/b/3", "x")
+        os.utime(os.path.join(self.tree, "a", "b", "3"),
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self._assert_changed()
+
+    def test_deleted(self):
+        os.unlink(os.path.join(self.tree, "a", "2"))
+        self._assert_changed()
+
+    def test_renamed(self):
+        os.rename(os.path.join(self.tree, "a", "b", "3"),
+                  os.path.join(self.tree, "a", "b", "4"))
+        self._assert_changed()
+
+    def test_time_limit(self):
+        self.assertIsNone(fingerprint.get_fingerprint(self.tree,
+                                                      time_limit=-1))
+
+    def test_combine(self):
+        first = fingerprint.combine([("/a", "1"), ("/b", "2")])
+        self.assertEqual(first, fingerprint.combine([("/a", "1"),
+                                                     ("/b", "2")]))
+        self.assertNotEqual(first, fingerprint.combine([("/a", "1"),
+                                                        ("/c", "2")]))
+        self.assertIsNone(fingerprint.combine([("/a", "1"), ("/b", None)]))
+
+    def test_process(self):
+        self.assertEqual(process.func_get_fingerprint(
+            host.get_localhost(), getpass.getuser(), self.tree),
+            self.fingerprint)
+        with self.assertRaises(process.ProcessError):
+            process.func_get_fingerprint(
+                host.get_localhost(), getpass.getuser(),
+                os.path.join(self.directory, "missing"))
+        self.assertIsNone(process.func_get_fingerprint(
+            host.get_localhost(), getpass.getuser(), self.tree,
+            time_limit=-1))
+
+    def test_clone(self):
+        clone = os.path.join(self.directory, "clone")
+        process.func_clone_tree(host.get_localhost(), getpass.getuser(),
+                                self.tree, clone)
+        self.assertEqual(os.stat(os.path.join(clone, "a", "b", "3")).st_ino,
+                         os.stat(os.path.join(self.tree, "a", "b",
+                                              "3")).st_ino)
+        self.assertTrue(os.path.islink(os.path.join(clone, "link")))
+        # hardlinking changes the change time of the files
+        self.assertNotEqual(fingerprint.get_fingerprint(clone),
+                            self.fingerprint)
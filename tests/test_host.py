@@ -33,3 +33,7 @@ class TestCases(unittest.TestCase):
         self.assertRaises(NotImplementedError, self.localhost_ip.get_real_ip)
         self.assertEqual(
             self.remotehost_ip.ip, self.remotehost_ip.get_real_ip())
+
+    def test_key(self):
+        self.assertEqual(Host(ip="127.0.0.1").key, Host(ip="127.53.1.245").key)
+        self.assertEqual(self.remotehost_ip.key, "192.0.0.1")
@@ -0,0 +1,125 @@
+import unittest
+import getpass
+import threading
+import time
+
+import filesystem
+import host
+import jobexecutor
+import process
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.max_running = {}
+        self.order = []
+        self.release = threading.Event()
+        self.executor = jobexecutor.JobExecutor(workers=4, max_per_host=2,
+                                                max_per_device=1)
+
+    def tearDown(self):
+        self.release.set()
+        self.executor.stop(cancel=True)
+
+    def _make_function(self, name, group):
+        def function():
+            with self.lock:
+                self.running[group] = self.running.get(group, 0) + 1
+                self.max_running[group] = max(self.max_running.get(group, 0),
+                                              self.running[group])
+                self.order.append(name)
+            self.release.wait(5)
+            with self.lock:
+                self.running[group] -= 1
+            return name
+        return function
+
+    def test_per_host_limit(self):
+        remote = host.Host(ip="192.168.0.2")
+        for name in ["a", "b", "c"]:
+            self.executor.submit(self._make_function(name, "remote"),
+                                 hosts=[remote, host.get_localhost()])
+        self.executor.submit(self._make_function("d", "local"),
+                             hosts=[host.get_localhost()])
+        self.executor.start()
+        self.assertFalse(self.executor.join(0.2))
+        # the local host is full with two remote backups reading from it too
+        self.assertEqual(self.max_running, {"remote": 2})
+        self.release.set()
+        self.assertTrue(self.executor.join(5))
+        self.assertEqual(sorted(self.order), ["a", "b", "c", "d"])
+
+    def test_per_device_limit(self):
+        device = filesystem.Device(host.get_localhost(), "1", "ext4", None)
+        other = filesystem.Device(host.get_localhost(), "2", "ext4", None)
+        for name in ["a", "b"]:
+            self.executor.submit(self._make_function(name, "1"),
+                                 devices=[device])
+        self.executor.submit(self._make_function("c", "2"), devices=[other])
+        self.executor.start()
+        self.assertFalse(self.executor.join(0.2))
+        self.assertEqual(self.max_running, {"1": 1, "2": 1})
+        self.release.set()
+        self.assertTrue(self.executor.join(5))
+
+    def test_same_key(self):
+        first = self.executor.submit(self._make_function("a", "key"),
+                                     key="repository")
+        self.executor.start()
+        time.sleep(0.1)
+        # one job may wait while the other one runs
+        second = self.executor.submit(self._make_function("b", "key"),
+                                      key="repository")
+        self.assertIsNotNone(second)
+        self.assertIsNone(self.executor.submit(
+            self._make_function("c", "key"), key="repository"))
+        self.release.set()
+        self.assertTrue(self.executor.join(5))
+        self.assertEqual(self.order, ["a", "b"])
+        self.assertEqual(self.max_running, {"key": 1})
+        self.assertEqual(first.result, "a")
+        self.assertEqual(second.state, jobexecutor.JOB_FINISHED)
+
+    def test_cancel(self):
+        done = []
+        running = self.executor.submit(
+            lambda: self.release.wait(5), key="a", callback=done.append)
+        self.executor.start()
+        time.sleep(0.1)
+        waiting = self.executor.submit(
+            lambda: None, key="a", callback=done.append)
+        waiting.cancel()
+        self.assertEqual(done, [waiting])
+        self.assertEqual(waiting.state, jobexecutor.JOB_CANCELLED)
+        running.cancel()
+        self.assertTrue(running.is_cancelled())
+        self.release.set()
+        self.assertTrue(self.executor.join(5))
+        self.assertEqual(running.state, jobexecutor.JOB_CANCELLED)
+        self.assertEqual(done, [waiting, running])
+
+    def test_timeout(self):
+        def function():
+            job = jobexecutor.get_current_job()
+            # rsync and friends stop as soon as the job is cancelled
+            process.execute(host.get_localhost(), ["sleep", "10"],
+                            getpass.getuser(), cancel_event=job.cancelled)
+        job = self.executor.submit(function, timeout=0.2)
+        start = time.time()
+        self.executor.start()
+        self.assertTrue(self.executor.join(5))
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(job.state, jobexecutor.JOB_TIMED_OUT)
+        self.assertIsNone(jobexecutor.get_current_job())
+
+    def test_error(self):
+        def function():
+            raise process.ProcessError(1, "", "failed")
+        job = self.executor.submit(function)
+        self.executor.start()
+        self.assertTrue(self.executor.join(5))
+        self.assertEqual(job.state, jobexecutor.JOB_FAILED)
+        self.assertIsInstance(job.error, process.ProcessError)
@@ -0,0 +1,182 @@
+import unittest
+
+import filesystem
+import host
+import mountmanager
+
+
+class FakeDevice(object):
+
+    def __init__(self, uuid, mounted=False):
+        self.uuid = uuid
+        self.host = host.get_localhost()
+        self.mounted = mounted
+        self.mounts = 0
+        self.unmounts = 0
+
+    def is_mounted(self):
+        return self.mounted
+
+    def mount(self, mountpoint):
+        if self.mounted:
+            raise filesystem.MountError("The device is already mounted.")
+        self.mounted = True
+        mountpoint.active = True
+        self.mounts += 1
+
+    def unmount(self):
+        self.mounted = False
+        self.unmounts += 1
+
+
+class FakeMountpoint(object):
+
+    def __init__(self, path, active=False, backup_options=None):
+        self.host = host.get_localhost()
+        self.path = path
+        self.active = active
+        self.options = ("defaults",)
+        self.backup_options = backup_options
+        self.remounts = []
+
+    def is_active(self):
+        return self.active
+
+    def remount(self, new_options=None):
+        self.remounts.append(new_options)
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = mountmanager.MountManager(idle_timeout=60)
+        self.device = FakeDevice("c3a1cc6b")
+        self.mountpoint = FakeMountpoint("/media/backup")
+
+    def test_mount_once(self):
+        self.manager.acquire(self.device, self.mountpoint)
+        self.manager.acquire(FakeDevice("c3a1cc6b"),
+                             FakeMountpoint("/media/backup/"))
+        self.assertEqual(self.device.mounts, 1)
+        self.assertEqual(
+            self.manager.get_reference_count(self.device, self.mountpoint), 2)
+
+    def test_host_aliases(self):
+        # All ips of the localhost are the same host.
+        mountpoint = FakeMountpoint("/media/backup")
+        mountpoint.host = host.Host(ip="127.0.0.2")
+        self.manager.acquire(self.device, self.mountpoint)
+        self.manager.acquire(self.device, mountpoint)
+        self.assertEqual(self.device.mounts, 1)
+        self.assertEqual(
+            self.manager.get_reference_count(self.device, self.mountpoint), 2)
+
+    def test_idle_unmount(self):
+        self.manager.acquire(self.device, self.mountpoint)
+        self.manager.release(self.device, self.mountpoint, now=1000)
+        self.assertEqual(self.manager.unmount_idle(now=1059), 0)
+        self.assertTrue(self.device.mounted)
+        self.assertEqual(self.manager.unmount_idle(now=1060), 1)
+        self.assertFalse(self.device.mounted)
+        self.assertEqual(
+            self.manager.get_reference_count(self.device, self.mountpoint), 0)
+
+    def test_reuse_while_idle(self):
+        self.manager.acquire(self.device, self.mountpoint)
+        self.manager.release(self.device, self.mountpoint, now=1000)
+        self.manager.acquire(self.device, self.mountpoint)
+        self.assertEqual(self.manager.unmount_idle(now=5000), 0)
+        self.assertEqual(self.device.mounts, 1)
+
+    def test_no_idle_timeout(self):
+        manager = mountmanager.MountManager(idle_timeout=0)
+        manager.acquire(self.device, self.mountpoint)
+        manager.release(self.device, self.mountpoint)
+        self.assertEqual(self.device.unmounts, 1)
+
+    def test_foreign_mount(self):
+        device = FakeDevice("c3a1cc6b", mounted=True)
+        mountpoint = FakeMountpoint("/media/backup", active=True)
+        self.manager.acquire(device, mountpoint)
+        self.manager.release(device, mountpoint)
+        self.assertEqual(self.manager.unmount_all(), 0)
+        self.assertEqual(device.mounts, 0)
+        self.assertTrue(device.mounted)
+
+    def test_failed_mount(self):
+        device = FakeDevice("c3a1cc6b", mounted=True)
+        self.assertRaises(filesystem.MountError,
+                          self.manager.acquire, device, self.mountpoint)
+        self.assertEqual(
+            self.manager.get_reference_count(device, self.mountpoint), 0)
+
+    def test_release_unknown(self):
+        self.assertRaises(ValueError,
+                          self.manager.release, self.device, self.mountpoint)
+
+    def test_backup_profile(self):
+        mountpoint = FakeMountpoint("/media/backup",
+                                    backup_options=("noatime",))
+        self.manager.acquire(self.device, mountpoint)
+        self.manager.acquire(self.device, mountpoint)
+        self.assertEqual(mountpoint.remounts, [("noatime",)])
+        self.manager.release(self.device, mountpoint)
+        self.assertEqual(mountpoint.remounts, [("noatime",)])
+        self.manager.release(self.device, mountpoint)
+        self.assertEqual(mountpoint.remounts, [("noatime",), ("defaults",)])
+        self.manager.acquire(self.device, mountpoint)
+        self.assertEqual(mountpoint.remounts[-1], ("noatime",))
+
+    def test_no_backup_profile(self):
+        self.manager.acquire(self.device, self.mountpoint)
+        self.manager.release(self.device, self.mountpoint)
+        self.assertEqual(self.mountpoint.remounts, [])
+
+    def test_foreign_mount_profile(self):
+        device = FakeDevice("c3a1cc6b", mounted=True)
+        mountpoint = FakeMountpoint("/media/backup", active=True,
+                                    backup_options=("noatime",))
+        self.manager.acquire(device, mountpoint)
+        self.assertEqual(mountpoint.remounts, [])
+
+    def test_timings(self):
+        mountpoint = FakeMountpoint("/media/backup",
+                                    backup_options=("noatime",))
+        self.manager.acquire(self.device, mountpoint)
+        self.manager.release(self.device, mountpoint)
+        self.manager.unmount_all()
+        self.assertEqual(
+            [timing.operation for timing in self.manager.pop_timings()],
+            ["mount", "backup profile", "safe profile", "unmount"])
+        self.assertEqual(self.manager.pop_timings(), [])
+
+    def test_restore_safe_profile(self):
+        commands = []
+
+        class Mountpoint(filesystem.Mountpoint):
+
+            def exists(self):
+                return True
+
+            def is_active(self):
+                return True
+
+        (options, backup_options) = mountmanager.get_profiles("ext4")
+        mountpoint = Mountpoint(host.get_localhost(), "/media/backup",
+                                options, False, "backup", backup_options)
+        execute_mount_command = filesystem._execute_mount_command
+        filesystem._execute_mount_command = (
+            lambda mount_host, args, user: commands.append(args))
+        try:
+            self.manager.acquire(self.device, mountpoint)
+            self.manager.release(self.device, mountpoint)
+        finally:
+            filesystem._execute_mount_command = execute_mount_command
+        self.assertEqual(commands, [
+            ["mount", "-o", "noatime,lazytime,commit=60,remount",
+             "/media/backup"],
+            ["mount", "-o", "relatime,nolazytime,commit=5,remount",
+             "/media/backup"]])
+        self.assertEqual(mountmanager.get_profiles("btrfs"),
+                         (("relatime", "nolazytime"),
+                          ("noatime", "lazytime")))
@@ -0,0 +1,136 @@
+import unittest
+import threading
+import time
+
+import filesystem
+import host
+import mountplanner
+
+
+class FakeDevice(object):
+
+    def __init__(self, uuid, device_host, user="backup"):
+        self.uuid = uuid
+        self.host = device_host
+        self.user = user
+
+
+class FakeMountpoint(object):
+
+    def __init__(self, path, mountpoint_host):
+        self.path = path
+        self.host = mountpoint_host
+
+
+class FakeMountManager(object):
+
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.order = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, device, mountpoint):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+            self.order.append(mountpoint.path)
+        if device.uuid in self.failing:
+            raise filesystem.MountError("Device is not available.")
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.localhost = host.get_localhost()
+        self.remotehost = host.Host(ip="192.0.2.1")
+
+    def test_parallel(self):
+        manager = FakeMountManager()
+        planner = mountplanner.MountPlanner(manager, max_mounts_per_host=10)
+        for i in range(10):
+            planner.add(FakeDevice(str(i), self.localhost),
+                        FakeMountpoint("/media/{0}".format(i),
+                                       self.localhost))
+        start = time.time()
+        results = planner.execute()
+        self.assertLess(time.time() - start, 0.4)
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(result.error is None for result in results))
+        self.assertGreater(manager.max_running, 1)
+
+    def test_host_limit(self):
+        manager = FakeMountManager()
+        planner = mountplanner.MountPlanner(manager, max_mounts_per_host=2)
+        for i in range(6):
+            planner.add(FakeDevice(str(i), self.localhost),
+                        FakeMountpoint("/media/{0}".format(i),
+                                       self.localhost))
+        planner.execute()
+        self.assertEqual(manager.max_running, 2)
+
+    def test_nested_mountpoints(self):
+        manager = FakeMountManager()
+        planner = mountplanner.MountPlanner(manager, max_mounts_per_host=10)
+        planner.add(FakeDevice("a", self.localhost),
+                    FakeMountpoint("/media/backup/inner", self.localhost))
+        planner.add(FakeDevice("b", self.localhost),
+                    FakeMountpoint("/media/backup/", self.localhost))
+        planner.add(FakeDevice("c", self.localhost),
+                    FakeMountpoint("/media/backup2", self.localhost))
+        planner.execute()
+        self.assertLess(manager.order.index("/media/backup/"),
+                        manager.order.index("/media/backup/inner"))
+
+    def test_temporary_mountpoints(self):
+        manager = FakeMountManager()
+        planner = mountplanner.MountPlanner(manager, max_mounts_per_host=10)
+        for i in range(3):
+            planner.add(FakeDevice(str(i), self.remotehost),
+                        FakeMountpoint("/media/{0}".format(i),
+                                       self.localhost))
+        planner.execute()
+        # Every device has its own temporary mountpoint.
+        self.assertEqual(manager.max_running, 3)
+
+    def test_same_device(self):
+        manager = FakeMountManager()
+        planner = mountplanner.MountPlanner(manager, max_mounts_per_host=10)
+        for i in range(3):
+            planner.add(FakeDevice("a", self.localhost),
+                        FakeMountpoint("/media/{0}".format(i),
+                                       self.localhost))
+        planner.add(FakeDevice("b", self.localhost),
+                    FakeMountpoint("/media/b", self.localhost))
+        planner.execute()
+        # The mounts of the same device run one after another, next to the
+        # mount of the other device.
+        self.assertEqual([path for path in manager.order
+                          if path != "/media/b"],
+                         ["/media/0", "/media/1", "/media/2"])
+        self.assertEqual(manager.max_running, 2)
+
+    def test_failed_dependency(self):
+        manager = FakeMountManager(failing=("b",))
+        planner = mountplanner.MountPlanner(manager, max_mounts_per_host=10)
+        planner.add(FakeDevice("a", self.localhost),
+                    FakeMountpoint("/media/backup/inner", self.localhost))
+        planner.add(FakeDevice("b", self.localhost),
+                    FakeMountpoint("/media/backup", self.localhost))
+        results = planner.execute()
+        self.assertIsInstance(results[0].error, filesystem.MountError)
+        self.assertIsInstance(results[1].error, filesystem.MountError)
+        self.assertEqual(manager.order, ["/media/backup"])
+
+    def test_duplicates(self):
+        manager = FakeMountManager()
+        planner = mountplanner.MountPlanner(manager, max_mounts_per_host=10)
+        planner.add(FakeDevice("a", self.localhost),
+                    FakeMountpoint("/media/backup", self.localhost))
+        planner.add(FakeDevice("a", self.localhost),
+                    FakeMountpoint("/media/backup/", self.localhost))
+        self.assertEqual(len(planner.execute()), 1)
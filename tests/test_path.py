@@ -0,0 +1,49 @@
+import unittest
+import getpass
+
+import filesystem
+import host
+import path
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.localhost = host.get_localhost()
+        self.remotehost = host.Host(ip="192.0.2.1")
+        self.user = getpass.getuser()
+
+    def make_location(self, location_host, device_host):
+        device = filesystem.Device(host=device_host, uuid="c3a1cc6b",
+                                   filesystem="ext4", user=self.user)
+        mountpoint = filesystem.Mountpoint(host=location_host,
+                                           path="/media/backup",
+                                           options=("noatime",),
+                                           create_if_not_existent=False,
+                                           user=self.user)
+        return path.FullLocation(user=self.user, host=location_host,
+                                 path="/media/backup/repo", device=device,
+                                 mountpoint=mountpoint)
+
+    def test_direct_same_host(self):
+        location = self.make_location(self.localhost, self.localhost)
+        self.assertTrue(location.is_direct())
+        self.assertIs(location.get_direct_location(), location)
+
+    def test_remote_device(self):
+        location = self.make_location(self.localhost, self.remotehost)
+        self.assertFalse(location.is_direct())
+        direct = location.get_direct_location()
+        self.assertTrue(direct.is_direct())
+        self.assertEqual(direct.host, self.remotehost)
+        self.assertEqual(direct.mountpoint.host, self.remotehost)
+        self.assertEqual(direct.mountpoint.path, "/media/backup")
+        self.assertEqual(direct.mountpoint.options, ("noatime",))
+        self.assertEqual(direct.get_ssh_string(),
+                         "{0}@192.0.2.1:/media/backup/repo".format(self.user))
+
+    def test_local_device(self):
+        location = self.make_location(self.remotehost, self.localhost)
+        direct = location.get_direct_location()
+        self.assertTrue(direct.host.is_localhost())
+        self.assertEqual(direct.get_ssh_string(), "/media/backup/repo")
@@ -0,0 +1,71 @@
+import unittest
+
+import host
+import process
+
+
+class FakeConnection(object):
+
+    instances = []
+
+    def __init__(self, host, local_user, remote_user, port):
+        self.host = host
+        self.local_user = local_user
+        self.remote_user = remote_user
+        self.connected = False
+        self.commands = []
+        FakeConnection.instances.append(self)
+
+    def connect(self, timeout, remote_shell):
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def is_connected(self):
+        return self.connected
+
+    def execute(self, command, timeout):
+        self.commands.append((command, timeout))
+        return (0, "fingerprint\n", "")
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.connection_class = process._CONNECTION_CLASS
+        process._CONNECTION_CLASS = FakeConnection
+        FakeConnection.instances = []
+        self.remotehost = host.Host(ip="192.0.2.1")
+
+    def tearDown(self):
+        process.disconnect(self.remotehost)
+        process._CONNECTION_CLASS = self.connection_class
+
+    def test_shared(self):
+        process.execute(self.remotehost, ["true"], "backup")
+        process.execute(self.remotehost, ["true"], "backup")
+        self.assertEqual(len(FakeConnection.instances), 1)
+        self.assertTrue(process.is_connected(self.remotehost))
+
+    def test_unshared(self):
+        # Long commands must not wait for or hold up the shared connection.
+        process.execute(self.remotehost, ["true"], "backup")
+        shared = FakeConnection.instances[0]
+        self.assertEqual(process.func_get_fingerprint(
+            self.remotehost, "backup", "/home", time_limit=60),
+            "fingerprint")
+        process.func_clone_tree(self.remotehost, "backup", "/a", "/b",
+                                time_limit=3600)
+        self.assertEqual(len(shared.commands), 1)
+        (walk, clone) = FakeConnection.instances[1:]
+        self.assertEqual(walk.commands[0][1], 70 * 1000)
+        self.assertEqual(clone.commands[0][1], 3600 * 1000)
+        self.assertFalse(walk.connected)
+        self.assertFalse(clone.connected)
+
+    def test_clone_minimum_timeout(self):
+        process.func_clone_tree(self.remotehost, "backup", "/a", "/b",
+                                time_limit=0.5)
+        self.assertEqual(FakeConnection.instances[0].commands[0][1],
+                         process._COMMAND_TIMEOUT)
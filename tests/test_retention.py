@@ -0,0 +1,101 @@
+import unittest
+import datetime
+import random
+
+import backuprepository
+import retention
+
+
+class FakeCron(object):
+
+    def matches(self, date_time):
+        return False
+
+
+def _make_tag(max_age=None, max_count=None, thinning=None):
+    return backuprepository.Tag(FakeCron(), max_age, max_count,
+                                thinning=thinning)
+
+
+def _timestamp(*args):
+    return retention.to_timestamp(datetime.datetime(*args))
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = _timestamp(2013, 6, 15, 12, 0, 0)
+        # every six hours over the last five weeks
+        self.births = [self.now - hours * 3600
+                       for hours in range(0, 5 * 7 * 24, 6)]
+
+    def _get_expired(self, births, tag_ids, tags):
+        expired = retention.get_expired(births, tag_ids, tags, self.now)
+        self.assertEqual(expired, retention._get_expired_sorted(
+            births, tag_ids, tags, self.now))
+        return expired
+
+    def test_max_age(self):
+        tag = _make_tag(max_age=datetime.timedelta(days=1))
+        expired = self._get_expired(self.births, [0] * len(self.births),
+                                    [tag])
+        self.assertEqual(expired, list(range(5, len(self.births))))
+
+    def test_max_count(self):
+        births = list(reversed(self.births))
+        tag = _make_tag(max_count=3)
+        expired = self._get_expired(births, [0] * len(births), [tag])
+        self.assertEqual(expired, list(range(len(births) - 3)))
+
+    def test_thinning(self):
+        tag = _make_tag(thinning=retention.DAILY)
+        expired = self._get_expired(self.births, [0] * len(self.births),
+                                    [tag])
+        kept = [birth for (index, birth) in enumerate(self.births)
+                if index not in expired]
+        days = [birth // 86400 for birth in kept]
+        self.assertEqual(len(days), len(set(days)))
+        self.assertEqual(set(days),
+                         set(birth // 86400 for birth in self.births))
+        # the newest backup of a day is kept
+        self.assertIn(self.now, kept)
+
+    def test_weekly_thinning(self):
+        tag = _make_tag(thinning=retention.WEEKLY)
+        sunday = _timestamp(2013, 6, 16, 23, 0, 0)
+        monday = _timestamp(2013, 6, 17, 1, 0, 0)
+        tuesday = _timestamp(2013, 6, 18, 1, 0, 0)
+        expired = self._get_expired([sunday, monday, tuesday], [0, 0, 0],
+                                    [tag])
+        self.assertEqual(expired, [1])
+
+    def test_monthly_thinning_with_count(self):
+        tag = _make_tag(max_count=1, thinning=retention.MONTHLY)
+        expired = self._get_expired(self.births, [0] * len(self.births),
+                                    [tag])
+        self.assertEqual(expired, list(range(1, len(self.births))))
+
+    def test_tags_separate(self):
+        tags = [_make_tag(max_count=1), _make_tag(max_count=2), None]
+        births = [1, 2, 3, 4, 5, 6, 7]
+        tag_ids = [0, 1, 2, 0, 1, 2, 1]
+        self.assertEqual(self._get_expired(births, tag_ids, tags), [0, 1])
+
+    def test_random(self):
+        generator = random.Random(42)
+        tags = [_make_tag(max_count=10, thinning=retention.HOURLY),
+                _make_tag(max_age=datetime.timedelta(days=3)),
+                _make_tag(max_count=5, max_age=datetime.timedelta(days=20),
+                          thinning=retention.WEEKLY)]
+        births = [self.now - generator.randint(0, 60 * 86400)
+                  for _ in range(1000)]
+        tag_ids = [generator.randint(0, 2) for _ in births]
+        self._get_expired(births, tag_ids, tags)
+
+    def test_unknown_bucket(self):
+        self.assertRaises(ValueError, retention.get_expired, [1], [0],
+                          [_make_tag(thinning="fortnightly")], self.now)
+
+    def test_empty(self):
+        self.assertEqual(retention.get_expired([], [], [_make_tag()],
+                                               self.now), [])
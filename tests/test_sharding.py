@@ -0,0 +1,62 @@
+import unittest
+
+import catalog
+import sharding
+
+
+class Tests(unittest.TestCase):
+
+    def test_plan_balanced(self):
+        sizes = {"a": 100, "b": 60, "c": 50, "d": 40, "e": 10}
+        shards = sharding.plan_shards(sorted(sizes), sizes, 2)
+        self.assertEqual(shards, [["a", "d"], ["b", "c", "e"]])
+        self.assertEqual(sorted(entry for shard in shards for entry in shard),
+                         sorted(sizes))
+
+    def test_plan_unknown(self):
+        # without estimates, directories are spread evenly
+        shards = sharding.plan_shards(["a", "b", "c", "d"], {}, 2)
+        self.assertEqual([len(shard) for shard in shards], [2, 2])
+        # new directories count as average
+        shards = sharding.plan_shards(["a", "b", "new"], {"a": 10, "b": 10},
+                                      3)
+        self.assertEqual(shards, [["a"], ["b"], ["new"]])
+
+    def test_plan_few_entries(self):
+        self.assertEqual(sharding.plan_shards(["a"], {}, 4), [["a"]])
+        self.assertEqual(sharding.plan_shards([], {}, 4), [])
+
+    def test_update_sizes(self):
+        sizes = {"a": 30, "b": 10, "c": 50, "gone": 5}
+        shards = [["a", "b"], ["c"], ["d"]]
+        self.assertEqual(sharding.update_sizes(sizes, shards,
+                                               [400, 80, None]),
+                         {"a": 300, "b": 100, "c": 80})
+
+    def test_update_sizes_failed(self):
+        sizes = {"a": 30, "b": 10}
+        self.assertEqual(sharding.update_sizes(sizes, [["a"], ["b"]],
+                                               [None, 20]),
+                         {"a": 30, "b": 20})
+
+    def test_shard_paths(self):
+        self.assertEqual(sharding.get_shard_paths("/home", ["a", "b"]),
+                         ["/./home/a", "/./home/b"])
+        self.assertEqual(sharding.get_shard_paths("/srv/home/", ["a"]),
+                         ["/srv/home/./a"])
+        self.assertEqual(sharding.get_shard_paths("/srv/home", ["a"]),
+                         ["/srv/./home/a"])
+        self.assertEqual(sharding.get_shard_paths("/", ["a"]), ["/./a"])
+        self.assertEqual(sharding.get_shard_paths("home", ["a"]),
+                         ["./home/a"])
+        self.assertEqual(sharding.get_shard_paths("srv/home", ["a"]),
+                         ["srv/./home/a"])
+
+    def test_sizes_in_catalog(self):
+        repository_catalog = catalog.Catalog(":memory:")
+        self.assertEqual(sharding.load_sizes(repository_catalog, "/home"), {})
+        sharding.save_sizes(repository_catalog, "/home", {"a": 10.5})
+        self.assertEqual(sharding.load_sizes(repository_catalog, "/home"),
+                         {"a": 10.5})
+        self.assertEqual(sharding.load_sizes(repository_catalog, "/srv"), {})
+        repository_catalog.close()
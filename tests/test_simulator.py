@@ -0,0 +1,119 @@
+import unittest
+import collections
+import datetime
+
+import backuprepository
+import cron
+import retention
+import simulator
+
+
+def replay(tags, start, end):
+    """Checks the backups every minute, like BackupRepository."""
+    births = []
+    tag_ids = []
+    created = 0
+    peak = 0
+    expiries = collections.Counter()
+    now = start
+    while now < end:
+        timestamp = retention.to_timestamp(now)
+        expired = retention.get_expired(births, tag_ids, tags, timestamp)
+        if expired:
+            expiries[timestamp] += len(expired)
+        for index in reversed(expired):
+            del births[index]
+            del tag_ids[index]
+        for (tag_id, tag) in enumerate(tags):
+            if tag.cron.matches(now):
+                births.append(timestamp)
+                tag_ids.append(tag_id)
+                created += 1
+        peak = max(peak, len(births))
+        now += datetime.timedelta(minutes=1)
+    return (created, peak, expiries)
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.start = datetime.datetime(2012, 2, 27, 22, 17)
+        self.end = datetime.datetime(2012, 3, 3, 1, 0)
+        self.tags = [
+            backuprepository.Tag(cron.Cronjob("*/10 * * * * *"),
+                                 datetime.timedelta(hours=5), 20,
+                                 "often", retention.HOURLY),
+            backuprepository.Tag(cron.Cronjob("*/30 */2 * * * *"),
+                                 None, None, "thinned", retention.DAILY),
+            backuprepository.Tag(cron.Cronjob("5 * * * * *"),
+                                 datetime.timedelta(minutes=150), None,
+                                 "aged"),
+            backuprepository.Tag(cron.Cronjob("1-3 1 * * * *"),
+                                 None, 4, "counted"),
+            # The newest backup of the current hour counts right away.
+            backuprepository.Tag(cron.Cronjob("0,30 * * * * *"),
+                                 None, 1, "thinned and counted",
+                                 retention.HOURLY),
+            backuprepository.Tag(cron.Cronjob("15 */5 * * * *"),
+                                 datetime.timedelta(days=3), 2,
+                                 "daily and counted", retention.DAILY)]
+
+    def test_occurrences(self):
+        cronjob = cron.Cronjob("*/20 1-2,23 28-31 * * *")
+        occurrences = simulator.get_occurrences(cronjob, self.start,
+                                                self.end)
+        expected = []
+        now = self.start
+        while now < self.end:
+            if cronjob.matches(now):
+                expected.append(retention.to_timestamp(now))
+            now += datetime.timedelta(minutes=1)
+        self.assertEqual(list(occurrences), expected)
+
+    def test_same_as_replay(self):
+        tags = self.tags
+        expiry_counts = simulator.CheckHistogram(self.start, self.end)
+        result = simulator.simulate(tags, self.start, self.end,
+                                    expiry_counts)
+        (created, peak, expiries) = replay(tags, self.start, self.end)
+        self.assertEqual(result.created, created)
+        self.assertEqual(result.peak, peak)
+        self.assertEqual(expiry_counts.get_counts(), dict(expiries))
+        self.assertEqual(result.expired, sum(expiries.values()))
+        self.assertEqual(result.burst, max(expiries.values()))
+        for tag in tags:
+            (births, tag_expiries) = simulator.simulate_tag(tag, self.start,
+                                                            self.end)
+            self.assertEqual(list(tag_expiries),
+                             simulator._get_expiries_sorted(
+                                 list(births), tag, self.end))
+
+    def test_repositories(self):
+        tags = [backuprepository.Tag(cron.Cronjob("*/15 * * * * *"), None,
+                                     2, "quarterly")]
+        other = [backuprepository.Tag(cron.Cronjob("*/15 * * * * *"), None,
+                                      3, "quarterly")]
+        (results, burst) = simulator.simulate_repositories(
+            [tags, other, tags], self.start, self.end)
+        self.assertIs(results[0], results[2])
+        self.assertEqual(results[0].remaining, 2)
+        self.assertEqual(results[1].remaining, 3)
+        self.assertEqual(burst, 3)
+
+    def test_without_numpy(self):
+        if simulator.numpy is None:
+            self.skipTest("NumPy is not installed")
+        numpy_counts = simulator.CheckHistogram(self.start, self.end)
+        expected = simulator.simulate(self.tags, self.start, self.end,
+                                      numpy_counts, 2)
+        expected_counts = numpy_counts.get_counts()
+        numpy_module = simulator.numpy
+        simulator.numpy = None
+        try:
+            counts = simulator.CheckHistogram(self.start, self.end)
+            result = simulator.simulate(self.tags, self.start, self.end,
+                                        counts, 2)
+            self.assertEqual(counts.get_counts(), expected_counts)
+        finally:
+            simulator.numpy = numpy_module
+        self.assertEqual(vars(result), vars(expected))
@@ -0,0 +1,127 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+import backuprepository
+import catalog
+import path
+import usage
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.catalog = catalog.Catalog(":memory:")
+        self.first = self._make_backup("2010-12-15T21:13:02.hourly.bak", 10)
+        self._write(self.first, "unchanged", 20000)
+        os.mkdir(os.path.join(self.directory, self.first, "dir"))
+        self._write(self.first, "dir/changed", 30000)
+        self.second = self._make_backup("2011-03-23T13:59:45.hourly.bak", 20)
+        os.mkdir(os.path.join(self.directory, self.second, "dir"))
+        os.link(os.path.join(self.directory, self.first, "unchanged"),
+                os.path.join(self.directory, self.second, "unchanged"))
+        self._write(self.second, "dir/changed", 40000)
+        self._write(self.second, "new", 50000)
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.directory)
+
+    def _make_backup(self, name, birth):
+        os.mkdir(os.path.join(self.directory, name))
+        self.catalog.add(name, "hourly", birth, catalog.STATUS_COMPLETE)
+        return name
+
+    def _write(self, backup, name, size):
+        with open(os.path.join(self.directory, backup, name), "wb") as new:
+            new.write(b"x" * size)
+
+    def _account(self, name):
+        return usage.account_backup(self.catalog, self.directory,
+                                    self.catalog.get_snapshot(name))
+
+    def _get_du(self, *paths):
+        """Counts every inode below the paths once."""
+        seen = set()
+        total = 0
+        for root in paths:
+            for (inode, _, size, _) in usage._walk(root):
+                if inode not in seen:
+                    seen.add(inode)
+                    total += size
+            total += usage._get_size(os.lstat(root))
+        return total
+
+    def _get_unique_bytes(self, name):
+        return self.catalog.get_snapshot(name).unique_bytes
+
+    def test_oldest_owner(self):
+        first_path = os.path.join(self.directory, self.first)
+        second_path = os.path.join(self.directory, self.second)
+        self.assertEqual(self._account(self.first), self._get_du(first_path))
+        self._account(self.second)
+        self.assertEqual(
+            self._get_unique_bytes(self.first) +
+            self._get_unique_bytes(self.second),
+            self._get_du(first_path, second_path))
+        # the shared file only counts for the first backup
+        self.assertEqual(
+            self._get_unique_bytes(self.second),
+            self._get_du(second_path) - usage._get_size(
+                os.lstat(os.path.join(second_path, "unchanged"))))
+
+    def test_out_of_order(self):
+        self._account(self.second)
+        self._account(self.first)
+        self.assertEqual(self._get_unique_bytes(self.first),
+                         self._get_du(os.path.join(self.directory,
+                                                   self.first)))
+        unchanged = os.lstat(os.path.join(self.directory, self.second,
+                                          "unchanged"))
+        self.assertEqual(self.catalog.get_inodes(
+            [unchanged.st_ino])[unchanged.st_ino].snapshot, self.first)
+
+    def test_release(self):
+        self._account(self.first)
+        self._account(self.second)
+        second_path = os.path.join(self.directory, self.second)
+        shutil.rmtree(os.path.join(self.directory, self.first))
+        self.catalog.remove(self.first)
+        self.assertEqual(usage.release_inodes(self.catalog, self.directory,
+                                              window=5), (1, 1))
+        self.assertEqual(self._get_unique_bytes(self.second),
+                         self._get_du(second_path))
+        self.assertEqual(self.catalog.get_orphaned_inodes(), [])
+        self.assertEqual(usage.release_inodes(self.catalog, self.directory,
+                                              window=5), (0, 0))
+
+    def test_internal_hardlink(self):
+        os.link(os.path.join(self.directory, self.second, "new"),
+                os.path.join(self.directory, self.second, "dir", "new"))
+        self._account(self.first)
+        self._account(self.second)
+        self.assertEqual(
+            self._get_unique_bytes(self.first) +
+            self._get_unique_bytes(self.second),
+            self._get_du(os.path.join(self.directory, self.first),
+                         os.path.join(self.directory, self.second)))
+
+    def test_repository(self):
+        self.catalog.add("2012-01-01T00:00:00.hourly.bak", "hourly", 30,
+                         catalog.STATUS_FAILED)
+        repository = backuprepository.BackupRepository(
+            source_locations=[],
+            repository_location=path.FullLocation(
+                None, None, self.directory, None),
+            repository_directories=None,
+            tags=[],
+            catalog=self.catalog)
+        self.assertEqual(repository.update_usage(), 2)
+        self.assertEqual(repository.update_usage(), 0)
+        self.assertEqual(
+            self.catalog.get_usage_by_tag(),
+            {"hourly": self._get_du(
+                os.path.join(self.directory, self.first),
+                os.path.join(self.directory, self.second))})